@@ -1,3 +1,4 @@
+import time
 from datetime import datetime, timedelta
 from typing import Optional
 from jose import JWTError, jwt
@@ -9,6 +10,7 @@ from sqlalchemy import select
 from app.config import settings
 from app.database import get_db
 from app.models import User
+from app.utils import TTLCache
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 security = HTTPBearer()
@@ -33,49 +35,108 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -
     return encoded_jwt
 
 
-async def get_current_user(
-    credentials: HTTPAuthorizationCredentials = Depends(security),
-    db: AsyncSession = Depends(get_db)
-) -> User:
-    credentials_exception = HTTPException(
+# Fast path auth: token già verificato → user_id, user_id → snapshot delle colonne di User.
+# Cache per processo con TTL breve; invalidate_user() dopo ogni cambio di crediti/verifica
+# (negli altri processi lo snapshot resta al massimo auth_cache_ttl_seconds).
+_token_cache = TTLCache(maxsize=settings.auth_token_cache_size, ttl=settings.auth_cache_ttl_seconds)
+_user_cache = TTLCache(maxsize=settings.auth_user_cache_size, ttl=settings.auth_cache_ttl_seconds)
+
+_USER_COLUMNS = [c.key for c in User.__table__.columns]
+
+
+def _credentials_exception() -> HTTPException:
+    return HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    
+
+
+def _decode_user_id(token: str) -> Optional[str]:
+    """user_id (sub) di un JWT valido, None se non valido. I token verificati restano in cache fino a
+    auth_cache_ttl_seconds, mai oltre la loro scadenza."""
+    user_id = _token_cache.get(token)
+    if user_id is not None:
+        return user_id
     try:
-        token = credentials.credentials
         payload = jwt.decode(token, settings.jwt_secret_key, algorithms=[settings.jwt_algorithm])
-        user_id: str = payload.get("sub")
-        if user_id is None:
-            raise credentials_exception
     except JWTError:
-        raise credentials_exception
-    
+        return None
+    user_id = payload.get("sub")
+    if user_id is None:
+        return None
+    ttl = settings.auth_cache_ttl_seconds
+    exp = payload.get("exp")
+    if exp is not None:
+        ttl = min(ttl, exp - time.time())
+    if ttl > 0:
+        _token_cache.set(token, user_id, ttl=ttl)
+    return user_id
+
+
+def _remember_user(user: User) -> None:
+    _user_cache.set(user.id, {key: getattr(user, key) for key in _USER_COLUMNS})
+
+
+def invalidate_user(user_id: str) -> None:
+    """Da chiamare dopo ogni modifica di crediti o verifica email dell'utente."""
+    _user_cache.pop(user_id)
+
+
+async def _load_user(db: AsyncSession, user_id: str, use_cache: bool = True) -> Optional[User]:
+    """User dallo snapshot in cache (oggetto nuovo, non legato a una sessione) o dal DB."""
+    if use_cache:
+        snapshot = _user_cache.get(user_id)
+        if snapshot is not None:
+            return User(**snapshot)
     result = await db.execute(select(User).where(User.id == user_id))
     user = result.scalar_one_or_none()
-    if user is None:
-        raise credentials_exception
-    
+    if user is not None:
+        _remember_user(user)
     return user
 
 
-async def get_current_user_optional(
+async def get_current_user_id(
+    credentials: HTTPAuthorizationCredentials = Depends(security),
+) -> str:
+    """Solo l'id dell'utente autenticato: nessuna query (per endpoint che filtrano per user_id)."""
+    user_id = _decode_user_id(credentials.credentials)
+    if user_id is None:
+        raise _credentials_exception()
+    return user_id
+
+
+async def get_current_user_id_optional(
     credentials: Optional[HTTPAuthorizationCredentials] = Depends(HTTPBearer(auto_error=False)),
-    db: AsyncSession = Depends(get_db)
-) -> Optional[User]:
-    """Get current user if authenticated, otherwise return None"""
+) -> Optional[str]:
+    """Come get_current_user_id, None se non autenticato."""
     if credentials is None:
         return None
-    
-    try:
-        token = credentials.credentials
-        payload = jwt.decode(token, settings.jwt_secret_key, algorithms=[settings.jwt_algorithm])
-        user_id: str = payload.get("sub")
-        if user_id is None:
-            return None
-    except JWTError:
-        return None
-    
-    result = await db.execute(select(User).where(User.id == user_id))
-    return result.scalar_one_or_none()
+    return _decode_user_id(credentials.credentials)
+
+
+async def get_current_user(
+    credentials: HTTPAuthorizationCredentials = Depends(security),
+    db: AsyncSession = Depends(get_db)
+) -> User:
+    user_id = _decode_user_id(credentials.credentials)
+    if user_id is None:
+        raise _credentials_exception()
+    user = await _load_user(db, user_id)
+    if user is None:
+        raise _credentials_exception()
+    return user
+
+
+async def get_current_user_fresh(
+    credentials: HTTPAuthorizationCredentials = Depends(security),
+    db: AsyncSession = Depends(get_db)
+) -> User:
+    """Come get_current_user ma sempre dal DB (es. saldo crediti mostrato all'utente)."""
+    user_id = _decode_user_id(credentials.credentials)
+    if user_id is None:
+        raise _credentials_exception()
+    user = await _load_user(db, user_id, use_cache=False)
+    if user is None:
+        raise _credentials_exception()
+    return user
@@ -22,6 +22,16 @@ class Settings(BaseSettings):
     database_url: str
     ca_certificate: str = ""  # Optional CA certificate for SSL connection (full cert content with BEGIN/END)
     database_ssl_reject_unauthorized: bool = True  # Se False, accetta certificati self-signed (es. Render)
+    # Pool connessioni (per processo). Il listener eventi (EVENTS_BACKEND=postgres) tiene occupata una connessione.
+    db_pool_size: int = 10
+    db_max_overflow: int = 10
+    db_pool_timeout: float = 30.0  # secondi di attesa per una connessione libera
+    db_pool_recycle: int = 1800  # riapre connessioni più vecchie (proxy/Render chiudono le idle)
+    db_pool_pre_ping: bool = True
+    db_warmup_connections: int = 2  # aperte all'avvio
+    db_statement_cache_size: int = 100  # asyncpg; 0 con pgbouncer in transaction mode
+    db_prepared_statement_cache_size: int = 100  # SQLAlchemy asyncpg
+    db_echo: bool = False  # log SQL (lento: solo debug)
 
     @field_validator("database_ssl_reject_unauthorized", mode="before")
     @classmethod
@@ -36,9 +46,24 @@ class Settings(BaseSettings):
     jwt_secret_key: str
     jwt_algorithm: str = "HS256"
     jwt_expiration_hours: int = 24
+    # Cache auth per processo: token verificati e snapshot utente (invalidati su crediti/verifica)
+    auth_cache_ttl_seconds: int = 60
+    auth_token_cache_size: int = 10_000
+    auth_user_cache_size: int = 10_000
+    # bcrypt (login/signup/OTP) in un thread pool dedicato
+    password_hash_workers: int = 2
+    password_hash_max_queue: int = 64  # oltre, 503 immediato
+    # OTP verifica email: HMAC con chiave server (default: jwt_secret_key), tentativi per codice
+    otp_secret_key: str = ""
+    otp_max_attempts: int = 5
     
     # WaveSpeed API
     wavespeed_api_key: str
+    # Pool HTTP condiviso verso api.wavespeed.ai (keep-alive + HTTP/2: evita handshake TCP+TLS per richiesta)
+    wavespeed_max_connections: int = 20
+    wavespeed_max_keepalive_connections: int = 10
+    wavespeed_keepalive_expiry: float = 30.0  # secondi
+    wavespeed_http2: bool = True
     
     # Storage
     storage_type: str = "local"  # "local" or "s3"
@@ -47,14 +72,27 @@ class Settings(BaseSettings):
     aws_secret_access_key: str = ""
     aws_region: str = "us-east-1"
     s3_bucket_name: str = ""
+    s3_endpoint_url: str = ""  # opzionale: endpoint S3-compatibile (MinIO, moto server) invece di AWS
+    s3_max_pool_connections: int = 20  # pool connessioni botocore
+    s3_max_concurrency: int = 8  # operazioni S3 contemporanee (thread dell'executor S3)
+    s3_multipart_threshold_mb: int = 16  # upload_file oltre questa soglia usa multipart
     # URL pubblici per API esterne (es. WaveSpeed). Obbligatori per evitare "image url is not allowed":
     # - LOCAL: public_base_url = https://tuo-backend.onrender.com (URL assoluto /storage/...)
     # - S3: cloudfront_domain = d1q70pf5vjeyhc.cloudfront.net (opzionale, altrimenti si usa URL S3 diretto)
     public_base_url: str = ""   # per storage_type=local
     cloudfront_domain: str = "" # per storage_type=s3 (es. d1q70pf5vjeyhc.cloudfront.net, senza https://)
+    # Storage content-addressed: oggetti nominati con l'hash del contenuto (dedup di upload e output)
+    storage_content_addressed: bool = False
+    storage_hash_algorithm: str = "sha256"  # qualsiasi nome hashlib, es. "sha256", "blake2b"
+    storage_hash_index_size: int = 100_000  # hash noti tenuti in memoria (evita exists/HEAD ripetuti)
+    # Streaming output WaveSpeed → storage (memoria per job limitata a chunk/parte, non all'immagine intera)
+    download_chunk_size_kb: int = 256
+    s3_multipart_chunk_size_mb: int = 8  # minimo 5 (limite S3)
     
     # App
     environment: str = "development"
+    # GET /api/metrics (stato interno di code, pool, SMTP): vuoto = endpoint disabilitato (404)
+    metrics_token: str = ""
     cors_origins: str = Field(
         default="http://localhost:3000",
         validation_alias=AliasChoices("CORS_ORIGIN", "CORS_ORIGINS"),
@@ -65,6 +103,68 @@ class Settings(BaseSettings):
     
     # Free tier
     free_generations_per_month: int = 3
+    free_quota_exhausted_cache_seconds: int = 300  # device/IP con quota esaurita rifiutati senza query
+    free_quota_exhausted_cache_size: int = 10_000
+
+    # Cache risultati di generazione (stessa richiesta → output esistente, nessun task WaveSpeed).
+    # Attiva solo con storage_content_addressed=True: la chiave usa l'URL dell'input, che solo così è l'hash del contenuto
+    generation_cache_free_enabled: bool = True
+    generation_cache_paid_enabled: bool = False
+    generation_cache_ttl_seconds: int = 3600  # livello in memoria
+    generation_cache_max_entries: int = 1000
+    generation_cache_db_ttl_hours: int = 24 * 7  # livello DB: generation completate negli ultimi N
+
+    # Singleflight: POST identici in parallelo si agganciano alla generation già in corso
+    singleflight_window_seconds: int = 600  # oltre, una generation ancora in corso non assorbe nuove richieste
+    singleflight_submit_grace_seconds: int = 60  # una generation senza task WaveSpeed assorbe richieste solo per questo tempo
+
+    # Coda persistente webhook WaveSpeed (Postgres SKIP LOCKED), lane separate paid/free
+    job_workers_paid: int = 3
+    job_workers_free: int = 1
+    job_paid_max_backlog: int = 0  # 0 = nessun limite
+    job_free_max_backlog: int = 200  # oltre, /api/generate-free risponde 503 (backpressure)
+    job_max_attempts: int = 5
+    job_visibility_timeout_seconds: int = 300  # un job "running" oltre questo tempo torna reclamabile
+    job_retry_base_seconds: float = 10.0  # backoff: base * 2^(tentativo-1)
+    job_retry_max_seconds: float = 600.0
+    job_poll_interval_seconds: float = 2.0
+    job_retention_hours: int = 72  # job "done" eliminati dopo N ore
+
+    # Recupero webhook WaveSpeed persi (polling adattivo delle generation ferme in processing)
+    reconciler_enabled: bool = True
+    reconciler_interval_seconds: float = 30.0  # ogni quanto cerca generation da interrogare
+    reconciler_grace_seconds: int = 120  # prima di questo tempo si aspetta il webhook
+    reconciler_base_interval_seconds: int = 30  # intervallo per generation: base * 2^tentativi
+    reconciler_max_interval_seconds: int = 600
+    reconciler_batch_size: int = 50
+    reconciler_rate_per_second: float = 5.0  # limite globale di poll verso WaveSpeed
+    reconciler_max_concurrency: int = 5
+    reconciler_max_age_minutes: int = 60  # oltre, la generation viene segnata failed
+    reconciler_pending_grace_seconds: int = 300  # generation ancora "pending" oltre questo tempo: invio a WaveSpeed interrotto
+
+    # Notifiche stato generation (long-poll / SSE)
+    events_backend: str = "postgres"  # "postgres" (LISTEN/NOTIFY, più worker) o "memory" (un solo processo)
+    events_listener_check_seconds: float = 30.0
+    generation_wait_max_seconds: float = 30.0  # massimo per ?wait= su GET /api/generations/{id}
+    generation_sse_max_seconds: float = 300.0
+    generation_sse_keepalive_seconds: float = 15.0
+
+    # Batch (POST /api/generate-batch)
+    batch_max_items: int = 500
+    batch_concurrency: int = 8  # task WaveSpeed creati in parallelo (tutti i batch del processo)
+    batch_results_chunk_size: int = 100  # righe lette per blocco nello streaming dei risultati
+
+    # Storico generation (/api/user/generations)
+    history_max_page_size: int = 100
+
+    # Watermark (free tier): Pillow fuori dall'event loop
+    watermark_executor: str = "thread"  # "thread" o "process"
+    watermark_workers: int = 2
+    watermark_max_in_flight: int = 2  # job contemporanei nell'executor; gli altri attendono in coda
+    watermark_overlay_cache_size: int = 3  # maschere pronte per dimensione (1:1, 4:5, 16:9); 1 byte/pixel ciascuna
+    watermark_jpeg_quality: int = 95
+    watermark_jpeg_progressive: bool = False
+    watermark_jpeg_subsampling: str = ""  # "" = default Pillow; oppure "4:4:4", "4:2:2", "4:2:0"
     
     # Stripe
     stripe_secret_key: str = ""
@@ -76,11 +176,24 @@ class Settings(BaseSettings):
     
     # Upload limits
     max_upload_size_mb: int = 10
+    upload_chunk_size_kb: int = 64  # lettura a chunk dell'upload (memoria costante per richiesta)
     allowed_image_types: str = "image/jpeg,image/png"
 
     # Gmail SMTP (verification OTP)
     gmail_user: str = ""
     gmail_pass: str = ""
+    smtp_host: str = "smtp.gmail.com"
+    smtp_port: int = 587
+    smtp_starttls: bool = True
+    smtp_timeout_seconds: float = 15.0
+    smtp_idle_seconds: float = 60.0  # connessione SMTP persistente chiusa dopo N secondi senza invii
+    # Outbox email (tabella + sender in background, vedi app/email_outbox.py)
+    email_batch_size: int = 20  # messaggi per giro sulla stessa connessione
+    email_poll_interval_seconds: float = 5.0
+    email_max_attempts: int = 6
+    email_retry_base_seconds: float = 5.0
+    email_retry_max_seconds: float = 300.0
+    email_retention_hours: int = 24  # righe sent/expired eliminate dopo N ore
 
     def get_allowed_image_types_list(self) -> List[str]:
         return _parse_list_str(self.allowed_image_types)
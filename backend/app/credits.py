@@ -0,0 +1,159 @@
+"""
+Movimenti di crediti senza read-modify-write: ogni operazione è un solo statement SQL (CTE) che
+aggiorna il saldo in modo condizionale e scrive la CreditTransaction, quindi richieste concorrenti
+non possono spendere più crediti di quelli disponibili.
+
+Le generation prepagate hanno credits_reserved > 0 finché non vengono saldate (completed) o
+rimborsate (failed); saldo e rimborso azzerano credits_reserved con un UPDATE condizionale,
+quindi sono idempotenti (webhook duplicati, retry della coda). Per le generation free
+credits_reserved indica una generation della quota mensile prenotata (vedi utils.reserve_free_generation).
+"""
+from typing import Optional
+
+from sqlalchemy import insert, literal, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app import auth, utils
+from app.models import CreditTransaction, Generation, User, generate_uuid
+
+
+async def _apply(
+    db: AsyncSession,
+    user_id: str,
+    change_amount: int,
+    type: str,
+    reference_id: Optional[str],
+    min_balance: Optional[int] = None,
+) -> bool:
+    """Saldo += change_amount e CreditTransaction in un solo statement (CTE). Con min_balance l'UPDATE
+    è condizionale (credits_balance >= min_balance): False se il saldo non basta o l'utente non esiste."""
+    conditions = [User.id == user_id]
+    if min_balance is not None:
+        conditions.append(User.credits_balance >= min_balance)
+    changed = (
+        update(User)
+        .where(*conditions)
+        .values(credits_balance=User.credits_balance + change_amount)
+        .returning(User.id)
+        .cte("changed")
+    )
+    r = await db.execute(
+        insert(CreditTransaction)
+        .add_cte(changed)
+        .from_select(
+            ["id", "user_id", "change_amount", "type", "reference_id"],
+            select(
+                literal(generate_uuid(), CreditTransaction.id.type),
+                changed.c.id,
+                literal(change_amount),
+                literal(type),
+                literal(reference_id),
+            ),
+        )
+        .returning(CreditTransaction.id)
+    )
+    applied = r.scalar_one_or_none() is not None
+    if applied:
+        auth.invalidate_user(user_id)
+    return applied
+
+
+async def reserve(
+    db: AsyncSession,
+    user_id: str,
+    amount: int,
+    reference_id: Optional[str] = None,
+    type: str = "generation",
+) -> bool:
+    """Scala `amount` crediti solo se il saldo basta (UPDATE ... WHERE credits_balance >= amount) e
+    registra la transazione nello stesso statement. False se il saldo non basta. Non fa commit."""
+    return await _apply(db, user_id, -amount, type, reference_id, min_balance=amount)
+
+
+async def charge(db: AsyncSession, user_id: str, amount: int, reference_id: Optional[str] = None) -> bool:
+    """Addebito senza prenotazione (generation create prima delle prenotazioni): atomico ma non
+    condizionale, il lavoro è già stato fatto. Non fa commit."""
+    return await _apply(db, user_id, -amount, "generation", reference_id)
+
+
+async def grant(db: AsyncSession, user_id: str, amount: int, reference_id: Optional[str] = None, type: str = "purchase") -> bool:
+    """Accredito (acquisto Stripe). False se l'utente non esiste. Non fa commit."""
+    return await _apply(db, user_id, amount, type, reference_id)
+
+
+async def settle(db: AsyncSession, generation_id: str) -> bool:
+    """Generation completata: il credito prenotato resta speso. True se la generation era prepagata
+    (e non ancora saldata/rimborsata), False altrimenti. Non fa commit."""
+    r = await db.execute(
+        update(Generation)
+        .where(Generation.id == generation_id, Generation.credits_reserved > 0)
+        .values(credits_reserved=0)
+        .returning(Generation.id)
+    )
+    return r.scalar_one_or_none() is not None
+
+
+async def refund(db: AsyncSession, generation_id: str) -> int:
+    """Generation fallita: restituisce quanto prenotato. Paid: saldo + CreditTransaction "refund" in un solo
+    statement; free: la generation torna nella quota del mese. Ritorna i crediti rimborsati (0 se non
+    c'era nulla da rimborsare o se la generation è free). Non fa commit."""
+    amount = await _refund_credits(db, generation_id)
+    if not amount:
+        await _release_free_quota(db, generation_id)
+    return amount
+
+
+async def _release_free_quota(db: AsyncSession, generation_id: str) -> None:
+    r = await db.execute(
+        update(Generation)
+        .where(Generation.id == generation_id, Generation.credits_reserved > 0, Generation.is_free.is_(True))
+        .values(credits_reserved=0)
+        .returning(Generation.device_id, Generation.ip_address)
+    )
+    row = r.first()
+    if row and row.device_id and row.ip_address:
+        await utils.release_free_generation(db, row.device_id, row.ip_address)
+
+
+async def _refund_credits(db: AsyncSession, generation_id: str) -> int:
+    released = (
+        update(Generation)
+        .where(
+            Generation.id == generation_id,
+            Generation.credits_reserved > 0,
+            Generation.is_free.is_(False),
+            Generation.user_id.isnot(None),
+        )
+        .values(credits_reserved=0)
+        # RETURNING vede i valori nuovi: l'importo arriva dal sottoselect sulla riga prima dell'update
+        .returning(
+            Generation.user_id,
+            select(Generation.credits_reserved)
+            .where(Generation.id == generation_id)
+            .scalar_subquery()
+            .label("amount"),
+        )
+        .cte("released")
+    )
+    credited = (
+        update(User)
+        .where(User.id == released.c.user_id)
+        .values(credits_balance=User.credits_balance + released.c.amount)
+        .returning(User.id)
+        .cte("credited")
+    )
+    r = await db.execute(
+        insert(CreditTransaction)
+        .add_cte(released)
+        .add_cte(credited)
+        .from_select(
+            ["id", "user_id", "change_amount", "type", "reference_id"],
+            select(literal(generate_uuid(), CreditTransaction.id.type), released.c.user_id, released.c.amount, literal("refund"), literal(generation_id)),
+        )
+        .returning(CreditTransaction.user_id, CreditTransaction.change_amount)
+    )
+    row = r.first()
+    if row is None:
+        return 0
+    auth.invalidate_user(row.user_id)
+    return row.change_amount
@@ -1,9 +1,15 @@
+import asyncio
+import logging
 import tempfile
+import time
 import ssl
+from collections import deque
 from urllib.parse import urlparse, parse_qs, urlencode, urlunparse
 
+from sqlalchemy import exc, text
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine, async_sessionmaker
 from sqlalchemy.orm import declarative_base
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from app.config import settings
 
 
@@ -59,11 +65,49 @@ if need_ssl and "ssl" not in connect_args:
     else:
         connect_args = {**connect_args, "ssl": True}
 
+# Cache dei prepared statement: asyncpg (per connessione) e SQLAlchemy. 0 con pgbouncer in transaction mode.
+connect_args = {
+    **connect_args,
+    "statement_cache_size": settings.db_statement_cache_size,
+    "prepared_statement_cache_size": settings.db_prepared_statement_cache_size,
+}
+
+_pool_waits_ms: deque[float] = deque(maxlen=1000)
+_pool_stats = {"checkouts": 0, "timeouts": 0}
+
+
+class _TimedQueuePool(AsyncAdaptedQueuePool):
+    """Pool standard che misura l'attesa per ottenere una connessione (incluso connect e pre-ping se servono).
+    Estende solo Pool.connect(), API pubblica usata da Engine per ogni checkout (SQLAlchemy 2.0 e 2.1)."""
+
+    def connect(self):
+        start = time.perf_counter()
+        try:
+            conn = super().connect()
+        except exc.TimeoutError:
+            # Nessuna connessione libera entro db_pool_timeout
+            _pool_stats["timeouts"] += 1
+            raise
+        _pool_waits_ms.append((time.perf_counter() - start) * 1000)
+        _pool_stats["checkouts"] += 1
+        return conn
+
+
+# Il pool logga sotto il nome della classe (app.database...): come i logger "sqlalchemy", solo da WARNING
+logging.getLogger(f"{__name__}.{_TimedQueuePool.__name__}").setLevel(logging.WARNING)
+
+
 engine = create_async_engine(
     _db_url,
-    echo=settings.environment == "development",
+    echo=settings.db_echo,
     future=True,
     connect_args=connect_args,
+    poolclass=_TimedQueuePool,
+    pool_size=settings.db_pool_size,
+    max_overflow=settings.db_max_overflow,
+    pool_timeout=settings.db_pool_timeout,
+    pool_recycle=settings.db_pool_recycle,
+    pool_pre_ping=settings.db_pool_pre_ping,
 )
 
 AsyncSessionLocal = async_sessionmaker(
@@ -81,3 +125,33 @@ async def get_db():
             yield session
         finally:
             await session.close()
+
+
+async def warm_up_pool() -> None:
+    """Apre db_warmup_connections connessioni all'avvio (in parallelo, poi tornano nel pool), così le
+    prime richieste dopo un cold start non pagano connect/TLS."""
+    n = min(settings.db_warmup_connections, settings.db_pool_size)
+    if n <= 0:
+        return
+
+    async def ping():
+        async with engine.connect() as conn:
+            await conn.execute(text("SELECT 1"))
+
+    await asyncio.gather(*(ping() for _ in range(n)))
+
+
+def get_pool_stats() -> dict:
+    pool = engine.pool
+    waits = sorted(_pool_waits_ms)
+    return {
+        "size": pool.size(),
+        "checked_out": pool.checkedout(),
+        "checked_in": pool.checkedin(),
+        "overflow": pool.overflow(),
+        "checkouts": _pool_stats["checkouts"],
+        "timeouts": _pool_stats["timeouts"],
+        "wait_avg_ms": round(sum(waits) / len(waits), 2) if waits else 0.0,
+        "wait_p99_ms": round(waits[min(len(waits) - 1, int(len(waits) * 0.99))], 2) if waits else 0.0,
+        "wait_max_ms": round(waits[-1], 2) if waits else 0.0,
+    }
@@ -0,0 +1,237 @@
+"""
+Outbox delle email: le richieste (signup, resend-otp) scrivono il messaggio in email_outbox_photoshotai nella
+stessa transazione dell'utente e rispondono subito; un sender in background lo invia.
+
+- Una sola connessione SMTP persistente per processo (email_sender.SMTPConnection), usata da un thread
+  dedicato: STARTTLS + login solo alla prima email, chiusa dopo smtp_idle_seconds senza invii.
+- Batch: fino a email_batch_size messaggi reclamati con un UPDATE ... FOR UPDATE SKIP LOCKED (più istanze
+  non inviano due volte lo stesso messaggio) e inviati sulla stessa connessione.
+- Errori temporanei: retry con backoff esponenziale; errori 5xx o dopo email_max_attempts: "dead".
+- I messaggi oltre expires_at (OTP già scaduto) non vengono inviati ("expired"); dopo l'invio i corpi
+  (che contengono l'OTP) vengono azzerati.
+"""
+import asyncio
+import logging
+import smtplib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Optional
+
+from sqlalchemy import and_, delete, func, or_, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app import email_sender
+from app.config import settings
+from app.database import AsyncSessionLocal
+from app.models import EmailOutbox
+
+logger = logging.getLogger(__name__)
+
+# Un messaggio "sending" da più di così (sender morto a metà batch) torna reclamabile
+_LOCK_SECONDS = 300
+
+_task: Optional[asyncio.Task] = None
+_wakeup: Optional[asyncio.Event] = None
+_executor: Optional[ThreadPoolExecutor] = None
+_connection = email_sender.SMTPConnection()
+_stats = {
+    "sent": 0,
+    "retried": 0,
+    "dead": 0,
+    "expired": 0,
+    "batches": 0,
+}
+
+
+def _get_wakeup() -> asyncio.Event:
+    global _wakeup
+    if _wakeup is None:
+        _wakeup = asyncio.Event()
+    return _wakeup
+
+
+def enqueue(
+    db: AsyncSession,
+    to_email: str,
+    subject: str,
+    body_plain: str,
+    body_html: str,
+    expires_at: Optional[datetime] = None,
+) -> None:
+    """Aggiunge il messaggio alla sessione del chiamante (nessun commit: parte con la sua transazione).
+    Dopo il commit chiamare wake() per inviarlo subito."""
+    db.add(EmailOutbox(
+        to_email=to_email,
+        subject=subject,
+        body_plain=body_plain,
+        body_html=body_html,
+        expires_at=expires_at,
+    ))
+
+
+def wake() -> None:
+    """Sveglia il sender di questo processo (le altre istanze lo trovano al prossimo poll)."""
+    _get_wakeup().set()
+
+
+async def _claim_batch(db: AsyncSession) -> list[EmailOutbox]:
+    now = func.now()
+    expired = await db.execute(
+        update(EmailOutbox)
+        .where(EmailOutbox.status == "queued", EmailOutbox.expires_at < now)
+        .values(status="expired", body_plain=None, body_html=None)
+        .returning(EmailOutbox.id)
+    )
+    _stats["expired"] += len(expired.all())
+    claimable = (
+        select(EmailOutbox.id)
+        .where(or_(
+            and_(EmailOutbox.status == "queued", EmailOutbox.available_at <= now),
+            and_(EmailOutbox.status == "sending", EmailOutbox.locked_until < now),
+        ))
+        .order_by(EmailOutbox.available_at)
+        .limit(settings.email_batch_size)
+        .with_for_update(skip_locked=True)
+    )
+    r = await db.execute(
+        update(EmailOutbox)
+        .where(EmailOutbox.id.in_(claimable))
+        .values(
+            status="sending",
+            attempts=EmailOutbox.attempts + 1,
+            locked_until=now + timedelta(seconds=_LOCK_SECONDS),
+        )
+        .returning(EmailOutbox)
+        .execution_options(synchronize_session=False)
+    )
+    batch = list(r.scalars().all())
+    await db.commit()
+    return batch
+
+
+def _is_permanent(error: Exception) -> bool:
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return True
+    return isinstance(error, smtplib.SMTPResponseException) and 500 <= error.smtp_code < 600
+
+
+def _send_batch(messages: list[tuple[str, str, Optional[str], Optional[str]]]) -> list[Optional[Exception]]:
+    """Nel thread SMTP: invia i messaggi in ordine sulla connessione persistente, un esito per messaggio."""
+    results: list[Optional[Exception]] = []
+    for to_email, subject, body_plain, body_html in messages:
+        try:
+            _connection.send(to_email, subject, body_plain, body_html)
+            results.append(None)
+        except Exception as e:
+            results.append(e)
+    return results
+
+
+def _backoff_seconds(attempts: int) -> float:
+    return min(settings.email_retry_max_seconds, settings.email_retry_base_seconds * 2 ** max(0, attempts - 1))
+
+
+async def _record_results(batch: list[EmailOutbox], results: list[Optional[Exception]]) -> None:
+    sent_ids = [m.id for m, error in zip(batch, results) if error is None]
+    async with AsyncSessionLocal() as db:
+        if sent_ids:
+            await db.execute(
+                update(EmailOutbox)
+                .where(EmailOutbox.id.in_(sent_ids))
+                .values(status="sent", sent_at=func.now(), locked_until=None, body_plain=None, body_html=None)
+            )
+            _stats["sent"] += len(sent_ids)
+        for message, error in zip(batch, results):
+            if error is None:
+                continue
+            last_error = f"{type(error).__name__}: {error}"[:1000]
+            if _is_permanent(error) or message.attempts >= settings.email_max_attempts:
+                logger.error(f"Email {message.id} to {message.to_email} dead after {message.attempts} attempts: {last_error}")
+                values = {"status": "dead", "body_plain": None, "body_html": None}
+                _stats["dead"] += 1
+            else:
+                delay = _backoff_seconds(message.attempts)
+                logger.warning(f"Email {message.id} attempt {message.attempts} failed, retry in {delay:.0f}s: {last_error}")
+                values = {"status": "queued", "available_at": func.now() + timedelta(seconds=delay)}
+                _stats["retried"] += 1
+            await db.execute(
+                update(EmailOutbox)
+                .where(EmailOutbox.id == message.id)
+                .values(last_error=last_error, locked_until=None, **values)
+            )
+        await db.commit()
+
+
+async def _purge_finished() -> None:
+    """Elimina le righe sent/expired più vecchie di email_retention_hours (le dead restano per analisi)."""
+    async with AsyncSessionLocal() as db:
+        await db.execute(
+            delete(EmailOutbox).where(
+                EmailOutbox.status.in_(("sent", "expired")),
+                EmailOutbox.created_at < func.now() - timedelta(hours=settings.email_retention_hours),
+            )
+        )
+        await db.commit()
+
+
+async def _run() -> None:
+    loop = asyncio.get_running_loop()
+    wakeup = _get_wakeup()
+    last_purge = 0.0
+    while True:
+        try:
+            async with AsyncSessionLocal() as db:
+                batch = await _claim_batch(db)
+            if batch:
+                results = await loop.run_in_executor(
+                    _executor,
+                    _send_batch,
+                    [(m.to_email, m.subject, m.body_plain, m.body_html) for m in batch],
+                )
+                await _record_results(batch, results)
+                _stats["batches"] += 1
+                continue
+            await loop.run_in_executor(_executor, _connection.close_if_idle, settings.smtp_idle_seconds)
+            if loop.time() - last_purge > 3600:
+                last_purge = loop.time()
+                await _purge_finished()
+            wakeup.clear()
+            try:
+                await asyncio.wait_for(wakeup.wait(), timeout=settings.email_poll_interval_seconds)
+            except asyncio.TimeoutError:
+                pass
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # DB non raggiungibile...: i messaggi reclamati tornano disponibili dopo _LOCK_SECONDS
+            logger.exception("Email outbox: errore nel ciclo di invio")
+            await asyncio.sleep(settings.email_poll_interval_seconds)
+
+
+def start() -> None:
+    """Avvia il sender in background (chiamato nel lifespan). Sempre attivo: signup e resend-otp scrivono
+    solo nell'outbox, senza sender le email non partirebbero."""
+    global _task, _executor
+    if _task is None:
+        _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="smtp")
+        _task = asyncio.create_task(_run(), name="email-outbox-sender")
+
+
+async def stop() -> None:
+    global _task, _executor
+    if _task is not None:
+        _task.cancel()
+        await asyncio.gather(_task, return_exceptions=True)
+        _task = None
+    if _executor is not None:
+        await asyncio.get_running_loop().run_in_executor(_executor, _connection.close)
+        _executor.shutdown(wait=False)
+        _executor = None
+
+
+def get_stats() -> dict:
+    return {
+        "running": _task is not None,
+        "smtp_connections_opened": _connection.opened,
+        **_stats,
+    }
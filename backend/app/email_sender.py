@@ -1,5 +1,11 @@
-"""Invio email via SMTP Gmail (OTP verifica ProductShotAI)."""
+"""Invio email via SMTP Gmail (OTP verifica ProductShotAI).
+
+I messaggi non vengono inviati dalle richieste HTTP: finiscono nell'outbox (app/email_outbox.py), il cui
+sender usa una SMTPConnection persistente.
+"""
 import smtplib
+import time
+from typing import Optional
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 
@@ -43,20 +49,83 @@ This code expires in 15 minutes. If you didn't create an account, you can ignore
 """
 
 
-def send_verification_otp(to_email: str, otp: str) -> None:
-    """Invia email con OTP di verifica (SMTP Gmail). Solleva in caso di errore SMTP."""
-    if not settings.gmail_user or not settings.gmail_pass:
-        raise RuntimeError("GMAIL_USER and GMAIL_PASS must be set to send verification emails")
+def is_configured() -> bool:
+    return bool(settings.gmail_user)
+
+
+def verification_otp_message(otp: str) -> tuple[str, str, str]:
+    """(subject, testo, html) dell'email con l'OTP di verifica."""
+    return SUBJECT, BODY_PLAIN.replace("{otp}", otp), BODY_HTML.replace("{otp}", otp)
+
 
+def _build_message(to_email: str, subject: str, body_plain: Optional[str], body_html: Optional[str]) -> str:
     msg = MIMEMultipart("alternative")
-    msg["Subject"] = SUBJECT
+    msg["Subject"] = subject
     msg["From"] = settings.gmail_user
     msg["To"] = to_email
+    if body_plain:
+        msg.attach(MIMEText(body_plain, "plain"))
+    if body_html:
+        msg.attach(MIMEText(body_html, "html"))
+    return msg.as_string()
+
+
+class SMTPConnection:
+    """Connessione SMTP riusata tra un invio e l'altro (connessione, STARTTLS e login una volta sola).
+    Bloccante e non thread-safe: va usata da un solo thread (vedi app/email_outbox.py)."""
+
+    def __init__(self):
+        self._smtp: Optional[smtplib.SMTP] = None
+        self._last_used = 0.0
+        self.opened = 0
+
+    def _connect(self) -> smtplib.SMTP:
+        smtp = smtplib.SMTP(settings.smtp_host, settings.smtp_port, timeout=settings.smtp_timeout_seconds)
+        try:
+            if settings.smtp_starttls:
+                smtp.starttls()
+            if settings.gmail_pass:
+                smtp.login(settings.gmail_user, settings.gmail_pass)
+        except Exception:
+            smtp.close()
+            raise
+        self.opened += 1
+        return smtp
+
+    def send(self, to_email: str, subject: str, body_plain: Optional[str], body_html: Optional[str]) -> None:
+        """Invia un messaggio. Solleva in caso di errore SMTP; se il server ha chiuso una connessione
+        rimasta aperta si riconnette una volta."""
+        if not is_configured():
+            raise RuntimeError("GMAIL_USER must be set to send emails")
+        msg = _build_message(to_email, subject, body_plain, body_html)
+        reused = self._smtp is not None
+        while True:
+            if self._smtp is None:
+                self._smtp = self._connect()
+            try:
+                self._smtp.sendmail(settings.gmail_user, to_email, msg)
+                self._last_used = time.monotonic()
+                return
+            except smtplib.SMTPServerDisconnected:
+                self.close()
+                if not reused:
+                    raise
+                reused = False
+            except (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused):
+                raise  # risposta del server: la connessione resta utilizzabile
+            except Exception:
+                self.close()
+                raise
 
-    msg.attach(MIMEText(BODY_PLAIN.replace("{otp}", otp), "plain"))
-    msg.attach(MIMEText(BODY_HTML.replace("{otp}", otp), "html"))
+    def close_if_idle(self, idle_seconds: float) -> None:
+        if self._smtp is not None and time.monotonic() - self._last_used > idle_seconds:
+            self.close()
 
-    with smtplib.SMTP("smtp.gmail.com", 587) as smtp:
-        smtp.starttls()
-        smtp.login(settings.gmail_user, settings.gmail_pass)
-        smtp.sendmail(settings.gmail_user, to_email, msg.as_string())
+    def close(self) -> None:
+        if self._smtp is None:
+            return
+        smtp, self._smtp = self._smtp, None
+        try:
+            smtp.quit()
+        except Exception:
+            smtp.close()
@@ -0,0 +1,144 @@
+"""
+Notifiche di cambio stato delle generation (pub/sub in processo).
+
+Chi aspetta una generation (long-poll, SSE) si iscrive con subscribe() e viene svegliato da publish()
+quando il webhook/la coda/il reconciler la completano o la segnano failed. Il payload è solo l'id:
+chi viene svegliato rilegge la riga, quindi una notifica persa o duplicata non fa danni.
+
+events_backend="postgres": publish() fa NOTIFY e ogni processo ascolta il canale con LISTEN su una
+connessione dedicata, così funziona anche con più worker/istanze (non con pgbouncer in transaction mode).
+events_backend="memory": solo in processo (un solo worker).
+"""
+import asyncio
+import logging
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.config import settings
+from app.database import engine
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = "generation_events_photoshotai"
+
+_waiters: dict[str, set[asyncio.Event]] = {}
+_listener_task: Optional[asyncio.Task] = None
+_stats = {
+    "published": 0,
+    "delivered": 0,
+    "listener_connected": False,
+}
+
+
+def _use_postgres() -> bool:
+    return settings.events_backend == "postgres"
+
+
+def add_waiter(generation_id: str) -> asyncio.Event:
+    """Come subscribe(), per chi non può usare un blocco with (es. stream SSE): chiamare remove_waiter alla fine."""
+    event = asyncio.Event()
+    _waiters.setdefault(generation_id, set()).add(event)
+    return event
+
+
+def remove_waiter(generation_id: str, event: asyncio.Event) -> None:
+    """Idempotente: si può chiamare più volte per lo stesso evento."""
+    waiters = _waiters.get(generation_id)
+    if waiters is not None:
+        waiters.discard(event)
+        if not waiters:
+            del _waiters[generation_id]
+
+
+@contextmanager
+def subscribe(generation_id: str) -> Iterator[asyncio.Event]:
+    """Evento settato a ogni notifica per la generation. Iscriversi PRIMA di leggere lo stato,
+    altrimenti una notifica tra lettura e attesa andrebbe persa."""
+    event = add_waiter(generation_id)
+    try:
+        yield event
+    finally:
+        remove_waiter(generation_id, event)
+
+
+def _dispatch(generation_id: str) -> None:
+    for event in _waiters.get(generation_id, ()):
+        event.set()
+        _stats["delivered"] += 1
+
+
+async def publish(db: AsyncSession, *generation_ids: str) -> None:
+    """Notifica il cambio di stato (chiamare dopo il commit della generation)."""
+    if not generation_ids:
+        return
+    _stats["published"] += len(generation_ids)
+    if not _use_postgres():
+        for generation_id in generation_ids:
+            _dispatch(str(generation_id))
+        return
+    try:
+        for generation_id in generation_ids:
+            await db.execute(text("SELECT pg_notify(:channel, :payload)"), {"channel": CHANNEL, "payload": str(generation_id)})
+        await db.commit()
+    except Exception:
+        # Il listener non riceverà nulla: svegliamo almeno i client di questo processo
+        logger.exception("NOTIFY generation events failed")
+        for generation_id in generation_ids:
+            _dispatch(str(generation_id))
+
+
+def _on_notify(connection, pid, channel, payload) -> None:
+    _dispatch(payload)
+
+
+async def _listen() -> None:
+    """Connessione dedicata con LISTEN; in caso di errore si riconnette."""
+    while True:
+        try:
+            async with engine.connect() as conn:
+                raw = await conn.get_raw_connection()
+                pg = raw.driver_connection
+                await pg.add_listener(CHANNEL, _on_notify)
+                _stats["listener_connected"] = True
+                logger.info(f"LISTEN {CHANNEL} attivo")
+                try:
+                    while not pg.is_closed():
+                        await asyncio.sleep(settings.events_listener_check_seconds)
+                finally:
+                    _stats["listener_connected"] = False
+                    if not pg.is_closed():
+                        await pg.remove_listener(CHANNEL, _on_notify)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("LISTEN generation events: connessione persa, nuovo tentativo")
+        # Notifiche perse mentre il listener era giù: i client in attesa rileggono lo stato
+        for generation_id in list(_waiters):
+            _dispatch(generation_id)
+        await asyncio.sleep(settings.events_listener_check_seconds)
+
+
+def start() -> None:
+    """Avvia il listener Postgres (chiamato nel lifespan; no-op con events_backend=memory)."""
+    global _listener_task
+    if _use_postgres() and _listener_task is None:
+        _listener_task = asyncio.create_task(_listen(), name="generation-events-listener")
+
+
+async def stop() -> None:
+    global _listener_task
+    if _listener_task is not None:
+        _listener_task.cancel()
+        await asyncio.gather(_listener_task, return_exceptions=True)
+        _listener_task = None
+
+
+def get_stats() -> dict:
+    return {
+        "backend": settings.events_backend,
+        "subscribers": sum(len(w) for w in _waiters.values()),
+        **_stats,
+    }
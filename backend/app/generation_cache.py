@@ -0,0 +1,82 @@
+"""Cache dei risultati di generazione: stesso input, prompt e parametri → output già pronto,
+senza un nuovo task WaveSpeed (a pagamento).
+
+Chiave: hash di URL input + prompt normalizzato + resolution + aspect_ratio + tier (free/paid: gli
+output free hanno il watermark). La cache è attiva solo con storage content-addressed: lì l'URL
+dell'input è l'hash del contenuto, quindi lo stesso file ricaricato produce la stessa chiave. Con URL
+casuali (uuid) una nuova upload dello stesso file non darebbe mai un hit.
+
+Due livelli: LRU in memoria con TTL (per processo) e DB (generations_photoshotai.request_hash delle
+generation completate), condiviso tra worker e restart.
+"""
+import hashlib
+import json
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.config import settings
+from app.models import Generation
+from app.utils import TTLCache
+
+_memory = TTLCache(
+    maxsize=settings.generation_cache_max_entries,
+    ttl=settings.generation_cache_ttl_seconds,
+)
+
+
+def compute_request_hash(
+    image_url: str,
+    prompt: str,
+    resolution: str,
+    aspect_ratio: str,
+    is_free: bool,
+) -> str:
+    """Hash della richiesta normalizzata (spazi del prompt compattati, default dei parametri)."""
+    normalized = [
+        image_url.strip(),
+        " ".join(prompt.split()),
+        (resolution or "8k").lower(),
+        aspect_ratio or "1:1",
+        "free" if is_free else "paid",
+    ]
+    return hashlib.sha256(json.dumps(normalized).encode()).hexdigest()
+
+
+def is_enabled(is_free: bool) -> bool:
+    if not settings.storage_content_addressed:
+        return False
+    return settings.generation_cache_free_enabled if is_free else settings.generation_cache_paid_enabled
+
+
+async def lookup(db: AsyncSession, request_hash: str, is_free: bool) -> Optional[str]:
+    """output_image_url di una generation identica già completata, oppure None."""
+    if not is_enabled(is_free):
+        return None
+    cached = _memory.get(request_hash)
+    if cached:
+        return cached
+    since = datetime.now(timezone.utc) - timedelta(hours=settings.generation_cache_db_ttl_hours)
+    r = await db.execute(
+        select(Generation.output_image_url)
+        .where(
+            Generation.request_hash == request_hash,
+            Generation.status == "completed",
+            Generation.output_image_url.isnot(None),
+            Generation.completed_at >= since,
+        )
+        .order_by(Generation.completed_at.desc())
+        .limit(1)
+    )
+    output_url = r.scalar_one_or_none()
+    if output_url:
+        _memory.set(request_hash, output_url)
+    return output_url
+
+
+def remember(request_hash: Optional[str], output_url: str, is_free: bool) -> None:
+    """Registra nel livello in memoria l'output di una generation appena completata."""
+    if request_hash and is_enabled(is_free):
+        _memory.set(request_hash, output_url)
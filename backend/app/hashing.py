@@ -0,0 +1,116 @@
+"""
+bcrypt fuori dall'event loop: hash e verifica girano in un thread pool dimensionato
+(password_hash_workers), così un burst di login/signup non blocca webhook e polling.
+
+Coda limitata: oltre password_hash_max_queue operazioni in attesa si risponde subito 503
+(HashingQueueFull) invece di accumulare richieste che andrebbero comunque in timeout.
+Istogrammi di attesa in coda ed esecuzione in get_stats() (/api/metrics).
+"""
+import asyncio
+import bisect
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from app import auth
+from app.config import settings
+
+# Limiti superiori dei bucket (ms); l'ultimo bucket conta tutto ciò che li supera
+_BUCKETS_MS = (10, 25, 50, 100, 200, 400, 800, 1600)
+
+_executor: Optional[ThreadPoolExecutor] = None
+_semaphore: Optional[asyncio.Semaphore] = None
+_stats = {
+    "waiting": 0,
+    "in_flight": 0,
+    "completed": 0,
+    "rejected": 0,
+}
+_histograms = {
+    "wait_ms": [0] * (len(_BUCKETS_MS) + 1),
+    "run_ms": [0] * (len(_BUCKETS_MS) + 1),
+}
+
+
+class HashingQueueFull(Exception):
+    """Troppe operazioni bcrypt in attesa: il chiamante deve riprovare più tardi."""
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        # bcrypt rilascia il GIL: più thread lavorano davvero in parallelo
+        _executor = ThreadPoolExecutor(max_workers=max(1, settings.password_hash_workers), thread_name_prefix="bcrypt")
+    return _executor
+
+
+def _get_semaphore() -> asyncio.Semaphore:
+    global _semaphore
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(max(1, settings.password_hash_workers))
+    return _semaphore
+
+
+def shutdown_executor() -> None:
+    """Chiude il thread pool bcrypt (chiamato allo shutdown dell'app)."""
+    global _executor, _semaphore
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+    _semaphore = None
+
+
+def _observe(histogram: str, ms: float) -> None:
+    _histograms[histogram][bisect.bisect_left(_BUCKETS_MS, ms)] += 1
+
+
+def _format_histogram(counts: list[int]) -> dict:
+    labels = [f"le_{b}" for b in _BUCKETS_MS] + ["inf"]
+    return dict(zip(labels, counts))
+
+
+def get_stats() -> dict:
+    return {
+        "workers": settings.password_hash_workers,
+        "max_queue": settings.password_hash_max_queue,
+        "queue_depth": _stats["waiting"],
+        "in_flight": _stats["in_flight"],
+        "completed": _stats["completed"],
+        "rejected": _stats["rejected"],
+        "wait_ms": _format_histogram(_histograms["wait_ms"]),
+        "run_ms": _format_histogram(_histograms["run_ms"]),
+    }
+
+
+async def _run(fn, *args):
+    if _stats["waiting"] >= settings.password_hash_max_queue:
+        _stats["rejected"] += 1
+        raise HashingQueueFull()
+    loop = asyncio.get_running_loop()
+    queued_at = time.perf_counter()
+    _stats["waiting"] += 1
+    acquired = False
+    try:
+        async with _get_semaphore():
+            _stats["waiting"] -= 1
+            acquired = True
+            started_at = time.perf_counter()
+            _observe("wait_ms", (started_at - queued_at) * 1000)
+            _stats["in_flight"] += 1
+            try:
+                return await loop.run_in_executor(_get_executor(), fn, *args)
+            finally:
+                _stats["in_flight"] -= 1
+                _stats["completed"] += 1
+                _observe("run_ms", (time.perf_counter() - started_at) * 1000)
+    finally:
+        if not acquired:
+            _stats["waiting"] -= 1  # cancellato mentre era in coda
+
+
+async def hash_password(password: str) -> str:
+    return await _run(auth.get_password_hash, password)
+
+
+async def verify_password(plain_password: str, hashed_password: str) -> bool:
+    return await _run(auth.verify_password, plain_password, hashed_password)
@@ -0,0 +1,305 @@
+"""Coda persistente (Postgres) per l'elaborazione dei webhook WaveSpeed.
+
+Il webhook inserisce un job e risponde subito; un pool di worker (task asyncio avviati nel
+lifespan) li reclama con UPDATE ... FOR UPDATE SKIP LOCKED, quindi più processi possono condividere
+la stessa coda senza doppie elaborazioni. I job sopravvivono ai restart: un job "running" il cui
+visibility timeout è scaduto (worker morto) torna reclamabile. Errori: retry con backoff
+esponenziale, dopo job_max_attempts il job finisce in stato "dead" (dead letter).
+
+Scheduler a corsie (lane): ogni job è "paid" o "free" (dalla generation) e ogni lane ha i suoi
+worker, quindi un picco di job free (watermark) non ritarda i risultati 8k dei clienti paganti.
+La profondità della coda per lane è campionata periodicamente: se la lane free supera
+job_free_max_backlog, /api/generate-free risponde 503 (backpressure) invece di accodare altro lavoro.
+"""
+import asyncio
+import logging
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, Optional
+
+from sqlalchemy import case, delete, func, insert, or_, and_, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.config import settings
+from app.database import AsyncSessionLocal
+from app.models import Generation, WebhookJob
+
+logger = logging.getLogger(__name__)
+
+JobHandler = Callable[[str, str, Optional[str], Optional[str]], Awaitable[None]]
+DeadHandler = Callable[[str, str], Awaitable[None]]
+
+LANES = ("paid", "free")
+
+_wakeups: dict[str, asyncio.Event] = {}
+_workers: list[asyncio.Task] = []
+
+
+def _new_lane_stats() -> dict:
+    return {
+        "processed": 0,
+        "retried": 0,
+        "dead": 0,
+        "backlog": 0,  # job in coda (campionato ogni job_poll_interval_seconds)
+        "wait_ms": deque(maxlen=500),  # attesa in coda (creazione → primo claim), ultimi N job
+    }
+
+
+_stats = {lane: _new_lane_stats() for lane in LANES}
+
+
+def _get_wakeup(lane: str) -> asyncio.Event:
+    if lane not in _wakeups:
+        _wakeups[lane] = asyncio.Event()
+    return _wakeups[lane]
+
+
+def lane_workers(lane: str) -> int:
+    return max(1, settings.job_workers_paid if lane == "paid" else settings.job_workers_free)
+
+
+def lane_max_backlog(lane: str) -> int:
+    """0 = nessun limite"""
+    return settings.job_paid_max_backlog if lane == "paid" else settings.job_free_max_backlog
+
+
+def is_lane_saturated(lane: str) -> bool:
+    """Backpressure: True se la coda della lane ha superato il limite configurato."""
+    limit = lane_max_backlog(lane)
+    return limit > 0 and _stats[lane]["backlog"] >= limit
+
+
+def _lane_of_generation(wavespeed_id: str):
+    """Lane ricavata dalla generation nello stesso INSERT (free se is_free, altrimenti paid)."""
+    lane = (
+        select(case((Generation.is_free.is_(True), "free"), else_="paid"))
+        .where(Generation.wavespeed_request_id == wavespeed_id)
+        .limit(1)
+        .scalar_subquery()
+    )
+    return func.coalesce(lane, "paid")
+
+
+async def enqueue(
+    db: AsyncSession,
+    wavespeed_id: str,
+    status: str,
+    output_url: Optional[str],
+    error: Optional[str],
+) -> None:
+    """Salva il risultato WaveSpeed come job (commit incluso) e sveglia i worker locali."""
+    await enqueue_many(db, [(wavespeed_id, status, output_url, error)])
+
+
+async def enqueue_many(
+    db: AsyncSession,
+    results: list[tuple[str, str, Optional[str], Optional[str]]],
+) -> None:
+    """Come enqueue, per più risultati (wavespeed_id, status, output_url, error) in un solo INSERT."""
+    if not results:
+        return
+    r = await db.execute(
+        insert(WebhookJob)
+        .values([
+            {
+                "wavespeed_request_id": wavespeed_id,
+                "wavespeed_status": status,
+                "output_url": output_url,
+                "error": error,
+                "max_attempts": settings.job_max_attempts,
+                "lane": _lane_of_generation(wavespeed_id),
+            }
+            for wavespeed_id, status, output_url, error in results
+        ])
+        .returning(WebhookJob.lane)
+    )
+    lanes = set(r.scalars().all())
+    await db.commit()
+    for lane in lanes:
+        _get_wakeup(lane).set()
+
+
+async def _claim(db: AsyncSession, lane: str) -> Optional[WebhookJob]:
+    """Reclama il prossimo job disponibile della lane (queued e scaduto il backoff, oppure running con
+    visibility timeout scaduto). SKIP LOCKED: worker concorrenti non si bloccano a vicenda."""
+    now = func.now()
+    next_id = (
+        select(WebhookJob.id)
+        .where(WebhookJob.lane == lane)
+        .where(or_(
+            and_(WebhookJob.status == "queued", WebhookJob.available_at <= now),
+            and_(WebhookJob.status == "running", WebhookJob.locked_until < now),
+        ))
+        .order_by(WebhookJob.available_at)
+        .limit(1)
+        .with_for_update(skip_locked=True)
+        .scalar_subquery()
+    )
+    r = await db.execute(
+        update(WebhookJob)
+        .where(WebhookJob.id == next_id)
+        .values(
+            status="running",
+            attempts=WebhookJob.attempts + 1,
+            locked_until=now + timedelta(seconds=settings.job_visibility_timeout_seconds),
+            updated_at=now,
+        )
+        .returning(WebhookJob)
+    )
+    job = r.scalar_one_or_none()
+    await db.commit()
+    if job is not None and job.attempts == 1 and job.created_at is not None:
+        wait = datetime.now(timezone.utc) - job.created_at
+        _stats[lane]["wait_ms"].append(max(0.0, wait.total_seconds() * 1000))
+    return job
+
+
+def _backoff_seconds(attempts: int) -> float:
+    return min(settings.job_retry_max_seconds, settings.job_retry_base_seconds * 2 ** max(0, attempts - 1))
+
+
+async def _finish(job_id: str, **values) -> None:
+    async with AsyncSessionLocal() as db:
+        await db.execute(update(WebhookJob).where(WebhookJob.id == job_id).values(updated_at=func.now(), **values))
+        await db.commit()
+
+
+async def _run_job(job: WebhookJob, handler: JobHandler, on_dead: DeadHandler) -> None:
+    try:
+        # Il job non può durare più del visibility timeout, altrimenti un altro worker lo riprenderebbe
+        await asyncio.wait_for(
+            handler(job.wavespeed_request_id, job.wavespeed_status, job.output_url, job.error),
+            timeout=settings.job_visibility_timeout_seconds,
+        )
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+        if job.attempts >= job.max_attempts:
+            logger.error(f"Job {job.id} (wavespeed_id={job.wavespeed_request_id}) dead after {job.attempts} attempts: {error}")
+            await _finish(job.id, status="dead", last_error=error, locked_until=None, finished_at=func.now())
+            _stats[job.lane]["dead"] += 1
+            await on_dead(job.wavespeed_request_id, error)
+        else:
+            delay = _backoff_seconds(job.attempts)
+            logger.warning(f"Job {job.id} (wavespeed_id={job.wavespeed_request_id}) attempt {job.attempts} failed, retry in {delay:.0f}s: {error}")
+            await _finish(
+                job.id,
+                status="queued",
+                last_error=error,
+                locked_until=None,
+                available_at=func.now() + timedelta(seconds=delay),
+            )
+            _stats[job.lane]["retried"] += 1
+        return
+    await _finish(job.id, status="done", locked_until=None, finished_at=func.now())
+    _stats[job.lane]["processed"] += 1
+
+
+async def _purge_finished() -> None:
+    """Elimina i job completati più vecchi di job_retention_hours (i dead restano per analisi)."""
+    async with AsyncSessionLocal() as db:
+        await db.execute(
+            delete(WebhookJob).where(
+                WebhookJob.status == "done",
+                WebhookJob.finished_at < func.now() - timedelta(hours=settings.job_retention_hours),
+            )
+        )
+        await db.commit()
+
+
+async def _sample_backlog() -> None:
+    """Profondità della coda per lane (job queued), usata per backpressure e metriche."""
+    async with AsyncSessionLocal() as db:
+        r = await db.execute(
+            select(WebhookJob.lane, func.count())
+            .where(WebhookJob.status == "queued")
+            .group_by(WebhookJob.lane)
+        )
+        counts = dict(r.all())
+    for lane in LANES:
+        _stats[lane]["backlog"] = counts.get(lane, 0)
+
+
+async def _maintenance() -> None:
+    """Campionamento backlog ogni job_poll_interval_seconds, pulizia job vecchi ogni ora."""
+    loop = asyncio.get_running_loop()
+    last_purge = 0.0
+    while True:
+        try:
+            await _sample_backlog()
+            if loop.time() - last_purge > 3600:
+                last_purge = loop.time()
+                await _purge_finished()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Job queue maintenance failed")
+        await asyncio.sleep(settings.job_poll_interval_seconds)
+
+
+async def _worker(lane: str, index: int, handler: JobHandler, on_dead: DeadHandler) -> None:
+    wakeup = _get_wakeup(lane)
+    while True:
+        try:
+            async with AsyncSessionLocal() as db:
+                job = await _claim(db, lane)
+            if job is None:
+                wakeup.clear()
+                try:
+                    await asyncio.wait_for(wakeup.wait(), timeout=settings.job_poll_interval_seconds)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await _run_job(job, handler, on_dead)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # Errori di infrastruttura (DB non raggiungibile...): il job resta reclamabile, si riprova
+            logger.exception(f"Job worker {lane}-{index}: errore nel ciclo della coda")
+            await asyncio.sleep(settings.job_poll_interval_seconds)
+
+
+def start_workers(handler: JobHandler, on_dead: DeadHandler) -> None:
+    """Avvia i worker asyncio di ogni lane e il task di manutenzione (chiamato nel lifespan)."""
+    for lane in LANES:
+        for i in range(lane_workers(lane)):
+            _workers.append(asyncio.create_task(
+                _worker(lane, i, handler, on_dead), name=f"webhook-job-worker-{lane}-{i}"
+            ))
+    _workers.append(asyncio.create_task(_maintenance(), name="webhook-job-maintenance"))
+
+
+async def stop_workers() -> None:
+    """Ferma i worker: un job interrotto resta "running" e viene ripreso dopo il visibility timeout."""
+    for task in _workers:
+        task.cancel()
+    await asyncio.gather(*_workers, return_exceptions=True)
+    _workers.clear()
+
+
+def _percentile(values: list[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return round(ordered[index], 1)
+
+
+def get_stats() -> dict:
+    """Per lane: worker, backlog, contatori, tempo di attesa in coda (p50/p99/max, ultimi 500 job)."""
+    result = {}
+    for lane in LANES:
+        stats = _stats[lane]
+        waits = list(stats["wait_ms"])
+        result[lane] = {
+            "workers": lane_workers(lane),
+            "backlog": stats["backlog"],
+            "max_backlog": lane_max_backlog(lane),
+            "saturated": is_lane_saturated(lane),
+            "processed": stats["processed"],
+            "retried": stats["retried"],
+            "dead": stats["dead"],
+            "queue_wait_p50_ms": _percentile(waits, 50),
+            "queue_wait_p99_ms": _percentile(waits, 99),
+            "queue_wait_max_ms": round(max(waits), 1) if waits else 0.0,
+        }
+    return result
@@ -1,32 +1,68 @@
-import asyncio
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Depends, HTTPException, status, UploadFile, File, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
+from starlette.background import BackgroundTask
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, func
+from sqlalchemy import select, func, update, and_, or_, union_all
 from slowapi import Limiter, _rate_limit_exceeded_handler
 from slowapi.util import get_remote_address
 from slowapi.errors import RateLimitExceeded
+import asyncio
+import base64
+import hashlib
 import httpx
-from datetime import datetime, timedelta, timezone
+import json
+from datetime import datetime, timezone
 import logging
 import secrets
 import stripe
+import uuid
 
 from app.config import settings
-from app.database import get_db, AsyncSessionLocal
-from app import models, schemas, auth, storage, wavespeed, watermark, utils, credit_packs, email_sender
-from app.auth import get_current_user, get_current_user_optional
-from app.models import User, Generation, CreditTransaction
+from app.database import get_db, AsyncSessionLocal, engine, get_pool_stats, warm_up_pool
+from app import models, schemas, auth, storage, wavespeed, watermark, utils, credit_packs, email_sender, generation_cache, singleflight, jobs, reconciler, events, credits, hashing, otp, email_outbox
+from app.auth import get_current_user, get_current_user_fresh, get_current_user_id, get_current_user_id_optional
+from app.models import User, Generation, GenerationBatch, CreditTransaction
 from app.storage import get_storage_adapter
 
 # Setup logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Risorse condivise del processo: pool DB (warm-up), pool HTTP WaveSpeed, storage adapter, executor watermark,
+    worker della coda webhook, reconciler dei webhook persi, listener degli eventi generation. Chiuse allo shutdown."""
+    try:
+        await warm_up_pool()
+    except Exception as e:
+        logger.warning(f"DB pool warm-up failed: {e}")
+    await wavespeed.init_http_client()
+    await storage.init_storage()
+    jobs.start_workers(_process_wavespeed_webhook_task, _mark_webhook_generation_failed)
+    reconciler.start()
+    events.start()
+    email_outbox.start()
+    await _resume_pending_batches()
+    try:
+        yield
+    finally:
+        await email_outbox.stop()
+        await events.stop()
+        await reconciler.stop()
+        await jobs.stop_workers()
+        await wavespeed.close_http_client()
+        storage.close_storage()
+        watermark.shutdown_executor()
+        hashing.shutdown_executor()
+        await engine.dispose()
+
+
 # Initialize FastAPI app
-app = FastAPI(title="ProductShotAI API", version="1.0.0")
+app = FastAPI(title="ProductShotAI API", version="1.0.0", lifespan=lifespan)
 
 # CORS: allow_origins da CORS_ORIGINS env; allow_origin_regex come fallback per *.vercel.app
 # (su Render a volte l'env non è disponibile all'avvio o il cold start risponde prima di FastAPI)
@@ -44,11 +80,28 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Upload: rifiuta i body troppo grandi prima che vengano letti (margine per header multipart)
+app.add_middleware(
+    utils.BodySizeLimitMiddleware,
+    paths=("/api/upload",),
+    max_bytes=settings.max_upload_size_mb * 1024 * 1024 + 64 * 1024,
+)
+
 # Rate limiting
 limiter = Limiter(key_func=get_remote_address)
 app.state.limiter = limiter
 app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
 
+
+@app.exception_handler(hashing.HashingQueueFull)
+async def _hashing_queue_full_handler(request: Request, exc: hashing.HashingQueueFull):
+    """Troppi login/signup in coda per bcrypt: 503 subito invece di far crescere la coda."""
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"detail": "Too many authentication requests right now. Please try again shortly."},
+        headers={"Retry-After": "5"},
+    )
+
 # Mount static files for local storage
 if settings.storage_type == "local":
     import os
@@ -63,43 +116,61 @@ async def health():
     return {"status": "ok"}
 
 
-# Auth endpoints
-OTP_EXPIRY_MINUTES = 15
+def _require_metrics_token(request: Request) -> None:
+    """Metriche solo con METRICS_TOKEN (header Authorization: Bearer <token>); senza token configurato
+    l'endpoint non esiste (404), così non viene esposto per errore."""
+    if not settings.metrics_token:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not Found")
+    scheme, _, token = request.headers.get("authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not secrets.compare_digest(token.encode(), settings.metrics_token.encode()):
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid metrics token")
+
 
+@app.get("/api/metrics", dependencies=[Depends(_require_metrics_token)])
+async def metrics():
+    """Metriche di processo (code e tempi dei job in background, pool DB). Richiede METRICS_TOKEN."""
+    return {
+        "watermark": watermark.get_stats(),
+        "webhook_jobs": jobs.get_stats(),
+        "reconciler": reconciler.get_stats(),
+        "email_outbox": email_outbox.get_stats(),
+        "events": events.get_stats(),
+        "db_pool": get_pool_stats(),
+        "password_hashing": hashing.get_stats(),
+    }
 
+
+# Auth endpoints
 @app.post("/api/auth/signup", response_model=schemas.SignupResponse)
 async def signup(
     request: schemas.SignupRequest,
     db: AsyncSession = Depends(get_db)
 ):
-    """Sign up: crea utente, invia OTP via email, richiede verifica su /verifyEmail."""
+    """Sign up: crea utente, accoda l'email con l'OTP (outbox), richiede verifica su /verifyEmail."""
+    if not email_sender.is_configured():
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Could not send verification email. Check GMAIL_USER and GMAIL_PASS."
+        )
     result = await db.execute(select(User).where(User.email == request.email))
     if result.scalar_one_or_none():
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Email already registered")
 
-    otp = "".join(secrets.choice("0123456789") for _ in range(6))
-    otp_hash = auth.get_password_hash(otp)
-    expires_at = datetime.now(timezone.utc) + timedelta(minutes=OTP_EXPIRY_MINUTES)
-
     user = User(
+        id=models.generate_uuid(),
         email=request.email,
-        password_hash=auth.get_password_hash(request.password),
+        password_hash=await hashing.hash_password(request.password),
         email_verified=False,
-        verification_otp_hash=otp_hash,
-        verification_otp_expires_at=expires_at,
     )
+    otp_code = otp.issue(user)  # HMAC, niente bcrypt (app/otp.py)
     db.add(user)
+    # Utente ed email nella stessa transazione; l'invio SMTP avviene nel sender in background
+    email_outbox.enqueue(
+        db, request.email, *email_sender.verification_otp_message(otp_code),
+        expires_at=user.verification_otp_expires_at,
+    )
     await db.commit()
-    await db.refresh(user)
-
-    try:
-        email_sender.send_verification_otp(request.email, otp)
-    except Exception as e:
-        logger.exception("Failed to send verification email")
-        raise HTTPException(
-            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
-            detail="Could not send verification email. Check GMAIL_USER and GMAIL_PASS."
-        ) from e
+    email_outbox.wake()
 
     return schemas.SignupResponse(require_verification=True, email=request.email)
 
@@ -118,19 +189,18 @@ async def verify_otp(
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Email not found")
     if user.email_verified:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Email already verified")
-    if not user.verification_otp_hash or not user.verification_otp_expires_at:
-        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="No OTP pending. Request a new one.")
-    if user.verification_otp_expires_at < datetime.now(timezone.utc):
-        user.verification_otp_hash = None
-        user.verification_otp_expires_at = None
-        await db.commit()
-        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="OTP expired. Request a new one.")
-    if not auth.verify_password(body.otp, user.verification_otp_hash):
-        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid OTP")
+    outcome = await otp.verify(user, body.otp)
+    if outcome != otp.VALID:
+        await db.commit()  # tentativo contato / OTP invalidato
+        detail = {
+            otp.MISSING: "No OTP pending. Request a new one.",
+            otp.EXPIRED: "OTP expired. Request a new one.",
+            otp.TOO_MANY_ATTEMPTS: "Too many attempts. Request a new OTP.",
+        }.get(outcome, "Invalid OTP")
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=detail)
 
     user.email_verified = True
-    user.verification_otp_hash = None
-    user.verification_otp_expires_at = None
+    auth.invalidate_user(user.id)
     await db.commit()
 
     access_token = auth.create_access_token(data={"sub": user.id})
@@ -144,7 +214,7 @@ async def resend_otp(
     body: schemas.ResendOtpRequest,
     db: AsyncSession = Depends(get_db),
 ):
-    """Invia un nuovo OTP all'email (solo se utente non ancora verificato)."""
+    """Accoda un nuovo OTP per l'email (solo se utente non ancora verificato)."""
     result = await db.execute(select(User).where(User.email == body.email))
     user = result.scalar_one_or_none()
     if not user:
@@ -152,19 +222,19 @@ async def resend_otp(
     if user.email_verified:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Email already verified")
 
-    otp = "".join(secrets.choice("0123456789") for _ in range(6))
-    user.verification_otp_hash = auth.get_password_hash(otp)
-    user.verification_otp_expires_at = datetime.now(timezone.utc) + timedelta(minutes=OTP_EXPIRY_MINUTES)
-    await db.commit()
-
-    try:
-        email_sender.send_verification_otp(body.email, otp)
-    except Exception as e:
-        logger.exception("Failed to resend verification email")
+    if not email_sender.is_configured():
         raise HTTPException(
             status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
             detail="Could not send verification email."
-        ) from e
+        )
+
+    otp_code = otp.issue(user)
+    email_outbox.enqueue(
+        db, body.email, *email_sender.verification_otp_message(otp_code),
+        expires_at=user.verification_otp_expires_at,
+    )
+    await db.commit()
+    email_outbox.wake()
 
     return {"message": "OTP sent"}
 
@@ -178,7 +248,7 @@ async def login(
     result = await db.execute(select(User).where(User.email == request.email))
     user = result.scalar_one_or_none()
 
-    if not user or not auth.verify_password(request.password, user.password_hash):
+    if not user or not await hashing.verify_password(request.password, user.password_hash):
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Incorrect email or password")
 
     if not user.email_verified:
@@ -203,64 +273,141 @@ async def logout():
 # User endpoints
 @app.get("/api/user/me", response_model=schemas.UserResponse)
 async def get_current_user_info(
-    current_user: User = Depends(get_current_user)
+    current_user: User = Depends(get_current_user_fresh)
 ):
     """Get current user info"""
     return current_user
 
 
+# Solo le colonne della risposta: niente oggetti ORM da idratare
+_HISTORY_COLUMNS = (
+    Generation.id,
+    Generation.input_image_url,
+    Generation.output_image_url,
+    Generation.prompt,
+    Generation.resolution,
+    Generation.aspect_ratio,
+    Generation.is_free,
+    Generation.status,
+    Generation.created_at,
+    Generation.completed_at,
+)
+
+
+def _encode_history_cursor(created_at: datetime, generation_id: str) -> str:
+    raw = f"{created_at.isoformat()}|{generation_id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def _decode_history_cursor(cursor: str) -> tuple[datetime, str]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        created_at, generation_id = raw.split("|", 1)
+        return datetime.fromisoformat(created_at), str(uuid.UUID(generation_id))
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+
+
 @app.get("/api/user/generations", response_model=schemas.GenerationHistoryResponse)
 async def get_user_generations(
     page: int = 1,
     page_size: int = 20,
-    current_user: User = Depends(get_current_user),
+    cursor: str | None = None,
+    current_user_id: str = Depends(get_current_user_id),
     db: AsyncSession = Depends(get_db)
 ):
-    """Get user's generation history"""
-    offset = (page - 1) * page_size
-    
-    # Get total count
-    count_result = await db.execute(
-        select(func.count(Generation.id)).where(Generation.user_id == current_user.id)
+    """Get user's generation history.
+
+    Keyset pagination: passare next_cursor della risposta precedente come cursor (la query parte
+    dall'indice (user_id, created_at) invece di scartare le righe con OFFSET). page resta per i
+    client vecchi. total è il contatore mantenuto da trigger su users_photoshotai, niente count(*)."""
+    page_size = min(max(page_size, 1), settings.history_max_page_size)
+
+    query = (
+        select(*_HISTORY_COLUMNS)
+        .where(Generation.user_id == current_user_id)
+        .order_by(Generation.created_at.desc(), Generation.id.desc())
+        .limit(page_size + 1)
     )
-    total = count_result.scalar_one()
-    
-    # Get generations
-    result = await db.execute(
-        select(Generation)
-        .where(Generation.user_id == current_user.id)
-        .order_by(Generation.created_at.desc())
-        .offset(offset)
-        .limit(page_size)
-    )
-    generations = result.scalars().all()
-    
+    if cursor:
+        created_at, generation_id = _decode_history_cursor(cursor)
+        # created_at <= X è il range sull'indice; l'id separa solo le righe con lo stesso created_at
+        query = query.where(
+            Generation.created_at <= created_at,
+            or_(Generation.created_at < created_at, and_(Generation.created_at == created_at, Generation.id < generation_id)),
+        )
+    elif page > 1:
+        query = query.offset((page - 1) * page_size)
+
+    rows = (await db.execute(query)).all()
+    total = (await db.execute(select(User.generation_count).where(User.id == current_user_id))).scalar_one_or_none() or 0
+
+    next_cursor = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        next_cursor = _encode_history_cursor(rows[-1].created_at, rows[-1].id)
+
     return {
-        "items": generations,
+        "items": rows,
         "total": total,
         "page": page,
-        "page_size": page_size
+        "page_size": page_size,
+        "next_cursor": next_cursor,
     }
 
 
-@app.get("/api/generations/{generation_id}")
-async def get_generation_status(
+_GENERATION_PENDING = ("pending", "processing")
+
+
+# Poll dello stato: solo le colonne che servono (niente prompt/URL di input), per id (PK); le generation
+# in corso sono anche nell'indice parziale idx_generations_status_poll_photoshotai
+_STATUS_COLUMNS = (
+    Generation.id,
+    Generation.status,
+    Generation.output_image_url,
+    Generation.error_message,
+    Generation.user_id,
+    Generation.is_free,
+    Generation.device_id,
+)
+
+
+async def _load_generation_status(db: AsyncSession, generation_id: str):
+    """Riga (solo colonne di stato) della generation, e rilascio della connessione (commit).
+    Prima il ramo sull'indice parziale (generation in corso, index-only scan); il ramo per PK viene
+    eseguito solo se il primo non trova nulla (UNION ALL + LIMIT 1: un solo round trip)."""
+    in_progress = select(*_STATUS_COLUMNS).where(
+        Generation.id == generation_id, Generation.status.in_(_GENERATION_PENDING)
+    )
+    finished = select(*_STATUS_COLUMNS).where(
+        Generation.id == generation_id, Generation.status.not_in(_GENERATION_PENDING)
+    )
+    r = await db.execute(union_all(in_progress, finished).limit(1))
+    row = r.first()
+    await db.commit()  # rilascia la connessione durante l'attesa
+    return row
+
+
+async def _get_visible_generation(
+    db: AsyncSession,
     generation_id: str,
-    device_id: str | None = None,
-    current_user: User | None = Depends(get_current_user_optional),
-    db: AsyncSession = Depends(get_db),
+    device_id: str | None,
+    current_user_id: str | None,
 ):
-    """Stato di una generation (per polling dopo 202). Paid: auth. Free: device_id in query."""
-    r = await db.execute(select(Generation).where(Generation.id == generation_id))
-    gen = r.scalar_one_or_none()
+    """Stato della generation visibile al chiamante (paid: proprietario; free: device_id), altrimenti 404."""
+    gen = await _load_generation_status(db, generation_id)
     if not gen:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Generation not found")
-    if current_user:
-        if gen.user_id != current_user.id:
+    if current_user_id:
+        if gen.user_id != current_user_id:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Generation not found")
     else:
         if not gen.is_free or not device_id or gen.device_id != device_id:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Generation not found")
+    return gen
+
+
+def _generation_status_payload(gen) -> dict:
     return {
         "id": str(gen.id),
         "status": gen.status,
@@ -269,6 +416,98 @@ async def get_generation_status(
     }
 
 
+def _generation_status_etag(gen) -> str:
+    digest = hashlib.blake2b(digest_size=8)
+    for value in (gen.id, gen.status, gen.output_image_url, gen.error_message):
+        digest.update(str(value).encode() + b"\0")
+    return f'"{digest.hexdigest()}"'
+
+
+def _etag_matches(request: Request, etag: str) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    return any(tag.strip().removeprefix("W/") in (etag, "*") for tag in if_none_match.split(","))
+
+
+@app.get("/api/generations/{generation_id}")
+async def get_generation_status(
+    request: Request,
+    generation_id: str,
+    device_id: str | None = None,
+    wait: float = 0,
+    current_user_id: str | None = Depends(get_current_user_id_optional),
+    db: AsyncSession = Depends(get_db),
+):
+    """Stato di una generation (per polling dopo 202). Paid: auth. Free: device_id in query.
+    Long-poll: con wait=N (secondi) se è ancora in corso risponde appena cambia stato o dopo N secondi.
+    ETag: con If-None-Match uguale allo stato attuale risponde 304 senza body."""
+    wait = min(max(wait, 0), settings.generation_wait_max_seconds)
+    with events.subscribe(generation_id) as changed:
+        gen = await _get_visible_generation(db, generation_id, device_id, current_user_id)
+        if wait and gen.status in _GENERATION_PENDING:
+            try:
+                await asyncio.wait_for(changed.wait(), timeout=wait)
+                gen = await _get_visible_generation(db, generation_id, device_id, current_user_id)
+            except asyncio.TimeoutError:
+                pass
+    # no-cache: il browser può tenere la risposta ma deve rivalidarla (If-None-Match) a ogni poll
+    headers = {"ETag": _generation_status_etag(gen), "Cache-Control": "private, no-cache"}
+    if _etag_matches(request, headers["ETag"]):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return JSONResponse(_generation_status_payload(gen), headers=headers)
+
+
+@app.get("/api/generations/{generation_id}/events")
+async def generation_events(
+    generation_id: str,
+    device_id: str | None = None,
+    current_user_id: str | None = Depends(get_current_user_id_optional),
+    db: AsyncSession = Depends(get_db),
+):
+    """Server-Sent Events: un evento "status" subito e uno a ogni cambio di stato, poi chiude quando la
+    generation è completed/failed (o dopo generation_sse_max_seconds). Stessi controlli di accesso del GET."""
+    # Iscrizione prima della prima lettura (come nel GET): una notifica tra lettura e stream non va persa
+    changed = events.add_waiter(generation_id)
+    try:
+        gen = await _get_visible_generation(db, generation_id, device_id, current_user_id)
+    except BaseException:
+        events.remove_waiter(generation_id, changed)
+        raise
+
+    async def stream():
+        nonlocal gen
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + settings.generation_sse_max_seconds
+        try:
+            last = None
+            while True:
+                payload = _generation_status_payload(gen)
+                if payload != last:
+                    yield f"event: status\ndata: {json.dumps(payload)}\n\n"
+                    last = payload
+                if gen.status not in _GENERATION_PENDING or loop.time() >= deadline:
+                    return
+                changed.clear()
+                try:
+                    timeout = min(settings.generation_sse_keepalive_seconds, deadline - loop.time())
+                    await asyncio.wait_for(changed.wait(), timeout=max(timeout, 0))
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                # Rilettura anche dopo il keepalive: una notifica persa (listener giù) non blocca lo stream
+                gen = await _load_generation_status(db, generation_id) or gen
+        finally:
+            events.remove_waiter(generation_id, changed)
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        # Anche se lo stream non parte mai (client già disconnesso)
+        background=BackgroundTask(events.remove_waiter, generation_id, changed),
+    )
+
+
 # Upload endpoint
 @app.post("/api/upload", response_model=schemas.UploadResponse)
 @limiter.limit("10/minute")
@@ -277,32 +516,41 @@ async def upload_image(
     file: UploadFile = File(...),
     db: AsyncSession = Depends(get_db)
 ):
-    """Upload product image"""
-    # Validate file type
+    """Upload product image. Lettura a chunk: limite di dimensione applicato durante la lettura,
+    tipo rilevato dai magic bytes del primo chunk, chunk inoltrati direttamente allo storage."""
     allowed = settings.get_allowed_image_types_list()
-    if file.content_type not in allowed:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail=f"Invalid file type. Allowed: {', '.join(allowed)}"
-        )
-    
-    # Read file content
-    content = await file.read()
-    
-    # Validate file size (max 10MB)
     max_size = settings.max_upload_size_mb * 1024 * 1024
-    if len(content) > max_size:
+    chunk_size = settings.upload_chunk_size_kb * 1024
+
+    # Validate file type (magic bytes, non il Content-Type dichiarato)
+    first_chunk = await file.read(chunk_size)
+    content_type = utils.detect_image_type(first_chunk)
+    if content_type not in allowed:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
-            detail=f"File too large. Maximum size: {settings.max_upload_size_mb}MB"
+            detail=f"Invalid file type. Allowed: {', '.join(allowed)}"
         )
-    
+
+    async def _chunks():
+        size = 0
+        chunk = first_chunk
+        while chunk:
+            # Validate file size (max 10MB) mentre si legge
+            size += len(chunk)
+            if size > max_size:
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail=f"File too large. Maximum size: {settings.max_upload_size_mb}MB"
+                )
+            yield chunk
+            chunk = await file.read(chunk_size)
+
     # Determine file extension
-    file_extension = ".jpg" if file.content_type == "image/jpeg" else ".png"
+    file_extension = ".jpg" if content_type == "image/jpeg" else ".png"
     
-    # Upload to storage
+    # Upload to storage (un upload interrotto non lascia file parziali)
     storage_adapter = get_storage_adapter()
-    image_url = await storage_adapter.upload_file(content, file_extension)
+    image_url = await storage_adapter.upload_stream(_chunks(), file_extension)
     
     logger.info(f"Image uploaded: {image_url}")
     return {"image_url": image_url}
@@ -330,6 +578,51 @@ def _get_wavespeed_webhook_url() -> str:
     return f"{base}/api/webhooks/wavespeed"
 
 
+async def _apply_completion_effects(db: AsyncSession, gen: Generation) -> None:
+    """Effetti di una generation completata: conteggio free del device/IP, oppure addebito del credito
+    (per le generation prenotate quota/credito restano solo spesi, vedi app/credits.py)."""
+    if gen.is_free and gen.device_id and gen.ip_address:
+        # Quota prenotata alla richiesta: solo saldo. Generation senza prenotazione: conteggio ora.
+        if await credits.settle(db, gen.id):
+            await db.commit()
+        else:
+            try:
+                await utils.increment_free_generation_count(db, gen.device_id, gen.ip_address)
+            except Exception as inc:
+                logger.warning(f"increment_free_generation_count failed (gen {gen.id}): {inc}")
+
+    if not gen.is_free and gen.user_id:
+        # Prepagata: il credito prenotato resta speso. Generation senza prenotazione (create prima
+        # del ledger): addebito atomico ora.
+        if not await credits.settle(db, gen.id):
+            await credits.charge(db, gen.user_id, 1, reference_id=gen.id)
+        await db.commit()
+
+
+async def _complete_from_cache(db: AsyncSession, generation: Generation, output_url: str) -> JSONResponse:
+    """Cache hit: la generation è completata subito con l'output esistente (nessun task WaveSpeed).
+    Conteggio free / addebito credito come per una generation completata dal webhook."""
+    generation.status = "completed"
+    generation.output_image_url = output_url
+    generation.completed_at = datetime.now(timezone.utc)
+    await db.commit()
+    await _apply_completion_effects(db, generation)
+    logger.info(f"Generation {generation.id} completed from result cache (request_hash={generation.request_hash})")
+    return JSONResponse(
+        content={"generation_id": str(generation.id), "status": "completed", "output_image_url": output_url, "error_message": None},
+        status_code=200,
+    )
+
+
+def _in_flight_response(generation: Generation) -> JSONResponse:
+    """Richiesta duplicata: stesso generation_id della richiesta identica già in corso."""
+    logger.info(f"Duplicate generation request coalesced into {generation.id} (request_hash={generation.request_hash})")
+    return JSONResponse(
+        content={"generation_id": str(generation.id), "status": "processing", "output_image_url": None, "error_message": None},
+        status_code=202,
+    )
+
+
 async def _process_wavespeed_webhook_task(
     wavespeed_id: str,
     status: str,
@@ -337,79 +630,74 @@ async def _process_wavespeed_webhook_task(
     error: str | None,
 ) -> None:
     """
-    Elabora il risultato del webhook WaveSpeed in background. Scorre output, watermark (free),
-    upload, aggiorna Generation. Idempotente: se già completed/failed non fa nulla.
+    Elabora il risultato del webhook WaveSpeed (handler della coda app/jobs.py). Scarica output,
+    watermark (free), upload, aggiorna Generation. Idempotente: se già completed/failed non fa nulla.
+    Le eccezioni risalgono alla coda, che ritenta con backoff; dopo l'ultimo tentativo
+    _mark_webhook_generation_failed segna la generation come failed.
     """
     async with AsyncSessionLocal() as db:
-        try:
-            r = await db.execute(select(Generation).where(Generation.wavespeed_request_id == wavespeed_id))
-            gen = r.scalar_one_or_none()
-            if not gen:
-                logger.warning(f"Webhook WaveSpeed: generation non trovata per wavespeed_id={wavespeed_id}")
-                return
-            if gen.status in ("completed", "failed"):
-                return  # idempotenza
+        r = await db.execute(select(Generation).where(Generation.wavespeed_request_id == wavespeed_id))
+        gen = r.scalar_one_or_none()
+        if not gen:
+            logger.warning(f"Webhook WaveSpeed: generation non trovata per wavespeed_id={wavespeed_id}")
+            return
+        if gen.status in ("completed", "failed"):
+            return  # idempotenza
+
+        if status == "failed":
+            gen.status = "failed"
+            gen.error_message = error or "WaveSpeed task failed"
+            gen.completed_at = datetime.now(timezone.utc)
+            await credits.refund(db, gen.id)
+            await db.commit()
+            await events.publish(db, gen.id)
+            logger.info(f"Webhook WaveSpeed: generation {gen.id} failed: {error}")
+            return
+
+        if status != "completed" or not output_url:
+            return
+
+        # completed: download, (watermark se free), upload, aggiorna.
+        # Paid: streaming chunk per chunk verso lo storage (memoria costante anche per 8k).
+        # Free: serve l'immagine intera per il watermark (4k).
+        storage_adapter = get_storage_adapter()
+        client = wavespeed.get_http_client()
+        async with client.stream("GET", output_url, timeout=httpx.Timeout(60.0)) as resp:
+            resp.raise_for_status()
+            if gen.is_free:
+                output_bytes = await resp.aread()
+            else:
+                chunk_size = settings.download_chunk_size_kb * 1024
+                final_url = await storage_adapter.upload_stream(resp.aiter_bytes(chunk_size), ".jpg")
 
-            if status == "failed":
-                gen.status = "failed"
-                gen.error_message = error or "WaveSpeed task failed"
-                gen.completed_at = datetime.now(timezone.utc)
-                await db.commit()
-                logger.info(f"Webhook WaveSpeed: generation {gen.id} failed: {error}")
-                return
+        if gen.is_free:
+            output_bytes = await watermark.apply_watermark(output_bytes)
+            final_url = await storage_adapter.upload_file(output_bytes, ".jpg")
 
-            if status != "completed" or not output_url:
-                return
+        gen.status = "completed"
+        gen.output_image_url = final_url
+        gen.completed_at = datetime.now(timezone.utc)
+        await db.commit()
+        generation_cache.remember(gen.request_hash, final_url, gen.is_free)
 
-            # completed: download, (watermark se free), upload, aggiorna
-            async with httpx.AsyncClient(timeout=httpx.Timeout(60.0)) as client:
-                resp = await client.get(output_url)
-                resp.raise_for_status()
-                output_bytes = resp.content
+        await _apply_completion_effects(db, gen)
+        await events.publish(db, gen.id)
 
-            if gen.is_free:
-                output_bytes = await watermark.apply_watermark(output_bytes)
+        logger.info(f"Webhook WaveSpeed: generation {gen.id} completed")
 
-            storage_adapter = get_storage_adapter()
-            final_url = await storage_adapter.upload_file(output_bytes, ".jpg")
 
-            gen.status = "completed"
-            gen.output_image_url = final_url
+async def _mark_webhook_generation_failed(wavespeed_id: str, error: str) -> None:
+    """Dead letter: tentativi esauriti per il job del webhook, la generation passa a failed."""
+    async with AsyncSessionLocal() as db:
+        r = await db.execute(select(Generation).where(Generation.wavespeed_request_id == wavespeed_id))
+        gen = r.scalar_one_or_none()
+        if gen and gen.status not in ("completed", "failed"):
+            gen.status = "failed"
+            gen.error_message = error
             gen.completed_at = datetime.now(timezone.utc)
+            await credits.refund(db, gen.id)
             await db.commit()
-
-            if gen.is_free and gen.device_id and gen.ip_address:
-                try:
-                    await utils.increment_free_generation_count(db, gen.device_id, gen.ip_address)
-                except Exception as inc:
-                    logger.warning(f"increment_free_generation_count failed (gen {gen.id}): {inc}")
-
-            if not gen.is_free and gen.user_id:
-                r2 = await db.execute(select(User).where(User.id == gen.user_id))
-                user = r2.scalar_one_or_none()
-                if user:
-                    user.credits_balance -= 1
-                    db.add(CreditTransaction(
-                        user_id=user.id,
-                        change_amount=-1,
-                        type="generation",
-                        reference_id=gen.id,
-                    ))
-                    await db.commit()
-
-            logger.info(f"Webhook WaveSpeed: generation {gen.id} completed")
-        except Exception as e:
-            logger.exception(f"Webhook WaveSpeed: errore elaborazione wavespeed_id={wavespeed_id}: {e}")
-            try:
-                r = await db.execute(select(Generation).where(Generation.wavespeed_request_id == wavespeed_id))
-                gen = r.scalar_one_or_none()
-                if gen:
-                    gen.status = "failed"
-                    gen.error_message = str(e)
-                    gen.completed_at = datetime.now(timezone.utc)
-                    await db.commit()
-            except Exception:
-                pass
+            await events.publish(db, gen.id)
 
 
 # Free generation: WaveSpeed con webhook. POST ritorna 202, frontend fa polling su GET /api/generations/{id}.
@@ -424,12 +712,34 @@ async def generate_free(
     ip_address = utils.get_client_ip(request)
     if not generate_request.device_id:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="device_id is required")
-    can_generate, _ = await utils.check_free_generation_limit(db, generate_request.device_id, ip_address)
-    if not can_generate:
+    if jobs.is_lane_saturated("free"):
+        # Backpressure: troppi risultati free ancora da elaborare, non accodarne altri
         raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail=f"Free generation limit reached ({settings.free_generations_per_month} per month). Please sign up and purchase credits for unlimited generations.",
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Free generation is busy right now. Please try again in a minute.",
+            headers={"Retry-After": "60"},
         )
+    limit_reached = HTTPException(
+        status_code=status.HTTP_403_FORBIDDEN,
+        detail=f"Free generation limit reached ({settings.free_generations_per_month} per month). Please sign up and purchase credits for unlimited generations.",
+    )
+    if utils.is_free_quota_exhausted(generate_request.device_id, ip_address):
+        raise limit_reached  # fast path, nessuna query
+    request_hash = generation_cache.compute_request_hash(
+        generate_request.image_url, generate_request.prompt, "4k", generate_request.aspect_ratio, is_free=True
+    )
+    # Singleflight: lock per device+richiesta fino al commit che crea la generation
+    await singleflight.lock(db, singleflight.owner_key(device_id=generate_request.device_id), request_hash)
+    in_flight = await singleflight.find_in_flight(db, request_hash, device_id=generate_request.device_id)
+    if in_flight:
+        await db.commit()
+        return _in_flight_response(in_flight)
+    cached_output = await generation_cache.lookup(db, request_hash, is_free=True)
+    # 503 prima di prenotare la quota se PUBLIC_BASE_URL manca
+    webhook_url = None if cached_output else _get_wavespeed_webhook_url()
+    if not await utils.reserve_free_generation(db, generate_request.device_id, ip_address):
+        await db.rollback()
+        raise limit_reached
     generation = Generation(
         device_id=generate_request.device_id,
         ip_address=ip_address,
@@ -439,14 +749,17 @@ async def generate_free(
         aspect_ratio=generate_request.aspect_ratio,
         is_free=True,
         status="pending",
+        request_hash=request_hash,
+        credits_reserved=1,  # una generation della quota mensile
     )
     db.add(generation)
-    await db.commit()
+    await db.commit()  # prenotazione quota e generation insieme
     await db.refresh(generation)
+    if cached_output:
+        return await _complete_from_cache(db, generation, cached_output)
     try:
         image_url = _ensure_absolute_image_url(generate_request.image_url)
         generation.status = "processing"
-        webhook_url = _get_wavespeed_webhook_url()
         ws = wavespeed.get_wavespeed_client()
         task_result = await ws.create_edit_task(
             image_url=image_url,
@@ -470,6 +783,7 @@ async def generate_free(
         generation.status = "failed"
         generation.error_message = str(e)
         generation.completed_at = datetime.utcnow()
+        await credits.refund(db, generation.id)
         await db.commit()
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Generation failed: {str(e)}")
 
@@ -480,18 +794,38 @@ async def generate_free(
 async def generate_paid(
     request: Request,
     generate_request: schemas.GenerateRequest,
-    current_user: User = Depends(get_current_user),
+    current_user_id: str = Depends(get_current_user_id),
     db: AsyncSession = Depends(get_db)
 ):
-    """Generate image for paid users (no watermark). Crea task WaveSpeed con webhook, ritorna 202."""
-    if current_user.credits_balance < 1:
+    """Generate image for paid users (no watermark). Crea task WaveSpeed con webhook, ritorna 202.
+    Il credito è prenotato in modo atomico alla creazione, saldato al completamento, rimborsato se fallisce."""
+    ip_address = utils.get_client_ip(request)
+    request_hash = generation_cache.compute_request_hash(
+        generate_request.image_url,
+        generate_request.prompt,
+        generate_request.resolution,
+        generate_request.aspect_ratio,
+        is_free=False,
+    )
+    # Singleflight: lock per utente+richiesta fino al commit che crea la generation
+    await singleflight.lock(db, singleflight.owner_key(user_id=current_user_id), request_hash)
+    in_flight = await singleflight.find_in_flight(db, request_hash, user_id=current_user_id)
+    if in_flight:
+        await db.commit()
+        return _in_flight_response(in_flight)
+    cached_output = await generation_cache.lookup(db, request_hash, is_free=False)
+    # 503 prima di prenotare il credito se PUBLIC_BASE_URL manca
+    webhook_url = None if cached_output else _get_wavespeed_webhook_url()
+    generation_id = models.generate_uuid()
+    if not await credits.reserve(db, current_user_id, 1, reference_id=generation_id):
+        await db.rollback()
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="Insufficient credits. Please purchase credits to continue."
         )
-    ip_address = utils.get_client_ip(request)
     generation = Generation(
-        user_id=current_user.id,
+        id=generation_id,
+        user_id=current_user_id,
         device_id=generate_request.device_id,
         ip_address=ip_address,
         input_image_url=generate_request.image_url,
@@ -499,15 +833,18 @@ async def generate_paid(
         resolution=generate_request.resolution or "8k",
         aspect_ratio=generate_request.aspect_ratio,
         is_free=False,
-        status="pending"
+        status="pending",
+        request_hash=request_hash,
+        credits_reserved=1,
     )
     db.add(generation)
-    await db.commit()
+    await db.commit()  # prenotazione e generation insieme
     await db.refresh(generation)
+    if cached_output:
+        return await _complete_from_cache(db, generation, cached_output)
     try:
         image_url = _ensure_absolute_image_url(generate_request.image_url)
         generation.status = "processing"
-        webhook_url = _get_wavespeed_webhook_url()
         ws = wavespeed.get_wavespeed_client()
         task_result = await ws.create_edit_task(
             image_url=image_url,
@@ -531,10 +868,248 @@ async def generate_paid(
         generation.status = "failed"
         generation.error_message = str(e)
         generation.completed_at = datetime.utcnow()
+        await credits.refund(db, generation.id)
         await db.commit()
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Generation failed: {str(e)}")
 
 
+_batch_semaphore: asyncio.Semaphore | None = None
+_batch_tasks: set[asyncio.Task] = set()
+
+
+def _get_batch_semaphore() -> asyncio.Semaphore:
+    """Limite globale di task WaveSpeed creati in parallelo dai batch (condiviso tra tutti i batch)."""
+    global _batch_semaphore
+    if _batch_semaphore is None:
+        _batch_semaphore = asyncio.Semaphore(max(1, settings.batch_concurrency))
+    return _batch_semaphore
+
+
+async def _fail_batch_generation(db: AsyncSession, generation_id: str, error: str) -> None:
+    await db.execute(
+        update(Generation)
+        .where(Generation.id == generation_id)
+        .values(status="failed", error_message=error, completed_at=func.now())
+        .execution_options(synchronize_session=False)
+    )
+    await credits.refund(db, generation_id)
+    await db.commit()
+    await events.publish(db, generation_id)
+
+
+async def _submit_batch_generation(generation_id: str, webhook_url: str) -> None:
+    """Un item del batch: cache risultati oppure task WaveSpeed. Il claim pending → processing è un
+    UPDATE condizionale, quindi un item non viene mai inviato due volte (anche riprendendo dopo un restart).
+    Un item rimasto processing senza wavespeed_request_id (processo morto durante l'invio) non viene
+    reinviato: il reconciler lo segna failed e lo rimborsa dopo reconciler_max_age_minutes."""
+    async with _get_batch_semaphore():
+        async with AsyncSessionLocal() as db:
+            r = await db.execute(
+                update(Generation)
+                .where(Generation.id == generation_id, Generation.status == "pending")
+                .values(status="processing")
+                .returning(Generation)
+                .execution_options(synchronize_session=False)
+            )
+            generation = r.scalar_one_or_none()
+            await db.commit()
+            if generation is None:
+                return
+            try:
+                cached_output = await generation_cache.lookup(db, generation.request_hash, is_free=False)
+                if cached_output:
+                    await _complete_from_cache(db, generation, cached_output)
+                    await events.publish(db, generation.id)
+                    return
+                ws = wavespeed.get_wavespeed_client()
+                task_result = await ws.create_edit_task(
+                    image_url=_ensure_absolute_image_url(generation.input_image_url),
+                    prompt=generation.prompt,
+                    resolution=generation.resolution or "8k",
+                    aspect_ratio=generation.aspect_ratio or "1:1",
+                    webhook_url=webhook_url,
+                )
+                # Condizionale: se nel frattempo il reconciler l'ha scaduta (e rimborsata) resta failed
+                r = await db.execute(
+                    update(Generation)
+                    .where(Generation.id == generation_id, Generation.status == "processing")
+                    .values(wavespeed_request_id=task_result.get("id"))
+                    .execution_options(synchronize_session=False)
+                )
+                await db.commit()
+                if r.rowcount == 0:
+                    logger.warning(f"Batch {generation.batch_id}: generation {generation_id} scaduta durante l'invio, task WaveSpeed ignorato")
+            except Exception as e:
+                logger.warning(f"Batch {generation.batch_id}: generation {generation_id} failed: {e}")
+                await db.rollback()
+                await _fail_batch_generation(db, generation_id, f"Generation failed: {e}")
+
+
+async def _run_batch(batch_id: str) -> None:
+    """Fan-out di un batch: invia gli item pending con concorrenza limitata (batch_concurrency)."""
+    async with AsyncSessionLocal() as db:
+        r = await db.execute(
+            select(Generation.id)
+            .where(Generation.batch_id == batch_id, Generation.status == "pending")
+            .order_by(Generation.batch_index)
+        )
+        generation_ids = list(r.scalars().all())
+    try:
+        webhook_url = _get_wavespeed_webhook_url()
+    except HTTPException as e:
+        logger.error(f"Batch {batch_id} non inviato: {e.detail}")
+        return
+    await asyncio.gather(*(_submit_batch_generation(gid, webhook_url) for gid in generation_ids))
+    logger.info(f"Batch {batch_id}: {len(generation_ids)} item inviati")
+
+
+def _schedule_batch(batch_id: str) -> None:
+    task = asyncio.create_task(_run_batch(batch_id), name=f"generation-batch-{batch_id}")
+    _batch_tasks.add(task)
+    task.add_done_callback(_batch_tasks.discard)
+
+
+async def _resume_pending_batches() -> None:
+    """All'avvio: riprende i batch con item ancora pending (processo riavviato durante il fan-out)."""
+    try:
+        async with AsyncSessionLocal() as db:
+            r = await db.execute(
+                select(Generation.batch_id)
+                .where(Generation.batch_id.isnot(None), Generation.status == "pending")
+                .distinct()
+            )
+            batch_ids = list(r.scalars().all())
+    except Exception as e:
+        logger.warning(f"Resume pending batches failed: {e}")
+        return
+    for batch_id in batch_ids:
+        _schedule_batch(batch_id)
+
+
+async def _get_user_batch(db: AsyncSession, batch_id: str, user_id: str) -> GenerationBatch:
+    r = await db.execute(select(GenerationBatch).where(GenerationBatch.id == batch_id))
+    batch = r.scalar_one_or_none()
+    if not batch or batch.user_id != user_id:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Batch not found")
+    return batch
+
+
+# Batch paid: N immagini/prompt, crediti prenotati tutti insieme, fan-out in background. Ritorna 202.
+@app.post("/api/generate-batch", response_model=schemas.GenerateBatchResponse, status_code=status.HTTP_202_ACCEPTED)
+@limiter.limit("5/minute")
+async def generate_batch(
+    request: Request,
+    batch_request: schemas.GenerateBatchRequest,
+    current_user_id: str = Depends(get_current_user_id),
+    db: AsyncSession = Depends(get_db),
+):
+    """Generate a catalog of product shots (no watermark). Un credito per item, prenotati in modo atomico:
+    se il saldo non basta per l'intero batch non viene creato nulla. I crediti degli item falliti sono rimborsati."""
+    items = batch_request.items
+    if len(items) > settings.batch_max_items:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Too many items: max {settings.batch_max_items} per batch",
+        )
+    _get_wavespeed_webhook_url()  # 503 subito se PUBLIC_BASE_URL manca, prima di prenotare crediti
+    ip_address = utils.get_client_ip(request)
+    batch = GenerationBatch(id=models.generate_uuid(), user_id=current_user_id, total_items=len(items))
+    if not await credits.reserve(db, current_user_id, len(items), reference_id=batch.id):
+        await db.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Insufficient credits. Please purchase credits to continue."
+        )
+    db.add(batch)
+    db.add_all([
+        Generation(
+            user_id=current_user_id,
+            device_id=batch_request.device_id,
+            ip_address=ip_address,
+            input_image_url=item.image_url,
+            prompt=item.prompt,
+            resolution=item.resolution or "8k",
+            aspect_ratio=item.aspect_ratio,
+            is_free=False,
+            status="pending",
+            request_hash=generation_cache.compute_request_hash(
+                item.image_url, item.prompt, item.resolution, item.aspect_ratio, is_free=False
+            ),
+            batch_id=batch.id,
+            batch_index=index,
+            credits_reserved=1,
+        )
+        for index, item in enumerate(items)
+    ])
+    await db.commit()  # crediti, batch e generation insieme
+    _schedule_batch(batch.id)
+    logger.info(f"Batch {batch.id} created for user {current_user_id}: {len(items)} items")
+    return schemas.GenerateBatchResponse(batch_id=batch.id, total=len(items), status="processing")
+
+
+@app.get("/api/batches/{batch_id}", response_model=schemas.BatchProgressResponse)
+async def get_batch_progress(
+    batch_id: str,
+    current_user_id: str = Depends(get_current_user_id),
+    db: AsyncSession = Depends(get_db),
+):
+    """Avanzamento aggregato del batch (conteggi per stato, una query GROUP BY)."""
+    batch = await _get_user_batch(db, batch_id, current_user_id)
+    r = await db.execute(
+        select(Generation.status, func.count())
+        .where(Generation.batch_id == batch.id)
+        .group_by(Generation.status)
+    )
+    counts = dict(r.all())
+    in_progress = counts.get("pending", 0) + counts.get("processing", 0)
+    return schemas.BatchProgressResponse(
+        batch_id=batch.id,
+        total=batch.total_items,
+        pending=counts.get("pending", 0),
+        processing=counts.get("processing", 0),
+        completed=counts.get("completed", 0),
+        failed=counts.get("failed", 0),
+        status="processing" if in_progress else "completed",
+    )
+
+
+@app.get("/api/batches/{batch_id}/results")
+async def get_batch_results(
+    batch_id: str,
+    current_user_id: str = Depends(get_current_user_id),
+    db: AsyncSession = Depends(get_db),
+):
+    """Risultati del batch in streaming (NDJSON, una riga per item nell'ordine della richiesta).
+    Le righe sono lette dal DB a blocchi, quindi anche batch da centinaia di item usano poca memoria."""
+    batch = await _get_user_batch(db, batch_id, current_user_id)
+
+    async def stream():
+        rows = await db.stream(
+            select(
+                Generation.id,
+                Generation.batch_index,
+                Generation.status,
+                Generation.input_image_url,
+                Generation.output_image_url,
+                Generation.error_message,
+            )
+            .where(Generation.batch_id == batch.id)
+            .order_by(Generation.batch_index)
+            .execution_options(yield_per=settings.batch_results_chunk_size)
+        )
+        async for row in rows:
+            yield json.dumps({
+                "generation_id": str(row.id),
+                "index": row.batch_index,
+                "status": row.status,
+                "input_image_url": row.input_image_url,
+                "output_image_url": row.output_image_url,
+                "error_message": row.error_message,
+            }) + "\n"
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+
 # Credit endpoints
 @app.get("/api/credits/packs")
 async def get_credit_packs():
@@ -584,12 +1159,13 @@ async def purchase_credits(
     return {"checkout_url": session.url}
 
 
-# Webhook WaveSpeed: riceve completed/failed, ritorna 2xx subito, elabora in background.
+# Webhook WaveSpeed: riceve completed/failed, accoda un job persistente, ritorna 2xx subito.
 # Requisiti: HTTPS, 2xx entro 20 min (noi rispondiamo in ms), pubblico.
 # Vedi https://wavespeed.ai/docs/how-to-use-webhooks
 @app.post("/api/webhooks/wavespeed")
-async def wavespeed_webhook(raw: Request):
-    """Riceve POST da WaveSpeed con id, status, outputs?, error?. Risponde 200 subito, elabora in background."""
+async def wavespeed_webhook(raw: Request, db: AsyncSession = Depends(get_db)):
+    """Riceve POST da WaveSpeed con id, status, outputs?, error?. Salva un job nella coda persistente
+    (app/jobs.py) e risponde 200 subito; i worker della coda elaborano in background."""
     try:
         body = await raw.json()
     except Exception:
@@ -602,7 +1178,7 @@ async def wavespeed_webhook(raw: Request):
     output_url = outputs[0] if outputs and stat == "completed" else None
     error = body.get("error")
 
-    asyncio.create_task(_process_wavespeed_webhook_task(wid, stat, output_url, error))
+    await jobs.enqueue(db, wid, stat, output_url, error)
     return JSONResponse(content={"received": True}, status_code=200)
 
 
@@ -630,11 +1206,11 @@ async def stripe_webhook(raw_request: Request, db: AsyncSession = Depends(get_db
     pack_id = metadata.get("pack_id")
     credits_s = metadata.get("credits", "0")
     try:
-        credits = int(credits_s)
+        credit_amount = int(credits_s)
     except ValueError:
         logger.error(f"Webhook Stripe: credits non numerico in metadata: {credits_s}")
         return {"received": True}
-    if not user_id or not pack_id or credits <= 0:
+    if not user_id or not pack_id or credit_amount <= 0:
         logger.error(f"Webhook Stripe: metadata mancanti o non validi session={session_id} metadata={metadata}")
         return {"received": True}
     # Idempotenza: evita di accreditare due volte per lo stesso checkout
@@ -642,19 +1218,9 @@ async def stripe_webhook(raw_request: Request, db: AsyncSession = Depends(get_db
     if r.scalar_one_or_none():
         logger.info(f"Webhook Stripe: checkout già elaborato session={session_id}")
         return {"received": True}
-    r = await db.execute(select(User).where(User.id == user_id))
-    user = r.scalar_one_or_none()
-    if not user:
+    if not await credits.grant(db, user_id, credit_amount, reference_id=session_id):
         logger.error(f"Webhook Stripe: user non trovato user_id={user_id} session={session_id}")
         return {"received": True}
-    user.credits_balance += credits
-    t = CreditTransaction(
-        user_id=user.id,
-        change_amount=credits,
-        type="purchase",
-        reference_id=session_id,
-    )
-    db.add(t)
     await db.commit()
-    logger.info(f"Webhook Stripe: accreditati {credits} crediti a user={user_id} pack={pack_id} session={session_id}")
+    logger.info(f"Webhook Stripe: accreditati {credit_amount} crediti a user={user_id} pack={pack_id} session={session_id}")
     return {"received": True}
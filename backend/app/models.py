@@ -1,7 +1,7 @@
 from sqlalchemy import Column, Integer, String, DateTime, Boolean, ForeignKey, Text, Index
 from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.orm import relationship
-from sqlalchemy.sql import func
+from sqlalchemy.sql import func, text
 from app.database import Base
 import uuid
 
@@ -20,9 +20,11 @@ class User(Base):
     email_verified = Column(Boolean, default=False, nullable=False)
     verification_otp_hash = Column(String(255), nullable=True)
     verification_otp_expires_at = Column(DateTime(timezone=True), nullable=True)
+    verification_otp_attempts = Column(Integer, default=0, nullable=False)  # tentativi errati sull'OTP corrente
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
     last_login_at = Column(DateTime(timezone=True), nullable=True)
+    generation_count = Column(Integer, default=0, nullable=False)  # mantenuto da trigger (migration_generation_history.sql)
     
     credit_transactions = relationship("CreditTransaction", back_populates="user")
     generations = relationship("Generation", back_populates="user")
@@ -58,16 +60,72 @@ class Generation(Base):
     status = Column(String, default="pending")  # "pending", "processing", "completed", "failed"
     error_message = Column(Text, nullable=True)
     wavespeed_request_id = Column(String, nullable=True, index=True)  # id WaveSpeed per webhook
+    request_hash = Column(String(64), nullable=True)  # hash input+parametri (cache risultati)
+    poll_attempts = Column(Integer, default=0, nullable=False)  # polling di recupero (webhook perso)
+    next_poll_at = Column(DateTime(timezone=True), nullable=True)
+    batch_id = Column(UUID(as_uuid=False), ForeignKey("generation_batches_photoshotai.id"), nullable=True)
+    batch_index = Column(Integer, nullable=True)  # posizione nella richiesta batch
+    credits_reserved = Column(Integer, default=0, nullable=False)  # crediti (paid) o quota free prenotati, non ancora saldati/rimborsati
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     completed_at = Column(DateTime(timezone=True), nullable=True)
     
     user = relationship("User", back_populates="generations")
+    batch = relationship("GenerationBatch", back_populates="generations")
     
     __table_args__ = (
         Index("idx_generations_user_created_photoshotai", "user_id", "created_at"),
+        Index(
+            "idx_generations_request_hash_photoshotai",
+            "request_hash",
+            "completed_at",
+            postgresql_where=text("request_hash IS NOT NULL AND status = 'completed'"),
+        ),
+        Index(
+            "idx_generations_stale_processing_photoshotai",
+            "next_poll_at",
+            "created_at",
+            postgresql_where=text("status = 'processing' AND wavespeed_request_id IS NOT NULL"),
+        ),
+        Index(
+            "idx_generations_batch_photoshotai",
+            "batch_id",
+            "batch_index",
+            postgresql_where=text("batch_id IS NOT NULL"),
+        ),
+        # Generation mai inviate a WaveSpeed (processo morto durante l'invio): scadute dal reconciler
+        Index(
+            "idx_generations_unsubmitted_photoshotai",
+            "created_at",
+            postgresql_where=text("status = 'processing' AND wavespeed_request_id IS NULL"),
+        ),
+        # Generation non-batch rimaste pending (processo morto tra la prenotazione e l'invio): scadute dal reconciler
+        Index(
+            "idx_generations_stranded_pending_photoshotai",
+            "created_at",
+            postgresql_where=text("status = 'pending' AND batch_id IS NULL"),
+        ),
+        # Poll di stato delle generation in corso: index-only scan (colonne di stato in INCLUDE)
+        Index(
+            "idx_generations_status_poll_photoshotai",
+            "id",
+            postgresql_include=["status", "output_image_url", "error_message", "user_id", "is_free", "device_id"],
+            postgresql_where=text("status IN ('pending', 'processing')"),
+        ),
     )
 
 
+class GenerationBatch(Base):
+    """Richiesta batch (catalogo): N generation paid con crediti prenotati tutti insieme."""
+    __tablename__ = "generation_batches_photoshotai"
+
+    id = Column(UUID(as_uuid=False), primary_key=True, default=generate_uuid)
+    user_id = Column(UUID(as_uuid=False), ForeignKey("users_photoshotai.id"), nullable=False, index=True)
+    total_items = Column(Integer, nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+    generations = relationship("Generation", back_populates="batch")
+
+
 class FreeGenerationLog(Base):
     __tablename__ = "free_generation_log_photoshotai"
     
@@ -82,3 +140,61 @@ class FreeGenerationLog(Base):
     __table_args__ = (
         Index("idx_free_gen_device_ip_month_photoshotai", "device_id", "ip_address", "month_year", unique=True),
     )
+
+
+class WebhookJob(Base):
+    """Job persistente di elaborazione webhook WaveSpeed (coda con SKIP LOCKED, vedi app/jobs.py)"""
+    __tablename__ = "webhook_jobs_photoshotai"
+    
+    id = Column(UUID(as_uuid=False), primary_key=True, default=generate_uuid)
+    wavespeed_request_id = Column(String, nullable=False)
+    wavespeed_status = Column(String, nullable=False)  # "completed" / "failed" (dal webhook)
+    lane = Column(String, default="paid", nullable=False)  # "paid" / "free": worker e priorità separati
+    output_url = Column(String, nullable=True)
+    error = Column(Text, nullable=True)
+    status = Column(String, default="queued", nullable=False)  # "queued", "running", "done", "dead"
+    attempts = Column(Integer, default=0, nullable=False)
+    max_attempts = Column(Integer, default=5, nullable=False)
+    available_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)  # backoff retry
+    locked_until = Column(DateTime(timezone=True), nullable=True)  # visibility timeout
+    last_error = Column(Text, nullable=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+    finished_at = Column(DateTime(timezone=True), nullable=True)
+    
+    __table_args__ = (
+        Index(
+            "idx_webhook_jobs_claim_photoshotai",
+            "lane",
+            "status",
+            "available_at",
+            postgresql_where=text("status IN ('queued', 'running')"),
+        ),
+    )
+
+
+class EmailOutbox(Base):
+    """Email in uscita: scritta nella stessa transazione di chi la genera, inviata dal sender in background (app/email_outbox.py)"""
+    __tablename__ = "email_outbox_photoshotai"
+
+    id = Column(UUID(as_uuid=False), primary_key=True, default=generate_uuid)
+    to_email = Column(String, nullable=False)
+    subject = Column(String, nullable=False)
+    body_plain = Column(Text, nullable=True)  # azzerati dopo l'invio (contengono l'OTP)
+    body_html = Column(Text, nullable=True)
+    status = Column(String, default="queued", nullable=False)  # "queued", "sending", "sent", "dead", "expired"
+    attempts = Column(Integer, default=0, nullable=False)
+    available_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)  # backoff retry
+    locked_until = Column(DateTime(timezone=True), nullable=True)  # sender morto: torna reclamabile
+    expires_at = Column(DateTime(timezone=True), nullable=True)  # oltre, inutile inviarla (OTP scaduto)
+    last_error = Column(Text, nullable=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    sent_at = Column(DateTime(timezone=True), nullable=True)
+
+    __table_args__ = (
+        Index(
+            "idx_email_outbox_claim_photoshotai",
+            "available_at",
+            postgresql_where=text("status IN ('queued', 'sending')"),
+        ),
+    )
@@ -0,0 +1,72 @@
+"""
+OTP di verifica email: codici a 6 cifre salvati come HMAC-SHA256 (chiave server, legato all'id utente)
+invece che con bcrypt. Un codice vive OTP_EXPIRY_MINUTES e ha al massimo otp_max_attempts tentativi:
+la forza bruta è fermata da tentativi + rate limit dell'endpoint, non dal costo dell'hash.
+
+Gli OTP emessi prima (hash bcrypt "$2...") restano verificabili fino alla scadenza.
+"""
+import hashlib
+import hmac
+import secrets
+from datetime import datetime, timedelta, timezone
+
+from app import hashing
+from app.config import settings
+from app.models import User
+
+OTP_EXPIRY_MINUTES = 15
+_PREFIX = "hmac-sha256$"
+
+# Esiti di verify()
+VALID = "valid"
+MISSING = "missing"
+EXPIRED = "expired"
+INVALID = "invalid"
+TOO_MANY_ATTEMPTS = "too_many_attempts"
+
+
+def _digest(user_id: str, code: str) -> str:
+    key = (settings.otp_secret_key or settings.jwt_secret_key).encode()
+    mac = hmac.new(key, f"{user_id}:{code}".encode(), hashlib.sha256).hexdigest()
+    return _PREFIX + mac
+
+
+def issue(user: User) -> str:
+    """Genera un nuovo OTP per l'utente (id già assegnato), azzera i tentativi. Ritorna il codice in chiaro. Non fa commit."""
+    code = "".join(secrets.choice("0123456789") for _ in range(6))
+    user.verification_otp_hash = _digest(user.id, code)
+    user.verification_otp_expires_at = datetime.now(timezone.utc) + timedelta(minutes=OTP_EXPIRY_MINUTES)
+    user.verification_otp_attempts = 0
+    return code
+
+
+def clear(user: User) -> None:
+    user.verification_otp_hash = None
+    user.verification_otp_expires_at = None
+    user.verification_otp_attempts = 0
+
+
+async def _matches(user: User, code: str) -> bool:
+    stored = user.verification_otp_hash
+    if stored.startswith(_PREFIX):
+        return hmac.compare_digest(stored, _digest(user.id, code))
+    return await hashing.verify_password(code, stored)
+
+
+async def verify(user: User, code: str) -> str:
+    """Controlla il codice e aggiorna lo stato dell'OTP sull'utente (consumato se valido, invalidato
+    se scaduto o tentativi esauriti, tentativo contato se errato). Il chiamante fa commit."""
+    if not user.verification_otp_hash or not user.verification_otp_expires_at:
+        return MISSING
+    if user.verification_otp_expires_at < datetime.now(timezone.utc):
+        clear(user)
+        return EXPIRED
+    if (user.verification_otp_attempts or 0) >= settings.otp_max_attempts:
+        clear(user)
+        return TOO_MANY_ATTEMPTS
+    if await _matches(user, code):
+        clear(user)
+        return VALID
+    # Incremento lato DB: tentativi concorrenti non si sovrascrivono
+    user.verification_otp_attempts = User.verification_otp_attempts + 1
+    return INVALID
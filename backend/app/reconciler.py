@@ -0,0 +1,207 @@
+"""
+Recupero dei webhook WaveSpeed persi: un task in background cerca le generation rimaste "processing"
+oltre reconciler_grace_seconds e chiede a WaveSpeed lo stato del task (GET /predictions/{id}/result).
+
+- Intervallo adattivo per generation: base * 2^(tentativi), fino a reconciler_max_interval_seconds
+  (salvato in next_poll_at, quindi più istanze non interrogano la stessa generation).
+- Limite globale di richieste al secondo e un solo client HTTP condiviso (pool di app/wavespeed.py).
+- I risultati completed/failed finiscono nella coda webhook (app/jobs.py) con un solo INSERT,
+  così download/watermark/upload passano per lo stesso percorso del webhook.
+- Oltre reconciler_max_age_minutes la generation viene segnata failed e rimborsata (un UPDATE per giro),
+  anche se non ha mai ricevuto un wavespeed_request_id (processo morto durante l'invio a WaveSpeed).
+- Le generation non-batch ancora "pending" oltre reconciler_pending_grace_seconds (processo morto tra la
+  prenotazione del credito o della quota free e l'invio) sono scadute e rimborsate nello stesso UPDATE.
+"""
+import asyncio
+import logging
+from datetime import timedelta
+from typing import Optional
+
+from sqlalchemy import and_, case, exists, func, or_, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app import credits, events, jobs, wavespeed
+from app.config import settings
+from app.database import AsyncSessionLocal
+from app.models import Generation, WebhookJob
+from app.utils import RateLimiter
+
+logger = logging.getLogger(__name__)
+
+_task: Optional[asyncio.Task] = None
+_stats = {
+    "polled": 0,
+    "recovered": 0,
+    "expired": 0,
+    "errors": 0,
+}
+
+
+def _next_poll_delay(poll_attempts):
+    """Espressione SQL: intervallo del prossimo poll, esponenziale nel numero di tentativi."""
+    seconds = func.least(
+        settings.reconciler_max_interval_seconds,
+        settings.reconciler_base_interval_seconds * func.power(2, poll_attempts),
+    )
+    return func.make_interval(0, 0, 0, 0, 0, 0, seconds)
+
+
+def _has_pending_job():
+    """Clausola EXISTS: per il task WaveSpeed della generation c'è già un job in coda (risultato arrivato)."""
+    return exists().where(
+        and_(
+            WebhookJob.wavespeed_request_id == Generation.wavespeed_request_id,
+            WebhookJob.status.in_(("queued", "running")),
+        )
+    )
+
+
+async def _expire_stale(db: AsyncSession) -> int:
+    """Segna failed (e rimborsa) le generation in processing da oltre reconciler_max_age_minutes: task WaveSpeed
+    mai concluso, oppure invio mai completato (wavespeed_request_id NULL, es. restart durante un batch).
+    Stessa sorte per le non-batch rimaste pending oltre reconciler_pending_grace_seconds (ben oltre il
+    timeout della chiamata a WaveSpeed): credito o generation free della quota prenotati ma task mai creato;
+    credits.refund restituisce l'uno o l'altra. I batch pending li riprende il resume dei batch.
+    Non scade le generation con un job webhook ancora in coda: il risultato è già arrivato e verrà elaborato
+    (retry con backoff, backpressure della lane free)."""
+    stale_processing = and_(
+        Generation.status == "processing",
+        Generation.created_at < func.now() - timedelta(minutes=settings.reconciler_max_age_minutes),
+        ~_has_pending_job(),
+    )
+    stranded_pending = and_(
+        Generation.status == "pending",
+        Generation.batch_id.is_(None),
+        Generation.created_at < func.now() - timedelta(seconds=settings.reconciler_pending_grace_seconds),
+    )
+    r = await db.execute(
+        update(Generation)
+        .where(or_(stale_processing, stranded_pending))
+        .values(
+            status="failed",
+            error_message=case(
+                (Generation.wavespeed_request_id.is_(None), "Generation was never submitted to WaveSpeed"),
+                else_="WaveSpeed task timed out",
+            ),
+            completed_at=func.now(),
+            next_poll_at=None,
+        )
+        .returning(Generation.id)
+    )
+    expired_ids = list(r.scalars().all())
+    for generation_id in expired_ids:
+        await credits.refund(db, generation_id)
+    await db.commit()
+    await events.publish(db, *expired_ids)
+    return len(expired_ids)
+
+
+async def _claim_due(db: AsyncSession) -> list[str]:
+    """Reclama un batch di generation da interrogare e sposta subito il loro next_poll_at in avanti
+    (un solo UPDATE). Salta quelle che hanno già un job in coda: il risultato è già arrivato."""
+    due_ids = (
+        select(Generation.id)
+        .where(
+            Generation.status == "processing",
+            Generation.wavespeed_request_id.isnot(None),
+            Generation.created_at < func.now() - timedelta(seconds=settings.reconciler_grace_seconds),
+            (Generation.next_poll_at.is_(None)) | (Generation.next_poll_at <= func.now()),
+            ~_has_pending_job(),
+        )
+        .order_by(Generation.next_poll_at.asc().nullsfirst(), Generation.created_at)
+        .limit(settings.reconciler_batch_size)
+        .with_for_update(skip_locked=True)
+    )
+    r = await db.execute(
+        update(Generation)
+        .where(Generation.id.in_(due_ids))
+        .values(
+            poll_attempts=Generation.poll_attempts + 1,
+            next_poll_at=func.now() + _next_poll_delay(Generation.poll_attempts),
+        )
+        .returning(Generation.wavespeed_request_id)
+        .execution_options(synchronize_session=False)
+    )
+    wavespeed_ids = list(r.scalars().all())
+    await db.commit()
+    return wavespeed_ids
+
+
+async def _poll_one(
+    client: wavespeed.WaveSpeedClient,
+    limiter: RateLimiter,
+    wavespeed_id: str,
+) -> Optional[tuple[str, str, Optional[str], Optional[str]]]:
+    await limiter.acquire()
+    try:
+        result = await client.get_prediction_result(wavespeed_id)
+    except Exception as e:
+        _stats["errors"] += 1
+        logger.warning(f"Reconciler: poll WaveSpeed fallito per {wavespeed_id}: {e}")
+        return None
+    _stats["polled"] += 1
+    status = result.get("status")
+    if status == "completed":
+        outputs = result.get("outputs") or []
+        if outputs:
+            return (wavespeed_id, status, outputs[0], None)
+    elif status == "failed":
+        return (wavespeed_id, status, None, result.get("error") or "WaveSpeed task failed")
+    return None
+
+
+async def reconcile_once(limiter: RateLimiter) -> None:
+    """Un giro: scadenza delle generation troppo vecchie, poll del batch dovuto, accodamento dei risultati."""
+    async with AsyncSessionLocal() as db:
+        expired = await _expire_stale(db)
+        wavespeed_ids = await _claim_due(db)
+    if expired:
+        _stats["expired"] += expired
+        logger.warning(f"Reconciler: {expired} generation scadute (processing da oltre {settings.reconciler_max_age_minutes} min o mai inviate) segnate failed")
+    if not wavespeed_ids:
+        return
+
+    client = wavespeed.get_wavespeed_client()
+    semaphore = asyncio.Semaphore(settings.reconciler_max_concurrency)
+
+    async def poll(wavespeed_id: str):
+        async with semaphore:
+            return await _poll_one(client, limiter, wavespeed_id)
+
+    results = [r for r in await asyncio.gather(*(poll(w) for w in wavespeed_ids)) if r]
+    if results:
+        async with AsyncSessionLocal() as db:
+            await jobs.enqueue_many(db, results)
+        _stats["recovered"] += len(results)
+        logger.info(f"Reconciler: {len(results)}/{len(wavespeed_ids)} risultati WaveSpeed recuperati senza webhook")
+
+
+async def _run() -> None:
+    limiter = RateLimiter(settings.reconciler_rate_per_second)
+    while True:
+        try:
+            await reconcile_once(limiter)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Reconciler: giro fallito")
+        await asyncio.sleep(settings.reconciler_interval_seconds)
+
+
+def start() -> None:
+    """Avvia il reconciler in background (chiamato nel lifespan)."""
+    global _task
+    if settings.reconciler_enabled and _task is None:
+        _task = asyncio.create_task(_run(), name="wavespeed-reconciler")
+
+
+async def stop() -> None:
+    global _task
+    if _task is not None:
+        _task.cancel()
+        await asyncio.gather(_task, return_exceptions=True)
+        _task = None
+
+
+def get_stats() -> dict:
+    return {"enabled": settings.reconciler_enabled, **_stats}
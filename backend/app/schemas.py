@@ -1,5 +1,5 @@
 from pydantic import BaseModel, EmailStr, Field, validator
-from typing import Optional
+from typing import List, Optional
 from datetime import datetime
 
 
@@ -73,6 +73,34 @@ class GenerateResponse(BaseModel):
     error_message: Optional[str] = None
 
 
+class GenerateBatchItem(BaseModel):
+    prompt: str = Field(..., min_length=1, max_length=1000)
+    image_url: str
+    aspect_ratio: str = Field(default="1:1", pattern="^(1:1|4:5|16:9)$")
+    resolution: str = Field(default="8k", pattern="^(4k|8k)$")
+
+
+class GenerateBatchRequest(BaseModel):
+    items: List[GenerateBatchItem] = Field(..., min_length=1)
+    device_id: Optional[str] = None
+
+
+class GenerateBatchResponse(BaseModel):
+    batch_id: str
+    total: int
+    status: str
+
+
+class BatchProgressResponse(BaseModel):
+    batch_id: str
+    total: int
+    pending: int
+    processing: int
+    completed: int
+    failed: int
+    status: str  # "processing" finché ci sono item pending/processing, poi "completed"
+
+
 # Credit schemas
 class CreditPack(BaseModel):
     id: str
@@ -114,3 +142,4 @@ class GenerationHistoryResponse(BaseModel):
     total: int
     page: int
     page_size: int
+    next_cursor: Optional[str] = None  # da passare come ?cursor= per la pagina successiva (None = ultima)
@@ -0,0 +1,56 @@
+"""Coalescing delle richieste di generazione identiche in corso (singleflight).
+
+Doppi click e retry del frontend inviano POST identici in parallelo: invece di una Generation e
+un task WaveSpeed per ciascuno, i duplicati si agganciano alla generation già in corso (stesso
+generation_id, stesso task WaveSpeed, un solo webhook).
+
+Funziona tra più worker/processi: la sezione "cerca in corso → crea" è serializzata per chiave con
+un advisory lock Postgres a livello di transazione (rilasciato dal commit che crea la generation).
+"""
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+from sqlalchemy import or_, select, text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.config import settings
+from app.models import Generation
+
+
+def owner_key(user_id: Optional[str] = None, device_id: Optional[str] = None) -> str:
+    """Proprietario della richiesta: utente autenticato (paid) oppure device (free)."""
+    return f"user:{user_id}" if user_id else f"device:{device_id}"
+
+
+async def lock(db: AsyncSession, owner: str, request_hash: str) -> None:
+    """Advisory lock sulla chiave owner+richiesta, valido fino a commit/rollback della transazione."""
+    await db.execute(
+        text("SELECT pg_advisory_xact_lock(hashtext(:key))"),
+        {"key": f"generation:{owner}:{request_hash}"},
+    )
+
+
+async def find_in_flight(
+    db: AsyncSession,
+    request_hash: str,
+    user_id: Optional[str] = None,
+    device_id: Optional[str] = None,
+) -> Optional[Generation]:
+    """Generation identica dello stesso proprietario ancora pending/processing (entro la finestra). Senza task
+    WaveSpeed (invio in corso o interrotto da un crash) conta solo entro singleflight_submit_grace_seconds:
+    una generation rimasta bloccata non deve assorbire i retry fino alla scadenza del reconciler."""
+    now = datetime.now(timezone.utc)
+    since = now - timedelta(seconds=settings.singleflight_window_seconds)
+    submit_since = now - timedelta(seconds=settings.singleflight_submit_grace_seconds)
+    query = select(Generation).where(
+        Generation.request_hash == request_hash,
+        Generation.status.in_(("pending", "processing")),
+        Generation.created_at >= since,
+        or_(Generation.wavespeed_request_id.isnot(None), Generation.created_at >= submit_since),
+    )
+    if user_id:
+        query = query.where(Generation.user_id == user_id)
+    else:
+        query = query.where(Generation.device_id == device_id, Generation.is_free.is_(True))
+    r = await db.execute(query.order_by(Generation.created_at.desc()).limit(1))
+    return r.scalar_one_or_none()
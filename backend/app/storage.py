@@ -1,21 +1,61 @@
+import asyncio
+import hashlib
+import io
+import logging
 import os
+import tempfile
 import uuid
-from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import AsyncIterator, Optional
 from pathlib import Path
 from urllib.parse import urlparse
 import aiofiles
 from app.config import settings
+from app.utils import TTLCache
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config as BotoConfig
 from botocore.exceptions import ClientError
 
+logger = logging.getLogger(__name__)
+
 
 class StorageAdapter:
-    """Abstract storage adapter for S3-compatible storage"""
+    """Abstract storage adapter for S3-compatible storage.
+    Con storage_content_addressed gli oggetti sono nominati con l'hash del contenuto: file identici
+    condividono lo stesso oggetto (e la stessa URL/cache CDN) e la scrittura viene saltata se esiste già."""
+    
+    content_addressed: bool = False
+    _known_hashes: Optional[TTLCache] = None
+    
+    def _init_content_addressing(self) -> None:
+        self.content_addressed = settings.storage_content_addressed
+        # Indice locale degli oggetti già presenti: evita exists/HEAD ripetuti per gli stessi hash
+        self._known_hashes = TTLCache(maxsize=settings.storage_hash_index_size)
+    
+    @staticmethod
+    def _new_hasher():
+        return hashlib.new(settings.storage_hash_algorithm)
+    
+    def _content_key(self, digest: str, file_extension: str) -> str:
+        return f"{digest}{file_extension}"
+    
+    def _is_known(self, key: str) -> bool:
+        return self._known_hashes is not None and key in self._known_hashes
+    
+    def _remember(self, key: str) -> None:
+        if self.content_addressed and self._known_hashes is not None:
+            self._known_hashes.set(key, True)
     
     async def upload_file(self, file_content: bytes, file_extension: str) -> str:
         """Upload file and return public URL"""
         raise NotImplementedError
     
+    async def upload_stream(self, chunks: AsyncIterator[bytes], file_extension: str) -> str:
+        """Upload file a chunk (es. da uno stream httpx) senza tenerlo tutto in memoria; ritorna URL pubblico"""
+        raise NotImplementedError
+    
     async def download_file(self, url: str) -> bytes:
         """Download file from URL and return bytes"""
         raise NotImplementedError
@@ -23,6 +63,13 @@ class StorageAdapter:
     async def delete_file(self, url: str) -> None:
         """Delete file from storage"""
         raise NotImplementedError
+    
+    async def health_check(self) -> None:
+        """Verifica che lo storage sia raggiungibile/scrivibile; solleva in caso di problemi"""
+        raise NotImplementedError
+    
+    def close(self) -> None:
+        """Rilascia risorse (executor, connessioni). Di default nulla da chiudere."""
 
 
 class LocalStorageAdapter(StorageAdapter):
@@ -32,17 +79,12 @@ class LocalStorageAdapter(StorageAdapter):
         self.base_path = Path(base_path).resolve()
         self.base_path.mkdir(parents=True, exist_ok=True)
         self.base_url = "/storage"
+        self._init_content_addressing()
     
     def _get_file_path(self, filename: str) -> Path:
         return self.base_path / filename
     
-    async def upload_file(self, file_content: bytes, file_extension: str) -> str:
-        filename = f"{uuid.uuid4()}{file_extension}"
-        file_path = self._get_file_path(filename)
-        
-        async with aiofiles.open(file_path, "wb") as f:
-            await f.write(file_content)
-        
+    def _public_url(self, filename: str) -> str:
         # Per WaveSpeed e altre API esterne servono URL assoluti e pubblici.
         # Con public_base_url (es. https://tuo-backend.onrender.com) si evita "image url is not allowed".
         if settings.public_base_url:
@@ -50,6 +92,59 @@ class LocalStorageAdapter(StorageAdapter):
             return f"{base}/storage/{filename}"
         return f"{self.base_url}/{filename}"
     
+    def _exists(self, filename: str) -> bool:
+        if self._is_known(filename):
+            return True
+        if self._get_file_path(filename).exists():
+            self._remember(filename)
+            return True
+        return False
+    
+    async def upload_file(self, file_content: bytes, file_extension: str) -> str:
+        if self.content_addressed:
+            hasher = self._new_hasher()
+            hasher.update(file_content)
+            filename = self._content_key(hasher.hexdigest(), file_extension)
+            if self._exists(filename):
+                return self._public_url(filename)
+        else:
+            filename = f"{uuid.uuid4()}{file_extension}"
+        file_path = self._get_file_path(filename)
+        
+        async with aiofiles.open(file_path, "wb") as f:
+            await f.write(file_content)
+        
+        self._remember(filename)
+        return self._public_url(filename)
+    
+    async def upload_stream(self, chunks: AsyncIterator[bytes], file_extension: str) -> str:
+        # Content-addressed: il nome dipende dall'hash, noto solo a fine stream → file .part poi rename
+        filename = f"{uuid.uuid4()}{file_extension}"
+        file_path = self._get_file_path(filename + ".part" if self.content_addressed else filename)
+        hasher = self._new_hasher() if self.content_addressed else None
+        
+        try:
+            async with aiofiles.open(file_path, "wb") as f:
+                async for chunk in chunks:
+                    if hasher is not None:
+                        hasher.update(chunk)
+                    await f.write(chunk)
+        except BaseException:
+            # Niente file parziali nello storage se il download si interrompe
+            if file_path.exists():
+                file_path.unlink()
+            raise
+        
+        if hasher is not None:
+            filename = self._content_key(hasher.hexdigest(), file_extension)
+            if self._exists(filename):
+                file_path.unlink()
+            else:
+                os.replace(file_path, self._get_file_path(filename))
+                self._remember(filename)
+        
+        return self._public_url(filename)
+    
     async def download_file(self, url: str) -> bytes:
         # Extract filename from URL
         filename = url.split("/")[-1]
@@ -59,43 +154,73 @@ class LocalStorageAdapter(StorageAdapter):
             return await f.read()
     
     async def delete_file(self, url: str) -> None:
+        if self.content_addressed:
+            return  # oggetto potenzialmente condiviso da più upload/generation
         filename = url.split("/")[-1]
         file_path = self._get_file_path(filename)
         if file_path.exists():
             file_path.unlink()
+    
+    async def health_check(self) -> None:
+        if not os.access(self.base_path, os.W_OK):
+            raise PermissionError(f"Storage path not writable: {self.base_path}")
 
 
 class S3StorageAdapter(StorageAdapter):
-    """AWS S3 storage adapter"""
+    """AWS S3 storage adapter.
+    boto3 è sincrono: ogni chiamata gira in un executor dedicato (mai sull'event loop), con un
+    semaforo che limita le operazioni S3 contemporanee e un pool di connessioni botocore proprio."""
     
     def __init__(
         self,
         bucket_name: str,
         access_key_id: str,
         secret_access_key: str,
-        region: str = "us-east-1"
+        region: str = "us-east-1",
+        endpoint_url: Optional[str] = None,
     ):
         self.bucket_name = bucket_name
+        max_concurrency = max(1, settings.s3_max_concurrency)
         self.s3_client = boto3.client(
             "s3",
             aws_access_key_id=access_key_id,
             aws_secret_access_key=secret_access_key,
-            region_name=region
+            region_name=region,
+            endpoint_url=endpoint_url or None,
+            config=BotoConfig(
+                max_pool_connections=settings.s3_max_pool_connections,
+                retries={"max_attempts": 3, "mode": "standard"},
+            ),
         )
-        self.base_url = f"https://{bucket_name}.s3.{region}.amazonaws.com"
-    
-    async def upload_file(self, file_content: bytes, file_extension: str) -> str:
-        filename = f"{uuid.uuid4()}{file_extension}"
-        
-        # boto3 is synchronous, but we can run it in executor if needed
-        # For now, using sync calls as boto3 doesn't have async support
-        self.s3_client.put_object(
-            Bucket=self.bucket_name,
-            Key=filename,
-            Body=file_content,
-            ContentType="image/jpeg" if file_extension == ".jpg" else "image/png"
+        self.transfer_config = TransferConfig(
+            multipart_threshold=settings.s3_multipart_threshold_mb * 1024 * 1024,
+            multipart_chunksize=max(5, settings.s3_multipart_chunk_size_mb) * 1024 * 1024,
+            max_concurrency=max_concurrency,
+            use_threads=True,
         )
-        
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="s3")
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        if endpoint_url:
+            # S3-compatibile (MinIO, moto server): URL path-style sull'endpoint configurato
+            self.base_url = f"{endpoint_url.rstrip('/')}/{bucket_name}"
+        else:
+            self.base_url = f"https://{bucket_name}.s3.{region}.amazonaws.com"
+        self._init_content_addressing()
+    
+    async def _run(self, fn, *args, **kwargs):
+        """Esegue una chiamata boto3 nell'executor S3, al massimo s3_max_concurrency alla volta."""
+        async with self._semaphore:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, partial(fn, *args, **kwargs))
+    
+    def close(self) -> None:
+        self._executor.shutdown(wait=False)
+    
+    async def health_check(self) -> None:
+        # HEAD bucket: risolve le credenziali e apre la prima connessione del pool
+        await self._run(self.s3_client.head_bucket, Bucket=self.bucket_name)
+    
+    def _public_url(self, filename: str) -> str:
         # CloudFront: URL pubblico tipo https://d1q70pf5vjeyhc.cloudfront.net/key (richiesto da WaveSpeed).
         # Se non impostato, si usa l'URL S3 diretto (già pubblico).
         if settings.cloudfront_domain:
@@ -103,31 +228,195 @@ class S3StorageAdapter(StorageAdapter):
             return f"https://{domain}/{filename}"
         return f"{self.base_url}/{filename}"
     
+    async def _exists(self, key: str) -> bool:
+        if self._is_known(key):
+            return True
+        try:
+            await self._run(self.s3_client.head_object, Bucket=self.bucket_name, Key=key)
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return False
+            raise
+        self._remember(key)
+        return True
+    
+    async def upload_file(self, file_content: bytes, file_extension: str) -> str:
+        if self.content_addressed:
+            hasher = self._new_hasher()
+            hasher.update(file_content)
+            filename = self._content_key(hasher.hexdigest(), file_extension)
+            if await self._exists(filename):
+                return self._public_url(filename)  # PUT risparmiato
+        else:
+            filename = f"{uuid.uuid4()}{file_extension}"
+        
+        # Oltre s3_multipart_threshold_mb upload_fileobj passa a multipart con parti in parallelo
+        await self._run(
+            self.s3_client.upload_fileobj,
+            io.BytesIO(file_content),
+            self.bucket_name,
+            filename,
+            ExtraArgs={"ContentType": "image/jpeg" if file_extension == ".jpg" else "image/png"},
+            Config=self.transfer_config,
+        )
+        
+        self._remember(filename)
+        return self._public_url(filename)
+    
+    async def _upload_stream_content_addressed(self, chunks: AsyncIterator[bytes], file_extension: str) -> str:
+        """La key (hash) è nota solo a fine stream: i chunk vanno su un file temporaneo locale
+        (memoria costante), poi upload solo se l'oggetto non esiste già."""
+        hasher = self._new_hasher()
+        fd, tmp_path = tempfile.mkstemp(suffix=file_extension)
+        os.close(fd)
+        try:
+            async with aiofiles.open(tmp_path, "wb") as f:
+                async for chunk in chunks:
+                    hasher.update(chunk)
+                    await f.write(chunk)
+            filename = self._content_key(hasher.hexdigest(), file_extension)
+            if not await self._exists(filename):
+                await self._run(
+                    self.s3_client.upload_file,
+                    tmp_path,
+                    self.bucket_name,
+                    filename,
+                    ExtraArgs={"ContentType": "image/jpeg" if file_extension == ".jpg" else "image/png"},
+                    Config=self.transfer_config,
+                )
+                self._remember(filename)
+        finally:
+            os.unlink(tmp_path)
+        return self._public_url(filename)
+    
+    async def _upload_part(self, key: str, upload_id: str, part_number: int, data: bytearray) -> dict:
+        resp = await self._run(
+            self.s3_client.upload_part,
+            Bucket=self.bucket_name,
+            Key=key,
+            UploadId=upload_id,
+            PartNumber=part_number,
+            Body=bytes(data),
+        )
+        return {"ETag": resp["ETag"], "PartNumber": part_number}
+    
+    async def upload_stream(self, chunks: AsyncIterator[bytes], file_extension: str) -> str:
+        """Multipart upload: in memoria al massimo una parte (s3_multipart_chunk_size_mb) alla volta."""
+        if self.content_addressed:
+            return await self._upload_stream_content_addressed(chunks, file_extension)
+        filename = f"{uuid.uuid4()}{file_extension}"
+        content_type = "image/jpeg" if file_extension == ".jpg" else "image/png"
+        part_size = max(5, settings.s3_multipart_chunk_size_mb) * 1024 * 1024  # S3: minimo 5MB per parte
+        
+        buffer = bytearray()
+        upload_id = None
+        parts = []
+        try:
+            async for chunk in chunks:
+                buffer.extend(chunk)
+                if len(buffer) < part_size:
+                    continue
+                if upload_id is None:
+                    upload_id = (await self._run(
+                        self.s3_client.create_multipart_upload,
+                        Bucket=self.bucket_name, Key=filename, ContentType=content_type,
+                    ))["UploadId"]
+                parts.append(await self._upload_part(filename, upload_id, len(parts) + 1, buffer))
+                buffer.clear()
+            
+            if upload_id is None:
+                # File più piccolo di una parte: un solo PUT
+                await self._run(
+                    self.s3_client.put_object,
+                    Bucket=self.bucket_name, Key=filename, Body=bytes(buffer), ContentType=content_type,
+                )
+            else:
+                if buffer:
+                    parts.append(await self._upload_part(filename, upload_id, len(parts) + 1, buffer))
+                await self._run(
+                    self.s3_client.complete_multipart_upload,
+                    Bucket=self.bucket_name,
+                    Key=filename,
+                    UploadId=upload_id,
+                    MultipartUpload={"Parts": parts},
+                )
+        except BaseException:
+            if upload_id is not None:
+                try:
+                    await self._run(
+                        self.s3_client.abort_multipart_upload,
+                        Bucket=self.bucket_name, Key=filename, UploadId=upload_id,
+                    )
+                except ClientError:
+                    pass
+            raise
+        
+        return self._public_url(filename)
+    
     def _url_to_key(self, url: str) -> str:
-        """Estrae la key S3 da URL S3 (s3...amazonaws.com/key) o CloudFront (dxxx.cloudfront.net/key)."""
+        """Estrae la key S3 da URL S3 (s3...amazonaws.com/key), CloudFront (dxxx.cloudfront.net/key)
+        o path-style dell'endpoint configurato (endpoint/bucket/key)."""
+        if url.startswith(self.base_url + "/"):
+            return url[len(self.base_url) + 1:]
         return urlparse(url).path.lstrip("/")
 
     async def download_file(self, url: str) -> bytes:
         key = self._url_to_key(url)
-        response = self.s3_client.get_object(Bucket=self.bucket_name, Key=key)
-        return response["Body"].read()
+
+        def _get() -> bytes:
+            response = self.s3_client.get_object(Bucket=self.bucket_name, Key=key)
+            return response["Body"].read()
+        return await self._run(_get)
 
     async def delete_file(self, url: str) -> None:
+        if self.content_addressed:
+            return  # oggetto potenzialmente condiviso da più upload/generation
         key = self._url_to_key(url)
         try:
-            self.s3_client.delete_object(Bucket=self.bucket_name, Key=key)
+            await self._run(self.s3_client.delete_object, Bucket=self.bucket_name, Key=key)
         except ClientError:
             pass
 
 
-def get_storage_adapter() -> StorageAdapter:
-    """Factory function to get the appropriate storage adapter"""
+# Adapter condiviso dal processo: un solo client boto3 (pool di connessioni e credenziali risolte
+# una volta) invece di uno nuovo per ogni upload/webhook. Creato da init_storage nel lifespan.
+_storage_adapter: Optional[StorageAdapter] = None
+
+
+def _build_storage_adapter() -> StorageAdapter:
     if settings.storage_type == "s3":
         return S3StorageAdapter(
             bucket_name=settings.s3_bucket_name,
             access_key_id=settings.aws_access_key_id,
             secret_access_key=settings.aws_secret_access_key,
-            region=settings.aws_region
+            region=settings.aws_region,
+            endpoint_url=settings.s3_endpoint_url,
         )
     else:
         return LocalStorageAdapter(base_path=settings.storage_path)
+
+
+def get_storage_adapter() -> StorageAdapter:
+    """Factory function to get the appropriate storage adapter (singleton di processo)"""
+    global _storage_adapter
+    if _storage_adapter is None:
+        _storage_adapter = _build_storage_adapter()
+    return _storage_adapter
+
+
+async def init_storage() -> StorageAdapter:
+    """Crea l'adapter all'avvio ed esegue un health probe, così il primo upload non paga
+    creazione client, risoluzione credenziali e handshake. Un probe fallito viene solo loggato."""
+    adapter = get_storage_adapter()
+    try:
+        await adapter.health_check()
+    except Exception:
+        logger.exception("Storage health probe failed (storage_type=%s)", settings.storage_type)
+    return adapter
+
+
+def close_storage() -> None:
+    global _storage_adapter
+    if _storage_adapter is not None:
+        _storage_adapter.close()
+        _storage_adapter = None
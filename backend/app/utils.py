@@ -1,9 +1,14 @@
+import asyncio
+import json
+import time
+from collections import OrderedDict
 from datetime import datetime
-from typing import Optional
-from fastapi import Request
+from typing import Any, Hashable, Optional
+from fastapi import HTTPException, Request
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, func
-from app.models import FreeGenerationLog
+from sqlalchemy import func, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from app.models import FreeGenerationLog, generate_uuid
 from app.config import settings
 
 
@@ -22,41 +27,218 @@ def get_client_ip(request: Request) -> str:
     return "unknown"
 
 
+class TTLCache:
+    """Cache LRU in memoria con scadenza opzionale (ttl in secondi, None = nessuna scadenza).
+    Pensata per l'event loop: non è thread-safe."""
+
+    def __init__(self, maxsize: int, ttl: Optional[float] = None):
+        self.maxsize = max(1, maxsize)
+        self.ttl = ttl
+        self._data: OrderedDict[Hashable, tuple[Any, Optional[float]]] = OrderedDict()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        item = self._data.get(key)
+        if item is None:
+            return default
+        value, expires_at = item
+        if expires_at is not None and expires_at <= time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+        self._data[key] = (value, expires_at)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        item = self._data.pop(key, None)
+        return default if item is None else item[0]
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def __contains__(self, key: Hashable) -> bool:
+        sentinel = object()
+        return self.get(key, sentinel) is not sentinel
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class RateLimiter:
+    """Limite globale di richieste al secondo condiviso tra task asyncio: acquire() attende
+    il prossimo slot libero (intervalli regolari, nessun burst)."""
+
+    def __init__(self, rate_per_second: float):
+        self.interval = 1.0 / rate_per_second if rate_per_second > 0 else 0.0
+        self._next_slot = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        if not self.interval:
+            return
+        async with self._lock:
+            now = time.monotonic()
+            wait = self._next_slot - now
+            self._next_slot = max(now, self._next_slot) + self.interval
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+# Magic bytes dei formati immagine accettati in upload
+_IMAGE_SIGNATURES = (
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+)
+
+
+def detect_image_type(head: bytes) -> Optional[str]:
+    """Content type dai primi byte del file (non ci si fida del Content-Type dichiarato dal client)"""
+    for signature, content_type in _IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return content_type
+    return None
+
+
+class BodySizeLimitMiddleware:
+    """Middleware ASGI: rifiuta con 413 i body oltre max_bytes sui path indicati, prima che vengano
+    letti per intero (Content-Length dichiarato oppure conteggio dei byte ricevuti se chunked).
+    Nel caso chunked solleva HTTPException dentro receive(): FastAPI la rilancia così com'è durante il
+    parsing del body (qualsiasi altra eccezione diventerebbe un 400)."""
+
+    def __init__(self, app, paths: tuple[str, ...], max_bytes: int):
+        self.app = app
+        self.paths = paths
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def _detail() -> str:
+        return f"File too large. Maximum size: {settings.max_upload_size_mb}MB"
+
+    async def _reject(self, send) -> None:
+        body = json.dumps({"detail": self._detail()}).encode()
+        await send({
+            "type": "http.response.start",
+            "status": 413,
+            "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+        })
+        await send({"type": "http.response.body", "body": body})
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] not in self.paths:
+            await self.app(scope, receive, send)
+            return
+
+        for name, value in scope.get("headers", []):
+            if name == b"content-length":
+                try:
+                    declared = int(value)
+                except ValueError:
+                    declared = 0
+                if declared > self.max_bytes:
+                    await self._reject(send)
+                    return
+                break
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    raise HTTPException(status_code=413, detail=self._detail())
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+
 def get_current_month_year() -> str:
     """Get current month-year string in format YYYY-MM"""
     now = datetime.now()
     return now.strftime("%Y-%m")
 
 
-async def check_free_generation_limit(
+# Fast path: (device, ip, mese) che hanno esaurito la quota free, rifiutati senza query.
+# Per processo; il TTL limita quanto a lungo un rilascio fatto da un altro processo resta invisibile.
+_free_quota_exhausted = TTLCache(
+    maxsize=settings.free_quota_exhausted_cache_size,
+    ttl=settings.free_quota_exhausted_cache_seconds,
+)
+
+
+def _free_quota_key(device_id: str, ip_address: str) -> tuple[str, str, str]:
+    return (device_id, ip_address, get_current_month_year())
+
+
+def is_free_quota_exhausted(device_id: str, ip_address: str) -> bool:
+    """True se la quota del mese è già risultata esaurita di recente (nessun accesso al DB)."""
+    return _free_quota_key(device_id, ip_address) in _free_quota_exhausted
+
+
+def _free_generation_upsert(device_id: str, ip_address: str, month_year: str):
+    """INSERT count=1, oppure count+1 se la riga (device, ip, mese) esiste già (indice unico)."""
+    stmt = pg_insert(FreeGenerationLog).values(
+        id=generate_uuid(),
+        device_id=device_id,
+        ip_address=ip_address,
+        month_year=month_year,
+        count=1,
+    )
+    return stmt, dict(count=FreeGenerationLog.count + 1, updated_at=func.now())
+
+
+async def reserve_free_generation(
     db: AsyncSession,
     device_id: str,
     ip_address: str
-) -> tuple[bool, int]:
+) -> bool:
     """
-    Check if user can make a free generation.
-    Returns (can_generate, current_count)
+    Prenota una generation free del mese per device+IP in un solo statement:
+    INSERT ... ON CONFLICT DO UPDATE SET count = count + 1 WHERE count < limite RETURNING count.
+    False (nessuna riga) se la quota è esaurita. Non fa commit.
     """
-    month_year = get_current_month_year()
-    
-    # Try to get existing record
+    key = _free_quota_key(device_id, ip_address)
+    if settings.free_generations_per_month <= 0:
+        return False
+    stmt, set_ = _free_generation_upsert(device_id, ip_address, key[2])
     result = await db.execute(
-        select(FreeGenerationLog).where(
+        stmt.on_conflict_do_update(
+            index_elements=["device_id", "ip_address", "month_year"],
+            set_=set_,
+            where=FreeGenerationLog.count < settings.free_generations_per_month,
+        ).returning(FreeGenerationLog.count)
+    )
+    count = result.scalar_one_or_none()
+    if count is None or count >= settings.free_generations_per_month:
+        _free_quota_exhausted.set(key, True)
+    return count is not None
+
+
+async def release_free_generation(
+    db: AsyncSession,
+    device_id: str,
+    ip_address: str
+) -> None:
+    """Restituisce una generation free prenotata (generation fallita). Non fa commit."""
+    key = _free_quota_key(device_id, ip_address)
+    await db.execute(
+        update(FreeGenerationLog)
+        .where(
             FreeGenerationLog.device_id == device_id,
             FreeGenerationLog.ip_address == ip_address,
-            FreeGenerationLog.month_year == month_year
+            FreeGenerationLog.month_year == key[2],
+            FreeGenerationLog.count > 0,
         )
+        .values(count=FreeGenerationLog.count - 1, updated_at=func.now())
     )
-    log_entry = result.scalar_one_or_none()
-    
-    if log_entry is None:
-        # First generation this month
-        return True, 0
-    
-    if log_entry.count >= settings.free_generations_per_month:
-        return False, log_entry.count
-    
-    return True, log_entry.count
+    _free_quota_exhausted.pop(key)
 
 
 async def increment_free_generation_count(
@@ -64,29 +246,12 @@ async def increment_free_generation_count(
     device_id: str,
     ip_address: str
 ) -> None:
-    """Increment free generation count for device+IP"""
-    month_year = get_current_month_year()
-    
-    # Try to get existing record
-    result = await db.execute(
-        select(FreeGenerationLog).where(
-            FreeGenerationLog.device_id == device_id,
-            FreeGenerationLog.ip_address == ip_address,
-            FreeGenerationLog.month_year == month_year
+    """Increment free generation count for device+IP (generation completate senza prenotazione)."""
+    stmt, set_ = _free_generation_upsert(device_id, ip_address, get_current_month_year())
+    await db.execute(
+        stmt.on_conflict_do_update(
+            index_elements=["device_id", "ip_address", "month_year"],
+            set_=set_,
         )
     )
-    log_entry = result.scalar_one_or_none()
-    
-    if log_entry is None:
-        # Create new record
-        log_entry = FreeGenerationLog(
-            device_id=device_id,
-            ip_address=ip_address,
-            month_year=month_year,
-            count=1
-        )
-        db.add(log_entry)
-    else:
-        log_entry.count += 1
-    
     await db.commit()
@@ -1,102 +1,199 @@
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageChops, ImageDraw, ImageFont
+import asyncio
 import io
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
 from typing import Optional
+from app.config import settings
+
+# Il lavoro Pillow (decode, composite, rotate, encode JPEG) gira fuori dall'event loop.
+# Executor e semaforo sono creati al primo uso; shutdown_executor() li chiude (lifespan).
+_executor: Optional[Executor] = None
+_semaphore: Optional[asyncio.Semaphore] = None
+_stats = {
+    "waiting": 0,        # job in coda sul semaforo
+    "in_flight": 0,      # job in esecuzione nell'executor
+    "completed": 0,
+    "failed": 0,
+    "total_wait_ms": 0.0,
+    "total_run_ms": 0.0,
+    "max_wait_ms": 0.0,
+}
+
+
+def _get_executor() -> Executor:
+    global _executor
+    if _executor is None:
+        workers = max(1, settings.watermark_workers)
+        if settings.watermark_executor == "process":
+            _executor = ProcessPoolExecutor(max_workers=workers)
+        else:
+            # Pillow rilascia il GIL nelle operazioni pesanti: i thread bastano nella maggior parte dei casi
+            _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="watermark")
+    return _executor
+
+
+def _get_semaphore() -> asyncio.Semaphore:
+    global _semaphore
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(max(1, settings.watermark_max_in_flight))
+    return _semaphore
+
+
+def shutdown_executor() -> None:
+    """Chiude l'executor del watermark (chiamato allo shutdown dell'app)."""
+    global _executor, _semaphore
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+    _semaphore = None
+
+
+def get_stats() -> dict:
+    """Metriche del watermark: profondità coda, job in corso, tempi medi/max di attesa ed esecuzione."""
+    done = _stats["completed"] + _stats["failed"]
+    overlay_cache = _get_overlay_mask.cache_info()  # solo thread executor: i processi hanno la loro cache
+    return {
+        "executor": settings.watermark_executor,
+        "workers": settings.watermark_workers,
+        "max_in_flight": settings.watermark_max_in_flight,
+        "queue_depth": _stats["waiting"],
+        "in_flight": _stats["in_flight"],
+        "completed": _stats["completed"],
+        "failed": _stats["failed"],
+        "avg_wait_ms": round(_stats["total_wait_ms"] / done, 1) if done else 0.0,
+        "max_wait_ms": round(_stats["max_wait_ms"], 1),
+        "avg_run_ms": round(_stats["total_run_ms"] / done, 1) if done else 0.0,
+        "overlay_cache_hits": overlay_cache.hits,
+        "overlay_cache_misses": overlay_cache.misses,
+        "overlay_cache_size": overlay_cache.currsize,
+    }
 
 
 async def apply_watermark(image_bytes: bytes) -> bytes:
-    """Apply watermark to image and return watermarked image bytes"""
-    # Open image from bytes
-    image = Image.open(io.BytesIO(image_bytes))
-    
-    # Convert to RGB if necessary
-    if image.mode != "RGB":
-        image = image.convert("RGB")
-    
-    # Create a copy for drawing
-    draw = ImageDraw.Draw(image)
-    
-    # Get image dimensions
-    width, height = image.size
-    
-    # Watermark text
-    watermark_text = "AI SAMPLE – UPGRADE FOR CLEAN IMAGE"
-    
-    # Font: percorsi per macOS, Linux (Debian/Ubuntu/Render), fallback default
-    font_size = max(width, height) // 20
-    font = None
-    for path in (
-        "/System/Library/Fonts/Helvetica.ttc",
-        "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf",
-        "/usr/share/fonts/truetype/liberation/LiberationSans-Bold.ttf",
-    ):
+    """Apply watermark to image and return watermarked image bytes.
+    Esegue _apply_watermark_sync nell'executor; al massimo watermark_max_in_flight job alla volta."""
+    loop = asyncio.get_running_loop()
+    queued_at = time.perf_counter()
+    _stats["waiting"] += 1
+    acquired = False
+    try:
+        async with _get_semaphore():
+            _stats["waiting"] -= 1
+            acquired = True
+            started_at = time.perf_counter()
+            wait_ms = (started_at - queued_at) * 1000
+            _stats["total_wait_ms"] += wait_ms
+            _stats["max_wait_ms"] = max(_stats["max_wait_ms"], wait_ms)
+            _stats["in_flight"] += 1
+            try:
+                result = await loop.run_in_executor(_get_executor(), _apply_watermark_sync, image_bytes)
+            except Exception:
+                _stats["failed"] += 1
+                raise
+            finally:
+                _stats["in_flight"] -= 1
+                _stats["total_run_ms"] += (time.perf_counter() - started_at) * 1000
+            _stats["completed"] += 1
+            return result
+    finally:
+        if not acquired:
+            _stats["waiting"] -= 1  # cancellato mentre era in coda
+
+
+WATERMARK_TEXT = "AI SAMPLE – UPGRADE FOR CLEAN IMAGE"
+WATERMARK_COLOR = (255, 215, 0)  # Vivid yellow
+WATERMARK_MAIN_ALPHA = 230       # testo centrale: alta opacità
+WATERMARK_TILED_ALPHA = 180      # testi diagonali: semi-trasparenti
+
+# Font: percorsi per macOS, Linux (Debian/Ubuntu/Render), fallback default
+_FONT_PATHS = (
+    "/System/Library/Fonts/Helvetica.ttc",
+    "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf",
+    "/usr/share/fonts/truetype/liberation/LiberationSans-Bold.ttf",
+)
+
+
+@lru_cache(maxsize=16)
+def _load_font(font_size: int):
+    """Font caricato una volta per dimensione (evita la ricerca su disco a ogni watermark)."""
+    for path in _FONT_PATHS:
         try:
-            font = ImageFont.truetype(path, font_size)
-            break
+            return ImageFont.truetype(path, font_size)
         except Exception:
             continue
-    if font is None:
-        font = ImageFont.load_default()
+    return ImageFont.load_default()
+
+
+@lru_cache(maxsize=max(1, settings.watermark_overlay_cache_size))
+def _get_overlay_mask(width: int, height: int, text: str) -> Image.Image:
+    """Maschera alpha (L) del watermark: testo centrale + testi diagonali, già ruotata.
+    Tutto il testo ha lo stesso colore, quindi un solo layer a 1 byte/pixel descrive l'overlay
+    (un quarto della memoria di un layer RGBA). WaveSpeed restituisce poche dimensioni fisse:
+    dopo il primo uso il watermark è un solo composite."""
+    font_size = max(width, height) // 20
+    font = _load_font(font_size)
+
+    main_mask = Image.new("L", (width, height), 0)
+    main_draw = ImageDraw.Draw(main_mask)
 
     # Bounding box testo (textbbox in Pillow 8+; fallback per versioni vecchie)
     try:
-        bbox = draw.textbbox((0, 0), watermark_text, font=font)
+        bbox = main_draw.textbbox((0, 0), text, font=font)
         text_width = bbox[2] - bbox[0]
         text_height = bbox[3] - bbox[1]
     except AttributeError:
         text_width = width // 2
         text_height = max(font_size, height // 20)
-    
-    # Calculate diagonal position (from top-left to bottom-right)
-    # Position text in center with rotation
-    angle = -45  # 45 degrees counter-clockwise
-    
-    # Create a temporary image for rotated text
-    temp_img = Image.new("RGBA", (width, height), (255, 255, 255, 0))
-    temp_draw = ImageDraw.Draw(temp_img)
-    
+
     # Calculate center position
     x = (width - text_width) // 2
     y = (height - text_height) // 2
-    
-    # Draw text with high opacity
-    temp_draw.text(
-        (x, y),
-        watermark_text,
-        font=font,
-        fill=(255, 215, 0, 230),  # Vivid yellow with high opacity (RGB + Alpha)
-    )
-    
-    # Rotate the text image
-    rotated = temp_img.rotate(angle, expand=False)
-    
-    # Paste rotated text onto original image
-    image = Image.alpha_composite(
-        image.convert("RGBA"),
-        rotated
-    ).convert("RGB")
-    
-    # Also add a semi-transparent overlay for extra protection
-    overlay = Image.new("RGBA", (width, height), (0, 0, 0, 0))
-    overlay_draw = ImageDraw.Draw(overlay)
-    
-    # Draw multiple diagonal watermarks
+
+    # Testo centrale ad alta opacità
+    main_draw.text((x, y), text, font=font, fill=WATERMARK_MAIN_ALPHA)
+
+    # Also add a semi-transparent overlay for extra protection: multiple diagonal watermarks
+    tiled_mask = Image.new("L", (width, height), 0)
+    tiled_draw = ImageDraw.Draw(tiled_mask)
     for i in range(-2, 3):
         offset_x = i * (width // 4)
         offset_y = i * (height // 4)
-        overlay_draw.text(
-            (x + offset_x, y + offset_y),
-            watermark_text,
-            font=font,
-            fill=(255, 215, 0, 180),
-        )
+        tiled_draw.text((x + offset_x, y + offset_y), text, font=font, fill=WATERMARK_TILED_ALPHA)
+
+    # screen(a, b) = a + b * (1 - a): è l'alpha di "b sopra a", quindi fonde i due layer
+    # esattamente come due alpha_composite in sequenza. Una sola rotazione per entrambi.
+    angle = -45  # 45 degrees counter-clockwise
+    return ImageChops.screen(main_mask, tiled_mask).rotate(angle, expand=False)
+
+
+def _jpeg_save_options() -> dict:
+    """Profilo JPEG dell'output watermarked (qualità, progressive, subsampling) da settings."""
+    options = {
+        "quality": settings.watermark_jpeg_quality,
+        "progressive": settings.watermark_jpeg_progressive,
+    }
+    if settings.watermark_jpeg_subsampling:
+        options["subsampling"] = settings.watermark_jpeg_subsampling  # "4:4:4", "4:2:2", "4:2:0"
+    return options
+
+
+def _apply_watermark_sync(image_bytes: bytes) -> bytes:
+    """Watermark sincrono (CPU-bound): da eseguire nell'executor, mai sull'event loop.
+    Un solo buffer full-frame: il colore viene fuso in place sull'immagine RGB tramite la maschera."""
+    # Open image from bytes
+    image = Image.open(io.BytesIO(image_bytes))
     
-    rotated_overlay = overlay.rotate(angle, expand=False)
-    image = Image.alpha_composite(
-        image.convert("RGBA"),
-        rotated_overlay
-    ).convert("RGB")
+    # Convert to RGB if necessary
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    
+    width, height = image.size
+    mask = _get_overlay_mask(width, height, WATERMARK_TEXT)
+    image.paste(WATERMARK_COLOR, (0, 0, width, height), mask)
     
     # Convert back to bytes
     output = io.BytesIO()
-    image.save(output, format="JPEG", quality=95)
+    image.save(output, format="JPEG", **_jpeg_save_options())
     return output.getvalue()
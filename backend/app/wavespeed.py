@@ -3,14 +3,60 @@ import asyncio
 from typing import Optional, Dict, Any
 from app.config import settings
 
+# Client HTTP condiviso dal processo (pool di connessioni keep-alive, HTTP/2).
+# Creato nel lifespan FastAPI (init_http_client) e chiuso allo shutdown (close_http_client).
+_http_client: Optional[httpx.AsyncClient] = None
+
+
+def _build_http_client() -> httpx.AsyncClient:
+    limits = httpx.Limits(
+        max_connections=settings.wavespeed_max_connections,
+        max_keepalive_connections=settings.wavespeed_max_keepalive_connections,
+        keepalive_expiry=settings.wavespeed_keepalive_expiry,
+    )
+    return httpx.AsyncClient(
+        timeout=httpx.Timeout(30.0, connect=10.0),
+        limits=limits,
+        http2=settings.wavespeed_http2,
+    )
+
+
+async def init_http_client() -> httpx.AsyncClient:
+    """Crea il client condiviso (idempotente). Chiamato all'avvio dell'app."""
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = _build_http_client()
+    return _http_client
+
+
+async def close_http_client() -> None:
+    """Chiude il client condiviso e le connessioni nel pool. Chiamato allo shutdown."""
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """Client condiviso; se il lifespan non è partito (script, test) lo crea al primo uso."""
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = _build_http_client()
+    return _http_client
+
 
 class WaveSpeedClient:
     """Async client for WaveSpeed API"""
     
-    def __init__(self, api_key: str):
+    def __init__(self, api_key: str, http_client: Optional[httpx.AsyncClient] = None):
         self.api_key = api_key
         self.base_url = "https://api.wavespeed.ai/api/v3"
         self.timeout = httpx.Timeout(30.0, connect=10.0)
+        self._client = http_client
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        return self._client or get_http_client()
     
     async def create_edit_task(
         self,
@@ -39,11 +85,10 @@ class WaveSpeedClient:
         }
         params = {"webhook": webhook_url} if webhook_url else None
 
-        async with httpx.AsyncClient(timeout=self.timeout) as client:
-            response = await client.post(url, headers=headers, params=params, json=payload)
-            response.raise_for_status()
-            result = response.json().get("data") or response.json()
-            return result
+        response = await self.client.post(url, headers=headers, params=params, json=payload, timeout=self.timeout)
+        response.raise_for_status()
+        result = response.json().get("data") or response.json()
+        return result
     
     async def get_prediction_result(self, request_id: str) -> Dict[str, Any]:
         """Get prediction result by request_id"""
@@ -52,11 +97,10 @@ class WaveSpeedClient:
             "Authorization": f"Bearer {self.api_key}",
         }
         
-        async with httpx.AsyncClient(timeout=self.timeout) as client:
-            response = await client.get(url, headers=headers)
-            response.raise_for_status()
-            result = response.json()["data"]
-            return result
+        response = await self.client.get(url, headers=headers, timeout=self.timeout)
+        response.raise_for_status()
+        result = response.json()["data"]
+        return result
     
     async def poll_for_completion(
         self,
@@ -80,4 +124,4 @@ class WaveSpeedClient:
 
 
 def get_wavespeed_client() -> WaveSpeedClient:
-    return WaveSpeedClient(api_key=settings.wavespeed_api_key)
+    return WaveSpeedClient(api_key=settings.wavespeed_api_key, http_client=get_http_client())
@@ -0,0 +1,84 @@
+"""Benchmark login: bcrypt inline nell'event loop (comportamento originale) vs app/hashing.py.
+
+Simula N login concorrenti (solo la verifica bcrypt, senza DB) e misura:
+- throughput (login/s) e latenza p50/p99 per login
+- blocco dell'event loop: ritardo massimo di un heartbeat ogni 10 ms (quanto aspetterebbero
+  webhook e polling durante il burst)
+
+Eseguire dalla cartella backend (serve il .env per app.config):
+    python scripts/bench_login.py [--logins 40] [--workers 2]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from app import auth, hashing  # noqa: E402
+from app.config import settings  # noqa: E402
+
+PASSWORD = "correct horse battery staple"
+
+
+async def _heartbeat(stop: asyncio.Event, lags: list[float], interval: float = 0.01) -> None:
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        lags.append(max(0.0, loop.time() - expected) * 1000)
+
+
+async def _login_inline(password_hash: str) -> bool:
+    return auth.verify_password(PASSWORD, password_hash)
+
+
+async def _login_pooled(password_hash: str) -> bool:
+    return await hashing.verify_password(PASSWORD, password_hash)
+
+
+async def _run(name: str, login, password_hash: str, logins: int) -> None:
+    stop = asyncio.Event()
+    lags: list[float] = []
+    heartbeat = asyncio.create_task(_heartbeat(stop, lags))
+    await asyncio.sleep(0.05)
+
+    # Latenza dall'arrivo del burst: con bcrypt inline le richieste aspettano l'event loop, non la coda
+    latencies: list[float] = []
+    start = time.perf_counter()
+
+    async def one():
+        assert await login(password_hash)
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    await asyncio.gather(*(one() for _ in range(logins)))
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await heartbeat
+
+    latencies.sort()
+    print(
+        f"{name:<8} {logins / elapsed:7.1f} login/s   "
+        f"p50 {latencies[len(latencies) // 2]:7.0f} ms   p99 {latencies[int(len(latencies) * 0.99) - 1]:7.0f} ms   "
+        f"max loop stall {max(lags, default=0.0):7.0f} ms"
+    )
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--logins", type=int, default=40)
+    parser.add_argument("--workers", type=int, default=settings.password_hash_workers)
+    args = parser.parse_args()
+    settings.password_hash_workers = args.workers
+    settings.password_hash_max_queue = max(settings.password_hash_max_queue, args.logins)
+
+    password_hash = auth.get_password_hash(PASSWORD)
+    print(f"{args.logins} login concorrenti, bcrypt rounds={password_hash.split('$')[2]}, workers={args.workers}")
+    await _run("inline", _login_inline, password_hash, args.logins)
+    await _run("pooled", _login_pooled, password_hash, args.logins)
+    hashing.shutdown_executor()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,138 @@
+"""Benchmark watermark, per dimensione d'uscita WaveSpeed (4k free tier).
+
+1. cache: primo watermark (cache maschere vuota) vs ripetuto (maschera in cache)
+2. compare: implementazione originale (due overlay RGBA, conversioni RGB<->RGBA) vs attuale
+   (una maschera, composite in place): latenza e picco di memoria (RSS) in un processo dedicato
+
+Eseguire dalla cartella backend (serve il .env per app.config):
+    python scripts/bench_watermark.py [--runs 5]
+"""
+import argparse
+import io
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from PIL import Image, ImageDraw  # noqa: E402
+
+from app import watermark  # noqa: E402
+
+# Dimensioni d'uscita WaveSpeed a 4k (free tier) per aspect ratio
+SIZES = {
+    "1:1": (4096, 4096),
+    "4:5": (3277, 4096),
+    "16:9": (4096, 2304),
+}
+
+
+def _legacy_watermark(image_bytes: bytes) -> bytes:
+    """Implementazione originale: due layer RGBA ruotati separatamente, due composite
+    con conversione RGB -> RGBA -> RGB ciascuno, JPEG q95. Solo per confronto."""
+    image = Image.open(io.BytesIO(image_bytes))
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    width, height = image.size
+    text = watermark.WATERMARK_TEXT
+    font = watermark._load_font(max(width, height) // 20)
+    bbox = ImageDraw.Draw(image).textbbox((0, 0), text, font=font)
+    x = (width - (bbox[2] - bbox[0])) // 2
+    y = (height - (bbox[3] - bbox[1])) // 2
+
+    temp_img = Image.new("RGBA", (width, height), (255, 255, 255, 0))
+    ImageDraw.Draw(temp_img).text((x, y), text, font=font, fill=(255, 215, 0, 230))
+    image = Image.alpha_composite(image.convert("RGBA"), temp_img.rotate(-45)).convert("RGB")
+
+    overlay = Image.new("RGBA", (width, height), (0, 0, 0, 0))
+    overlay_draw = ImageDraw.Draw(overlay)
+    for i in range(-2, 3):
+        overlay_draw.text(
+            (x + i * (width // 4), y + i * (height // 4)), text, font=font, fill=(255, 215, 0, 180)
+        )
+    image = Image.alpha_composite(image.convert("RGBA"), overlay.rotate(-45)).convert("RGB")
+
+    output = io.BytesIO()
+    image.save(output, format="JPEG", quality=95)
+    return output.getvalue()
+
+
+IMPLEMENTATIONS = {
+    "legacy": _legacy_watermark,
+    "current": watermark._apply_watermark_sync,
+}
+
+
+def _sample_jpeg(width: int, height: int) -> bytes:
+    image = Image.radial_gradient("L").resize((width, height)).convert("RGB")
+    output = io.BytesIO()
+    image.save(output, format="JPEG", quality=90)
+    return output.getvalue()
+
+
+def _time_ms(fn, *args) -> float:
+    start = time.perf_counter()
+    fn(*args)
+    return (time.perf_counter() - start) * 1000
+
+
+def _measure(name: str, data: bytes, runs: int, results) -> None:
+    """In un processo figlio: latenza migliore a caldo e picco RSS aggiuntivo rispetto all'avvio
+    (include la maschera in cache, che resta residente come in produzione)."""
+    fn = IMPLEMENTATIONS[name]
+    watermark._get_overlay_mask.cache_clear()  # cache ereditata dal processo padre (fork)
+    baseline_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    fn(data)  # warm-up (font/maschera in cache, come in produzione)
+    best_ms = min(_time_ms(fn, data) for _ in range(runs))
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results.put((best_ms, max(0, peak_kb - baseline_kb) / 1024))
+
+
+def _measure_in_child(name: str, data: bytes, runs: int) -> tuple[float, float]:
+    results = multiprocessing.Queue()
+    proc = multiprocessing.Process(target=_measure, args=(name, data, runs, results))
+    proc.start()
+    value = results.get()
+    proc.join()
+    return value
+
+
+def bench_cache(runs: int) -> None:
+    print(f"{'ratio':<6} {'size':>11} {'cold ms':>9} {'warm ms':>9} {'speedup':>8}")
+    for ratio, (width, height) in SIZES.items():
+        data = _sample_jpeg(width, height)
+        watermark._get_overlay_mask.cache_clear()
+        watermark._load_font.cache_clear()
+        cold = _time_ms(watermark._apply_watermark_sync, data)
+        warm = min(_time_ms(watermark._apply_watermark_sync, data) for _ in range(runs))
+        print(f"{ratio:<6} {width:>5}x{height:<5} {cold:>9.0f} {warm:>9.0f} {cold / warm:>7.1f}x")
+
+
+def bench_compare(runs: int) -> None:
+    print(f"{'ratio':<6} {'size':>11} {'legacy ms':>10} {'current ms':>11} {'legacy MB':>10} {'current MB':>11}")
+    for ratio, (width, height) in SIZES.items():
+        data = _sample_jpeg(width, height)
+        legacy_ms, legacy_mb = _measure_in_child("legacy", data, runs)
+        current_ms, current_mb = _measure_in_child("current", data, runs)
+        print(
+            f"{ratio:<6} {width:>5}x{height:<5} {legacy_ms:>10.0f} {current_ms:>11.0f} "
+            f"{legacy_mb:>10.0f} {current_mb:>11.0f}"
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5, help="watermark ripetuti per dimensione")
+    args = parser.parse_args()
+
+    print("== overlay cache ==")
+    bench_cache(args.runs)
+    print()
+    print("== legacy vs current (peak MB = RSS oltre il processo a riposo) ==")
+    bench_compare(args.runs)
+
+
+if __name__ == "__main__":
+    main()
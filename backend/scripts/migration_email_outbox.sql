@@ -0,0 +1,24 @@
+-- Outbox email: signup/resend-otp scrivono il messaggio nella stessa transazione dell'utente,
+-- il sender in background lo invia (vedi backend/app/email_outbox.py)
+-- Eseguire: psql "$DATABASE_URL" -f backend/scripts/migration_email_outbox.sql
+
+CREATE TABLE IF NOT EXISTS email_outbox_photoshotai (
+  id UUID PRIMARY KEY,
+  to_email VARCHAR NOT NULL,
+  subject VARCHAR NOT NULL,
+  body_plain TEXT,
+  body_html TEXT,
+  status VARCHAR NOT NULL DEFAULT 'queued',
+  attempts INTEGER NOT NULL DEFAULT 0,
+  available_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+  locked_until TIMESTAMPTZ,
+  expires_at TIMESTAMPTZ,
+  last_error TEXT,
+  created_at TIMESTAMPTZ DEFAULT now() NOT NULL,
+  sent_at TIMESTAMPTZ
+);
+
+-- Claim dei messaggi: solo righe ancora da inviare
+CREATE INDEX IF NOT EXISTS idx_email_outbox_claim_photoshotai
+  ON email_outbox_photoshotai (available_at)
+  WHERE status IN ('queued', 'sending');
@@ -0,0 +1,28 @@
+-- Generation batch (POST /api/generate-batch) e crediti prenotati per generation
+-- Eseguire: psql "$DATABASE_URL" -f backend/scripts/migration_generation_batches.sql
+
+CREATE TABLE IF NOT EXISTS generation_batches_photoshotai (
+  id UUID PRIMARY KEY,
+  user_id UUID NOT NULL REFERENCES users_photoshotai(id),
+  total_items INTEGER NOT NULL,
+  created_at TIMESTAMPTZ DEFAULT now()
+);
+CREATE INDEX IF NOT EXISTS ix_generation_batches_photoshotai_user_id ON generation_batches_photoshotai (user_id);
+
+ALTER TABLE generations_photoshotai ADD COLUMN IF NOT EXISTS batch_id UUID REFERENCES generation_batches_photoshotai(id);
+ALTER TABLE generations_photoshotai ADD COLUMN IF NOT EXISTS batch_index INTEGER;
+ALTER TABLE generations_photoshotai ADD COLUMN IF NOT EXISTS credits_reserved INTEGER NOT NULL DEFAULT 0;
+
+CREATE INDEX IF NOT EXISTS idx_generations_batch_photoshotai
+  ON generations_photoshotai (batch_id, batch_index)
+  WHERE batch_id IS NOT NULL;
+
+-- Item rimasti processing senza wavespeed_request_id (restart durante l'invio): il reconciler li scade e rimborsa
+CREATE INDEX IF NOT EXISTS idx_generations_unsubmitted_photoshotai
+  ON generations_photoshotai (created_at)
+  WHERE status = 'processing' AND wavespeed_request_id IS NULL;
+
+-- Generation non-batch rimaste pending con il credito prenotato (restart tra prenotazione e invio): il reconciler le scade e rimborsa
+CREATE INDEX IF NOT EXISTS idx_generations_stranded_pending_photoshotai
+  ON generations_photoshotai (created_at)
+  WHERE status = 'pending' AND batch_id IS NULL;
@@ -0,0 +1,9 @@
+-- Cache risultati di generazione: hash della richiesta (input + prompt + parametri + tier)
+-- Eseguire: psql "$DATABASE_URL" -f backend/scripts/migration_generation_cache.sql
+
+ALTER TABLE generations_photoshotai ADD COLUMN IF NOT EXISTS request_hash VARCHAR(64);
+
+-- Lookup della cache: solo generation completate con hash
+CREATE INDEX IF NOT EXISTS idx_generations_request_hash_photoshotai
+  ON generations_photoshotai (request_hash, completed_at)
+  WHERE request_hash IS NOT NULL AND status = 'completed';
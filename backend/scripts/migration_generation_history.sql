@@ -0,0 +1,51 @@
+-- Storico generation: contatore per utente mantenuto da trigger (vedi GET /api/user/generations)
+-- Eseguire: psql "$DATABASE_URL" -f backend/scripts/migration_generation_history.sql
+--
+-- La paginazione usa già idx_generations_user_created_photoshotai (user_id, created_at).
+-- Trigger per statement con transition table: un INSERT di un batch da 500 generation aggiorna il
+-- contatore con un solo UPDATE, non 500.
+
+ALTER TABLE users_photoshotai ADD COLUMN IF NOT EXISTS generation_count INTEGER NOT NULL DEFAULT 0;
+
+CREATE OR REPLACE FUNCTION generations_count_insert_photoshotai() RETURNS trigger AS $$
+BEGIN
+  UPDATE users_photoshotai u
+     SET generation_count = u.generation_count + n.cnt
+    FROM (SELECT user_id, count(*) AS cnt FROM new_rows WHERE user_id IS NOT NULL GROUP BY user_id) n
+   WHERE u.id = n.user_id;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION generations_count_delete_photoshotai() RETURNS trigger AS $$
+BEGIN
+  UPDATE users_photoshotai u
+     SET generation_count = greatest(u.generation_count - o.cnt, 0)
+    FROM (SELECT user_id, count(*) AS cnt FROM old_rows WHERE user_id IS NOT NULL GROUP BY user_id) o
+   WHERE u.id = o.user_id;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_generations_count_insert_photoshotai ON generations_photoshotai;
+CREATE TRIGGER trg_generations_count_insert_photoshotai
+  AFTER INSERT ON generations_photoshotai
+  REFERENCING NEW TABLE AS new_rows
+  FOR EACH STATEMENT EXECUTE FUNCTION generations_count_insert_photoshotai();
+
+DROP TRIGGER IF EXISTS trg_generations_count_delete_photoshotai ON generations_photoshotai;
+CREATE TRIGGER trg_generations_count_delete_photoshotai
+  AFTER DELETE ON generations_photoshotai
+  REFERENCING OLD TABLE AS old_rows
+  FOR EACH STATEMENT EXECUTE FUNCTION generations_count_delete_photoshotai();
+
+-- Allineamento iniziale (anche per rieseguire la migration): dopo i trigger, così nessun insert va perso
+UPDATE users_photoshotai u
+   SET generation_count = c.cnt
+  FROM (
+    SELECT u2.id, count(g.id) AS cnt
+      FROM users_photoshotai u2
+      LEFT JOIN generations_photoshotai g ON g.user_id = u2.id
+     GROUP BY u2.id
+  ) c
+ WHERE u.id = c.id AND u.generation_count IS DISTINCT FROM c.cnt;
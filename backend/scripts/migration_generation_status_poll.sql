@@ -0,0 +1,10 @@
+-- Poll dello stato generation (GET /api/generations/{id}): indice parziale e covering sulle sole generation
+-- in corso, così la lettura delle colonne di stato può essere un index-only scan senza toccare la riga
+-- (prompt, URL di input...). Le generation completed/failed escono dall'indice: resta piccolo.
+-- Eseguire: psql "$DATABASE_URL" -f backend/scripts/migration_generation_status_poll.sql
+-- CONCURRENTLY: niente lock sulla tabella in produzione (non eseguire dentro una transazione).
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_generations_status_poll_photoshotai
+  ON generations_photoshotai (id)
+  INCLUDE (status, output_image_url, error_message, user_id, is_free, device_id)
+  WHERE status IN ('pending', 'processing');
@@ -0,0 +1,6 @@
+-- OTP verifica email con HMAC e tentativi contati (vedi backend/app/otp.py)
+-- Eseguire: psql "$DATABASE_URL" -f backend/scripts/migration_otp_hmac.sql
+--
+-- verification_otp_hash ora contiene "hmac-sha256$<hex>"; gli OTP bcrypt già emessi restano validi fino alla scadenza.
+
+ALTER TABLE users_photoshotai ADD COLUMN IF NOT EXISTS verification_otp_attempts INTEGER NOT NULL DEFAULT 0;
@@ -0,0 +1,10 @@
+-- Recupero dei webhook WaveSpeed persi (vedi backend/app/reconciler.py)
+-- Eseguire: psql "$DATABASE_URL" -f backend/scripts/migration_reconciler.sql
+
+ALTER TABLE generations_photoshotai ADD COLUMN IF NOT EXISTS poll_attempts INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE generations_photoshotai ADD COLUMN IF NOT EXISTS next_poll_at TIMESTAMPTZ;
+
+-- Solo le generation in attesa del risultato WaveSpeed: indice piccolo anche con tabella grande
+CREATE INDEX IF NOT EXISTS idx_generations_stale_processing_photoshotai
+  ON generations_photoshotai (next_poll_at, created_at)
+  WHERE status = 'processing' AND wavespeed_request_id IS NOT NULL;
@@ -0,0 +1,24 @@
+-- Coda persistente per l'elaborazione dei webhook WaveSpeed (vedi backend/app/jobs.py)
+-- Eseguire: psql "$DATABASE_URL" -f backend/scripts/migration_webhook_jobs.sql
+
+CREATE TABLE IF NOT EXISTS webhook_jobs_photoshotai (
+  id UUID PRIMARY KEY,
+  wavespeed_request_id VARCHAR NOT NULL,
+  wavespeed_status VARCHAR NOT NULL,
+  output_url VARCHAR,
+  error TEXT,
+  status VARCHAR NOT NULL DEFAULT 'queued',
+  attempts INTEGER NOT NULL DEFAULT 0,
+  max_attempts INTEGER NOT NULL DEFAULT 5,
+  available_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+  locked_until TIMESTAMPTZ,
+  last_error TEXT,
+  created_at TIMESTAMPTZ DEFAULT now() NOT NULL,
+  updated_at TIMESTAMPTZ DEFAULT now() NOT NULL,
+  finished_at TIMESTAMPTZ
+);
+
+-- Claim dei job: solo righe ancora da elaborare
+CREATE INDEX IF NOT EXISTS idx_webhook_jobs_claim_photoshotai
+  ON webhook_jobs_photoshotai (status, available_at)
+  WHERE status IN ('queued', 'running');
@@ -0,0 +1,14 @@
+-- Lane (paid/free) dei job webhook: worker e backpressure separati per lane (vedi backend/app/jobs.py)
+-- Eseguire dopo migration_webhook_jobs.sql: psql "$DATABASE_URL" -f backend/scripts/migration_webhook_jobs_lanes.sql
+
+ALTER TABLE webhook_jobs_photoshotai ADD COLUMN IF NOT EXISTS lane VARCHAR NOT NULL DEFAULT 'paid';
+
+-- Job già in coda: lane dalla generation
+UPDATE webhook_jobs_photoshotai j SET lane = 'free'
+FROM generations_photoshotai g
+WHERE g.wavespeed_request_id = j.wavespeed_request_id AND g.is_free AND j.status IN ('queued', 'running');
+
+DROP INDEX IF EXISTS idx_webhook_jobs_claim_photoshotai;
+CREATE INDEX IF NOT EXISTS idx_webhook_jobs_claim_photoshotai
+  ON webhook_jobs_photoshotai (lane, status, available_at)
+  WHERE status IN ('queued', 'running');
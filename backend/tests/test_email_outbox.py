@@ -0,0 +1,132 @@
+"""Sender dell'outbox contro un server SMTP locale (aiosmtpd): batch sulla stessa connessione, 550 →
+errore permanente (dead), retry dopo la riconnessione. Nessun DB: si testa il lato SMTP (_send_batch)."""
+import smtplib
+import socket
+
+import pytest
+from aiosmtpd.controller import Controller
+
+from app import email_outbox, email_sender
+from app.config import settings
+
+
+class _Handler:
+    """Rifiuta con 550 i destinatari che iniziano per "bounce", registra gli altri messaggi."""
+
+    def __init__(self):
+        self.sessions = 0
+        self.delivered: list[str] = []
+
+    async def handle_EHLO(self, server, session, envelope, hostname, responses):
+        self.sessions += 1
+        session.host_name = hostname
+        return responses
+
+    async def handle_RCPT(self, server, session, envelope, address, rcpt_options):
+        if address.startswith("bounce"):
+            return "550 5.1.1 no such user"
+        envelope.rcpt_tos.append(address)
+        return "250 OK"
+
+    async def handle_DATA(self, server, session, envelope):
+        self.delivered.extend(envelope.rcpt_tos)
+        return "250 OK"
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _start_server(handler: _Handler, port: int) -> Controller:
+    controller = Controller(handler, hostname="127.0.0.1", port=port)
+    controller.start()
+    return controller
+
+
+def _message(to_email: str) -> tuple[str, str, str, str]:
+    return (to_email, *email_sender.verification_otp_message("123456"))
+
+
+@pytest.fixture
+def smtp_port(monkeypatch):
+    port = _free_port()
+    monkeypatch.setattr(settings, "smtp_host", "127.0.0.1")
+    monkeypatch.setattr(settings, "smtp_port", port)
+    monkeypatch.setattr(settings, "smtp_starttls", False)
+    monkeypatch.setattr(settings, "smtp_timeout_seconds", 5)
+    monkeypatch.setattr(settings, "gmail_user", "noreply@example.com")
+    monkeypatch.setattr(settings, "gmail_pass", "")
+    connection = email_sender.SMTPConnection()
+    monkeypatch.setattr(email_outbox, "_connection", connection)
+    yield port
+    connection.close()
+
+
+@pytest.fixture
+def handler(smtp_port):
+    handler = _Handler()
+    controller = _start_server(handler, smtp_port)
+    yield handler
+    controller.stop()
+
+
+def test_batch_uses_one_connection(handler):
+    recipients = [f"user{i}@example.com" for i in range(5)]
+    assert email_outbox._send_batch([_message(r) for r in recipients]) == [None] * 5
+    assert email_outbox._send_batch([_message("late@example.com")]) == [None]
+    assert handler.delivered == recipients + ["late@example.com"]
+    assert email_outbox._connection.opened == 1
+    assert handler.sessions == 1
+
+
+def test_550_is_permanent_and_keeps_the_connection(handler):
+    results = email_outbox._send_batch([
+        _message("first@example.com"),
+        _message("bounce@example.com"),
+        _message("second@example.com"),
+    ])
+    assert results[0] is None and results[2] is None
+    assert isinstance(results[1], smtplib.SMTPRecipientsRefused)
+    assert email_outbox._is_permanent(results[1])
+    assert handler.delivered == ["first@example.com", "second@example.com"]
+    assert email_outbox._connection.opened == 1
+
+
+def test_server_down_is_retried_after_reconnect(smtp_port):
+    first = _Handler()
+    controller = _start_server(first, smtp_port)
+    assert email_outbox._send_batch([_message("before@example.com")]) == [None]
+    controller.stop()
+
+    # Server giù: errore temporaneo (→ retry con backoff), non dead
+    [error] = email_outbox._send_batch([_message("retry@example.com")])
+    assert error is not None
+    assert not email_outbox._is_permanent(error)
+
+    second = _Handler()
+    controller = _start_server(second, smtp_port)
+    try:
+        assert email_outbox._send_batch([_message("retry@example.com")]) == [None]
+    finally:
+        controller.stop()
+    assert second.delivered == ["retry@example.com"]
+    assert email_outbox._connection.opened == 2
+
+
+def test_stale_connection_reconnects_once(smtp_port):
+    first = _Handler()
+    controller = _start_server(first, smtp_port)
+    assert email_outbox._send_batch([_message("before@example.com")]) == [None]
+    controller.stop()
+
+    # Il server ha chiuso la connessione rimasta aperta: il send successivo si riconnette da solo
+    second = _Handler()
+    controller = _start_server(second, smtp_port)
+    try:
+        assert email_outbox._send_batch([_message("after@example.com")]) == [None]
+    finally:
+        controller.stop()
+    assert second.delivered == ["after@example.com"]
+    assert email_outbox._connection.opened == 2
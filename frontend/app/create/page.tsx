@@ -13,30 +13,40 @@ const CONTAINER = 'mx-auto max-w-[1200px] px-6 md:px-10 lg:px-14'
 
 const LOADING_MESSAGES = ['Processing your image…', 'Adding the finishing touches...', 'Almost there...']
 
-const POLL_INTERVAL_MS = 3000
+const LONG_POLL_WAIT_S = 25
+const POLL_RETRY_MS = 3000
 
+// Long-poll: una richiesta resta aperta finché la generation non cambia stato (max LONG_POLL_WAIT_S)
 function startPolling(
   generationId: string,
   deviceId: string | undefined,
   onCompleted: (imageUrl: string) => void,
   onFailed: (message: string) => void,
 ) {
-  const id = setInterval(async () => {
-    try {
-      const res = await generationApi.getGeneration(generationId, deviceId)
-      if (res.status === 'completed') {
-        clearInterval(id)
-        const url = getAbsoluteImageUrl(res.output_image_url) ?? res.output_image_url ?? ''
-        if (url) onCompleted(url)
-      } else if (res.status === 'failed') {
-        clearInterval(id)
-        onFailed(res.error_message || 'Generation failed')
+  let stopped = false
+  const poll = async () => {
+    while (!stopped) {
+      try {
+        const res = await generationApi.getGeneration(generationId, deviceId, LONG_POLL_WAIT_S)
+        if (stopped) return
+        if (res.status === 'completed') {
+          const url = getAbsoluteImageUrl(res.output_image_url) ?? res.output_image_url ?? ''
+          if (url) onCompleted(url)
+          return
+        } else if (res.status === 'failed') {
+          onFailed(res.error_message || 'Generation failed')
+          return
+        }
+      } catch {
+        // retry dopo una pausa
+        await new Promise((resolve) => setTimeout(resolve, POLL_RETRY_MS))
       }
-    } catch {
-      // retry al prossimo giro
     }
-  }, POLL_INTERVAL_MS)
-  return () => clearInterval(id)
+  }
+  poll()
+  return () => {
+    stopped = true
+  }
 }
 
 export default function CreatePage() {
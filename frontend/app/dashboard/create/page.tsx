@@ -8,29 +8,39 @@ import { isAuthenticated } from '@/lib/auth'
 import toast from 'react-hot-toast'
 import { ResultPopup } from '@/components/ResultPopup'
 
-const POLL_INTERVAL_MS = 3000
+const LONG_POLL_WAIT_S = 25
+const POLL_RETRY_MS = 3000
 
+// Long-poll: una richiesta resta aperta finché la generation non cambia stato (max LONG_POLL_WAIT_S)
 function startPolling(
   generationId: string,
   onCompleted: (imageUrl: string) => void,
   onFailed: (message: string) => void,
 ) {
-  const id = setInterval(async () => {
-    try {
-      const res = await generationApi.getGeneration(generationId, undefined)
-      if (res.status === 'completed') {
-        clearInterval(id)
-        const url = getAbsoluteImageUrl(res.output_image_url) ?? res.output_image_url ?? ''
-        if (url) onCompleted(url)
-      } else if (res.status === 'failed') {
-        clearInterval(id)
-        onFailed(res.error_message || 'Generation failed')
+  let stopped = false
+  const poll = async () => {
+    while (!stopped) {
+      try {
+        const res = await generationApi.getGeneration(generationId, undefined, LONG_POLL_WAIT_S)
+        if (stopped) return
+        if (res.status === 'completed') {
+          const url = getAbsoluteImageUrl(res.output_image_url) ?? res.output_image_url ?? ''
+          if (url) onCompleted(url)
+          return
+        } else if (res.status === 'failed') {
+          onFailed(res.error_message || 'Generation failed')
+          return
+        }
+      } catch {
+        // retry dopo una pausa
+        await new Promise((resolve) => setTimeout(resolve, POLL_RETRY_MS))
       }
-    } catch {
-      // retry al prossimo giro
     }
-  }, POLL_INTERVAL_MS)
-  return () => clearInterval(id)
+  }
+  poll()
+  return () => {
+    stopped = true
+  }
 }
 
 export default function DashboardCreatePage() {
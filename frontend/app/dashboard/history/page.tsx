@@ -11,7 +11,10 @@ const PAGE_SIZE = 12
 
 export default function DashboardHistoryPage() {
   const router = useRouter()
-  const [page, setPage] = useState(1)
+  // Cursore di ogni pagina visitata: Next aggiunge next_cursor, Previous torna al precedente
+  const [cursors, setCursors] = useState<(string | undefined)[]>([undefined])
+  const page = cursors.length
+  const cursor = cursors[cursors.length - 1]
   const authenticated = isAuthenticated()
 
   useEffect(() => {
@@ -21,8 +24,8 @@ export default function DashboardHistoryPage() {
   }, [authenticated, router])
 
   const { data, isLoading } = useQuery({
-    queryKey: ['generations', page],
-    queryFn: () => userApi.getGenerations(page, PAGE_SIZE),
+    queryKey: ['generations', cursor ?? ''],
+    queryFn: () => userApi.getGenerations(cursor, PAGE_SIZE),
     enabled: authenticated,
   })
 
@@ -38,7 +41,7 @@ export default function DashboardHistoryPage() {
 
   const totalPages = data ? Math.ceil(data.total / PAGE_SIZE) : 0
   const hasPrev = page > 1
-  const hasNext = page < totalPages
+  const hasNext = Boolean(data?.next_cursor)
 
   return (
     <div className="max-w-7xl mx-auto px-4 sm:px-6 lg:px-8 py-12">
@@ -102,7 +105,7 @@ export default function DashboardHistoryPage() {
           {totalPages > 1 && (
             <div className="mt-10 flex items-center justify-center gap-2">
               <button
-                onClick={() => setPage((p) => Math.max(1, p - 1))}
+                onClick={() => setCursors((c) => (c.length > 1 ? c.slice(0, -1) : c))}
                 disabled={!hasPrev}
                 className="px-4 py-2 rounded-md border border-gray-300 text-rich-black font-medium disabled:opacity-50 disabled:cursor-not-allowed hover:bg-gray-50"
               >
@@ -112,7 +115,7 @@ export default function DashboardHistoryPage() {
                 Page {page} of {totalPages}
               </span>
               <button
-                onClick={() => setPage((p) => Math.min(totalPages, p + 1))}
+                onClick={() => data?.next_cursor && setCursors((c) => [...c, data.next_cursor])}
                 disabled={!hasNext}
                 className="px-4 py-2 rounded-md border border-gray-300 text-rich-black font-medium disabled:opacity-50 disabled:cursor-not-allowed hover:bg-gray-50"
               >
@@ -29,7 +29,7 @@ export default function DashboardPage() {
   // Recent Generations: disattivato (commentato)
   // const { data: generations, isLoading: gensLoading } = useQuery({
   //   queryKey: ['generations'],
-  //   queryFn: () => userApi.getGenerations(1, 10),
+  //   queryFn: () => userApi.getGenerations(undefined, 10),
   //   enabled: authenticated,
   // })
 
@@ -77,9 +77,10 @@ export const userApi = {
     const response = await api.get('/api/user/me')
     return response.data
   },
-  getGenerations: async (page: number = 1, pageSize: number = 20) => {
+  // Keyset pagination: cursor = next_cursor della pagina precedente (undefined = prima pagina)
+  getGenerations: async (cursor?: string, pageSize: number = 20) => {
     const response = await api.get('/api/user/generations', {
-      params: { page, page_size: pageSize },
+      params: { page_size: pageSize, ...(cursor ? { cursor } : {}) },
     })
     return response.data
   },
@@ -131,10 +132,15 @@ export const generationApi = {
     const response = await api.post('/api/generate-paid', data, { timeout: GENERATE_TIMEOUT_MS })
     return response.data
   },
-  /** Polling sullo stato dopo 202. Per free passare deviceId, per paid usare auth. */
-  getGeneration: async (generationId: string, deviceId?: string): Promise<GenerationStatus> => {
+  /** Stato dopo 202. Per free passare deviceId, per paid usare auth.
+   * waitSeconds > 0: long-poll, il server risponde appena la generation cambia stato (o dopo waitSeconds). */
+  getGeneration: async (generationId: string, deviceId?: string, waitSeconds = 0): Promise<GenerationStatus> => {
+    const params: Record<string, string | number> = {}
+    if (deviceId != null) params.device_id = deviceId
+    if (waitSeconds > 0) params.wait = waitSeconds
     const res = await api.get<GenerationStatus>(`/api/generations/${generationId}`, {
-      params: deviceId != null ? { device_id: deviceId } : undefined,
+      params,
+      timeout: waitSeconds > 0 ? (waitSeconds + 10) * 1000 : undefined,
     })
     return res.data
   },